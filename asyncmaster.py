@@ -0,0 +1,250 @@
+import asyncio
+import contextlib
+import master
+import metrics
+import time
+import recovery
+import transactions
+
+# asyncio implementation of the master's 2-phase-commit state machine. Every in-flight transaction
+# is a coroutine on a single event loop instead of an OS thread blocked across the three phases.
+# Transaction creation, the log records and recovery are the same as in the threaded Master
+# (recovery runs on the blocking replicaProxies before the loop starts); the protocol itself talks
+# to the replicas through asyncReplicaProxies, whose calls return awaitables
+class AsyncMaster(master.Master):
+
+	# how often a write held back by a rebalance copy checks again
+	MOVE_POLL = 0.01
+
+	def __init__(self, logFileName, replicaProxies, asyncReplicaProxies, **kwargs):
+		master.Master.__init__(self, logFileName, replicaProxies, **kwargs)
+		self.asyncReplicaProxies = asyncReplicaProxies
+		self.asyncGroupProxies = [[asyncReplicaProxies[ix] for ix in group] for group in self.sharding.groups]
+		self.proxyGroups.update((id(proxy), group) for group, proxies in enumerate(self.asyncGroupProxies) for proxy in proxies)
+		self.peerNames.update((id(proxy), "replica{0}".format(ix)) for ix, proxy in enumerate(asyncReplicaProxies))
+
+	async def get(self, key):
+		if not self.cache:
+			return await self.__get(key)
+		hit, result = self.cache.lookup(key)
+		if hit:
+			return result
+		value = await self.__get(key)
+		self.cache.fill(key, value, result)
+		return value
+
+	async def __get(self, key):
+		group = self.sharding.readOwner(key)
+		return await self.routers[group].readAsync(self.asyncGroupProxies[group], lambda replica: replica.get(key))
+
+	async def getMany(self, keys):
+		values, tokens = self._Master__lookupMany(keys)
+		chunks = self._Master__splitKeys(list(tokens))
+		results = await asyncio.gather(*[self.routers[group].readAsync(self.asyncGroupProxies[group], lambda replica, chunk=chunk: replica.getMany(chunk)) for group, chunk in chunks])
+		for fetched in results:
+			self._Master__fillMany(values, fetched, tokens)
+		return values
+
+	async def put(self, key, value):
+		async with self.__write([key]):
+			return await self.__2phaseCommit(lambda replica, tid: replica.put(key,value,tid), "put {0} {1}".format(key, value), key,
+				lambda replica, tid: replica.prepare(tid, "put", key, value), [["put", key, value]])
+
+	async def delete(self, key):
+		async with self.__write([key]):
+			return await self.__2phaseCommit(lambda replica, tid: replica.delete(key, tid), "delete {0}".format(key), key,
+				lambda replica, tid: replica.prepare(tid, "delete", key), [["delete", key]])
+
+	async def multi(self, ops):
+		ops = master.Master._Master__checkBatch(ops)
+		if not ops:
+			return True
+		async with self.__write(recovery.RecoveryHelper.batchKeys(ops)):
+			groupOps = self.sharding.splitOps(ops)
+			return await self.__2phaseCommit(lambda replica, tid: replica.multi(groupOps[self.proxyGroups[id(replica)]], tid), recovery.RecoveryHelper.createBatchOperationString(ops), recovery.RecoveryHelper.batchKeys(ops),
+				lambda replica, tid: replica.prepare(tid, "multi", groupOps[self.proxyGroups[id(replica)]]), ops, sorted(groupOps))
+
+	# Sharding.write for the event loop: a write held back by a rebalance copy polls instead of blocking the loop
+	@contextlib.asynccontextmanager
+	async def __write(self, keys):
+		entered = self.sharding.tryEnter(keys)
+		while entered is None:
+			await asyncio.sleep(AsyncMaster.MOVE_POLL)
+			entered = self.sharding.tryEnter(keys)
+		try:
+			yield
+		finally:
+			if entered:
+				self.sharding.exit(keys)
+
+	@metrics.timed("transaction")
+	async def __2phaseCommit(self, func, funcName, key, prepareFunc=None, ops=None, groups=None):
+		prepare = self.prepareMode and prepareFunc
+		transaction = await self.__createTransaction(prepareFunc if prepare else func, funcName, key, ops, groups)
+		if ops and len(transaction.participants) == 1:
+			return await self.__executeAndCommit(transaction)
+		if prepare:
+			allYes = await self.__prepare(transaction)
+		else:
+			await self.__executeOperation(transaction)
+			allYes = await self.__requestVotes(transaction)
+		if allYes:
+			await self.__commit(transaction)
+		else:
+			await self.__abort(transaction)
+
+		return allYes
+
+	@metrics.timed("phase.execute")
+	async def __executeOperation(self, transaction):
+		if self.cache:
+			self.cache.invalidate(transaction)
+		print("Start sending {0} operation".format(transaction.operationString))
+		results = await self.__broadcast(transaction, "operate", lambda replica: transaction.action(replica, transaction.tid), True)
+		success = False
+		for result in results:
+			if isinstance(result, Exception):
+				print("Error sending operation to one of the replicas")
+				print("Exception: {0}".format(result))
+			else:
+				success = True
+		return success
+
+	@metrics.timed("phase.votes")
+	async def __requestVotes(self, transaction):
+		transaction.state = "master-start-2pc"
+		if not self.presumedAbort:
+			await self.__log(transaction)
+
+		print("Sending votereqs")
+		votes = [asyncio.ensure_future(self.__vote(replica, transaction)) for replica in self._Master__proxies(transaction, self.asyncReplicaProxies)]
+		readOnly = []
+		for vote in asyncio.as_completed(votes):
+			replica, yes = await vote
+			if not yes:
+				for pending in votes:
+					pending.cancel()
+				return False
+			if yes == transactions.READ_ONLY:
+				readOnly.append(replica)
+		self._Master__dropReadOnly(transaction, readOnly, self.asyncReplicaProxies)
+		return True
+
+	async def __vote(self, replica, transaction):
+		try:
+			return replica, await self.__observed("voteReq", lambda replica: replica.voteReq(transaction.tid), replica, transaction, metrics.VOTE_NO)
+		except Exception as e:
+			print("Error sending voteReq to one of the replicas")
+			print("Exception: {0}".format(e))
+			return replica, False
+
+	@metrics.timed("phase.prepare")
+	async def __prepare(self, transaction):
+		transaction.state = "master-start-2pc"
+		if not self.presumedAbort:
+			await self.__log(transaction)
+
+		if self.cache:
+			self.cache.invalidate(transaction)
+		print("Sending prepare {0}".format(transaction.operationString))
+		# waits for every replica for the same reason as Master.__prepare
+		proxies = self._Master__proxies(transaction, self.asyncReplicaProxies)
+		votes = await self.__broadcast(transaction, "prepare", lambda replica: transaction.action(replica, transaction.tid), True)
+		allYes = True
+		for vote in votes:
+			if isinstance(vote, Exception):
+				print("Error sending prepare to one of the replicas")
+				print("Exception: {0}".format(vote))
+			allYes = allYes and not isinstance(vote, Exception) and vote
+		if allYes:
+			self._Master__dropReadOnly(transaction, [replica for replica, vote in zip(proxies, votes) if vote == transactions.READ_ONLY], self.asyncReplicaProxies)
+		return bool(allYes)
+
+	# Same as Master.__executeAndCommit
+	@metrics.timed("phase.onePhase")
+	async def __executeAndCommit(self, transaction):
+		if self.cache:
+			self.cache.invalidate(transaction)
+		print("Sending execute-and-commit {0}".format(transaction.operationString))
+		try:
+			committed = await self.__observed("executeAndCommit", lambda replica: replica.executeAndCommit(transaction.tid, transaction.operations),
+				self._Master__proxies(transaction, self.asyncReplicaProxies)[0], transaction)
+		except Exception as e:
+			print("Error sending execute-and-commit to the replica")
+			print("Exception: {0}".format(e))
+			committed = None
+		self._Master__finishOnePhase(transaction, committed)
+		return bool(committed)
+
+	@metrics.timed("phase.commit")
+	async def __commit(self, transaction):
+		transaction.state = "master-commit"
+		self._Master__count(transaction)
+		# same as Master.__commit: no record when every participant voted read-only (presumed abort only)
+		if self._Master__proxies(transaction) or not self.presumedAbort:
+			await self.__log(transaction)
+		print("Sending {0} to replicas".format(transaction.state))
+		acked = True
+		for result in await self.__broadcast(transaction, "commit", lambda replica: replica.commit(transaction.tid)):
+			if isinstance(result, Exception):
+				print("Error sending final commit decision to one of the replicas")
+				print("Exception: {0}".format(result))
+				acked = False
+		if self.cache:
+			self.cache.commit(transaction)
+		self.transactions.finish(transaction.tid, acked)
+
+	@metrics.timed("phase.abort")
+	async def __abort(self, transaction):
+		transaction.state = "master-abort"
+		self._Master__count(transaction)
+		if self.presumedAbort:
+			# same as Master.__abort: nothing logged and the acks aren't awaited
+			print("Sending {0} to replicas without waiting for acks".format(transaction.state))
+			asyncio.ensure_future(self.__broadcast(transaction, "abort", lambda replica: replica.abort(transaction.tid)))
+			if self.cache:
+				self.cache.abort(transaction)
+			self.transactions.discard(transaction.tid)
+			return
+		await self.__log(transaction)
+		print("Sending {0} to replicas".format(transaction.state))
+		acked = True
+		for result in await self.__broadcast(transaction, "abort", lambda replica: replica.abort(transaction.tid)):
+			if isinstance(result, Exception):
+				print("Error sending final abort decision to one of the replicas")
+				print("Exception: {0}".format(result))
+				acked = False
+		if self.cache:
+			self.cache.abort(transaction)
+		self.transactions.finish(transaction.tid, acked)
+
+	# undecided tells whether the answers can still abort the transaction (see Master.__observed)
+	async def __broadcast(self, transaction, phase, func, undecided=False):
+		return await asyncio.gather(*[self.__observed(phase, func, replica, transaction if undecided else None) for replica in self._Master__proxies(transaction, self.asyncReplicaProxies)], return_exceptions=True)
+
+	# Awaits func(replica), the call of a phase to a replica, the way Master.__observed runs it
+	async def __observed(self, phase, func, replica, transaction=None, negative=metrics.LOCK_BUSY):
+		start = time.monotonic()
+		try:
+			result = await func(replica)
+		except Exception as e:
+			self._Master__noteAbort(transaction, metrics.abortReason(e))
+			raise
+		finally:
+			self._Master__recordCall(phase, replica, start)
+		if not result:
+			self._Master__noteAbort(transaction, negative)
+		return result
+
+	# Master.__createTransaction, waiting for a tid reservation without blocking the loop
+	@metrics.timed("phase.create")
+	async def __createTransaction(self, func, funcName, key, ops, groups):
+		tid, reservation = self._Master__nextTid()
+		if reservation:
+			await asyncio.wrap_future(reservation)
+		return self._Master__startTransaction(tid, func, funcName, key, ops, groups)
+
+	# Waits for the group commit of the record without holding a thread
+	@metrics.timed("phase.log")
+	async def __log(self, transaction):
+		await asyncio.wrap_future(self.logFile.submit(recovery.RecoveryHelper.encodeTransaction(transaction)))
@@ -0,0 +1,189 @@
+import asyncio
+import concurrent.futures
+import inspect
+import itertools
+import json
+import xmlrpc.client
+import proxypool
+import transport
+
+# asyncio counterparts of the servers and proxies in transport.py, used by the asyncio master.
+# Methods of the served instance that are coroutines run on the event loop; plain methods run on
+# a thread pool so that a blocking call can't stall the loop
+
+class AsyncRPCServer:
+
+	DEFAULT_WORKERS = 32
+
+	def __init__(self, instance, workers=DEFAULT_WORKERS):
+		self.instance = instance
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="async-rpc")
+		self.listeners = []
+
+	# Serves clients with XML-RPC over HTTP/1.1 (keep-alive) on address
+	def listenXMLRPC(self, address, reusePort=False):
+		self.listeners.append((self.__serveXMLRPC, address, reusePort))
+
+	# Serves clients with the binary protocol of transport.py on address
+	def listenBinary(self, address, reusePort=False):
+		self.listeners.append((self.__serveBinary, address, reusePort))
+
+	def serve_forever(self):
+		asyncio.run(self.__serve())
+
+	async def __serve(self):
+		servers = []
+		for handler, address, reusePort in self.listeners:
+			servers.append(await asyncio.start_server(handler, address[0], address[1], backlog=1024, reuse_port=reusePort or None))
+		await asyncio.gather(*[server.serve_forever() for server in servers])
+
+	async def dispatch(self, method, params):
+		if method.startswith("_"):
+			raise AttributeError("method {0} is not supported".format(method))
+		func = getattr(self.instance, method)
+		if inspect.iscoroutinefunction(func):
+			return await func(*params)
+		result = await asyncio.get_running_loop().run_in_executor(self.executor, lambda: func(*params))
+		if inspect.isawaitable(result):
+			result = await result
+		return result
+
+	async def __serveXMLRPC(self, reader, writer):
+		try:
+			while True:
+				requestLine = await reader.readline()
+				if not requestLine:
+					break
+				headers = dict()
+				while True:
+					line = await reader.readline()
+					if line in (b"\r\n", b"\n", b""):
+						break
+					name, sep, value = line.decode("latin-1").partition(":")
+					headers[name.strip().lower()] = value.strip()
+				body = await reader.readexactly(int(headers.get("content-length", 0)))
+				keepAlive = requestLine.rstrip().endswith(b"HTTP/1.1") and headers.get("connection", "").lower() != "close"
+
+				try:
+					params, method = xmlrpc.client.loads(body)
+					result = await self.dispatch(method, params)
+					response = xmlrpc.client.dumps((result,), methodresponse=True, allow_none=True)
+				except Exception as e:
+					response = xmlrpc.client.dumps(xmlrpc.client.Fault(1, "{0}:{1}".format(type(e), e)), allow_none=True)
+
+				data = response.encode("utf-8")
+				writer.write(("HTTP/1.1 200 OK\r\nContent-Type: text/xml\r\nContent-Length: {0}\r\n{1}\r\n"
+					.format(len(data), "" if keepAlive else "Connection: close\r\n")).encode("latin-1") + data)
+				await writer.drain()
+				if not keepAlive:
+					break
+		except (ConnectionError, asyncio.IncompleteReadError) as e:
+			print("Connection closed: {0}".format(e))
+		finally:
+			writer.close()
+
+	async def __serveBinary(self, reader, writer):
+		try:
+			while True:
+				requestId, kind, payload = await readFrame(reader)
+				asyncio.ensure_future(self.__handleBinary(writer, requestId, payload))
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		finally:
+			writer.close()
+
+	async def __handleBinary(self, writer, requestId, payload):
+		try:
+			method, params = payload
+			result = await self.dispatch(method, params)
+			response = transport.encode(transport.RESPONSE, requestId, result)
+		except Exception as e:
+			response = transport.encode(transport.ERROR, requestId, "{0}: {1}".format(type(e).__name__, e))
+		writer.write(response)
+
+async def readFrame(reader):
+	header = await reader.readexactly(transport.HEADER.size)
+	length, requestId, kind = transport.HEADER.unpack(header)
+	data = await reader.readexactly(length)
+	return requestId, kind, json.loads(data.decode("utf-8"))
+
+# asyncio client of the binary protocol: one pipelined connection per peer, calls return awaitables
+class AsyncBinaryRPCProxy:
+
+	def __init__(self, host, port):
+		self.address = (host, port)
+		self.ids = itertools.count(1)
+		self.writer = None
+		self.connecting = None
+		self.pending = dict()
+
+	def __getattr__(self, name):
+		if name.startswith("__"):
+			raise AttributeError(name)
+		return lambda *args: self.call(name, *args)
+
+	async def call(self, method, *args):
+		writer = await self.__connect()
+		requestId = next(self.ids) & 0xFFFFFFFF
+		future = asyncio.get_running_loop().create_future()
+		self.pending[requestId] = future
+		writer.write(transport.encode(transport.REQUEST, requestId, [method, list(args)]))
+		return await future
+
+	async def __connect(self):
+		if self.writer is None:
+			if self.connecting is None:
+				self.connecting = asyncio.ensure_future(self.__open())
+			try:
+				await self.connecting
+			finally:
+				self.connecting = None
+		return self.writer
+
+	async def __open(self):
+		reader, writer = await asyncio.open_connection(self.address[0], self.address[1])
+		self.writer = writer
+		asyncio.ensure_future(self.__readLoop(reader, writer))
+
+	async def __readLoop(self, reader, writer):
+		try:
+			while True:
+				requestId, kind, payload = await readFrame(reader)
+				future = self.pending.pop(requestId, None)
+				if future is None or future.done():
+					continue
+				if kind == transport.ERROR:
+					future.set_exception(transport.RemoteError(payload))
+				else:
+					future.set_result(payload)
+		except (ConnectionError, asyncio.IncompleteReadError, OSError):
+			pass
+		if self.writer is writer:
+			self.writer = None
+		writer.close()
+		pending = self.pending
+		self.pending = dict()
+		for future in pending.values():
+			if not future.done():
+				future.set_exception(ConnectionError("Connection to {0} lost".format(self.address)))
+
+# Makes a blocking proxy (e.g. a proxypool.ProxyPool) usable from the event loop by running its calls on a thread pool
+class AsyncProxyAdapter:
+
+	CONTROL_WORKERS = 8
+
+	def __init__(self, proxy, executor):
+		self.proxy = proxy
+		self.executors = proxypool.CallExecutors(None, "async", executor, AsyncProxyAdapter.CONTROL_WORKERS)
+
+	def __getattr__(self, name):
+		if name.startswith("__"):
+			raise AttributeError(name)
+		method = getattr(self.proxy, name)
+		executor = self.executors.executorFor(name)
+		return lambda *args: asyncio.get_running_loop().run_in_executor(executor, lambda: method(*args))
+
+def createProxy(kind, port, executor, poolSize):
+	if kind == transport.BINARY:
+		return AsyncBinaryRPCProxy("localhost", int(port))
+	return AsyncProxyAdapter(transport.createProxy(kind, port, poolSize), executor)
@@ -3,7 +3,14 @@ import subprocess
 import xmlrpc.client
 import os
 import time
+import shelve
+import keyvaluestore
+import logformat
+import logstore
+import readcache
+import sharding
 import testingbase
+from transactions import Transaction
 
 class BasicTests(testingbase.TestingBase):
 	def setUp(self):
@@ -30,6 +37,43 @@ class BasicTests(testingbase.TestingBase):
 		self.masterProxy.delete(key)
 		self.assertEqual(None, self.masterProxy.get(key))
 
+	def test_multiPutAndGet(self):
+		items = {"key1": "value1", "key2": "value2", "key3": "value3"}
+		self.assertTrue(self.masterProxy.multiPut(items))
+		for key in items:
+			self.assertEqual(items[key], self.masterProxy.get(key))
+
+	def test_multiMixesPutsAndDeletes(self):
+		self.masterProxy.put("key1", "value1")
+		success = self.masterProxy.multi([["delete", "key1"], ["put", "key2", "value2"]])
+		self.assertTrue(success)
+		self.assertEqual(None, self.masterProxy.get("key1"))
+		self.assertEqual("value2", self.masterProxy.get("key2"))
+
+	def test_getManyReturnsAllKeys(self):
+		items = dict(("key" + str(i), "value" + str(i)) for i in range(100))
+		self.masterProxy.multiPut(items)
+		values = self.masterProxy.getMany(list(items) + ["missingKey"])
+		self.assertEqual(101, len(values))
+		self.assertEqual(None, values["missingKey"])
+		for key in items:
+			self.assertEqual(items[key], values[key])
+
+	# put a batch, then kill replicas and their dbs, restart replicas, and then get
+	def test_basicReplicaRecoveryWithMulti(self):
+		items = {"key1": "value1", "key2": "value2"}
+		self.masterProxy.multiPut(items)
+
+		self._killReplica1()
+		self._killReplica2()
+		self._removeDb(self.replica1DbName)
+		self._removeDb(self.replica2DbName)
+		self._startReplica1()
+		self._startReplica2()
+
+		for key in items:
+			self.assertEqual(items[key], self.masterProxy.get(key))
+
 	# put, then kill and restart replicas, and then get
 	def test_replicaStoresArePersistent(self):
 		key = "somekey"
@@ -58,6 +102,23 @@ class BasicTests(testingbase.TestingBase):
 
 		self.assertEqual(value, self.masterProxy.get(key))
 
+	# put values that aren't strings, then kill replicas and their dbs, restart replicas (which replay
+	# their logs), and then get
+	def test_replicaRecoveryKeepsValueTypes(self):
+		masterProxy = xmlrpc.client.ServerProxy("http://localhost:8000", allow_none=True)
+		masterProxy.put("intkey", 5)
+		masterProxy.put("nonekey", None)
+
+		self._killReplica1()
+		self._killReplica2()
+		self._removeDb(self.replica1DbName)
+		self._removeDb(self.replica2DbName)
+		self._startReplica1()
+		self._startReplica2()
+
+		self.assertEqual(5, masterProxy.get("intkey"))
+		self.assertEqual(None, masterProxy.get("nonekey"))
+
 	# put, then delete then kill replicas and their dbs, restart replicas, and then get
 	def test_basicReplicaRecoveryWithDelete(self):
 		key = "somekey"
@@ -122,7 +183,241 @@ class BasicTests(testingbase.TestingBase):
 		with self.assertRaises(Exception):
 			self.masterProxy.get(key)
 
+	def test_withOneReplica_WritesCommitInOnePhase(self):
+		self._restartWith(replicaPorts=[self.replica1Port])
+		key = "somekey"
+		value = "somevalue"
+
+		self.assertTrue(self.masterProxy.put(key, value))
+		self.assertEqual(value, self.masterProxy.get(key))
+		self.assertTrue(self.masterProxy.delete("missingKey"))
+
+		# no votes: the master only logs tid reservations and the replica only its decisions
+		self.assertEqual({"master-reserve"}, set(self._logStates(self.masterLogFile)))
+		self.assertEqual(["replica-commit", "replica-read-only"], self._logStates(self.replica1LogFile))
+
+	def test_deleteOfMissingKey_ReplicasVoteReadOnly(self):
+		self.assertTrue(self.masterProxy.delete("missingKey"))
+
+		self.assertIn("replica-read-only", self._logStates(self.replica1LogFile))
+		self.assertIn("replica-read-only", self._logStates(self.replica2LogFile))
+		self.assertNotIn("replica-commit", self._logStates(self.replica1LogFile) + self._logStates(self.replica2LogFile))
+
+	def test_addingAGroup_MovesItsKeysAndKeepsEveryKeyReadable(self):
+		self._restartWith(replicaPorts=[self.replica1Port])
+		items = dict(("key{0}".format(i), "value{0}".format(i)) for i in range(100))
+		self.assertTrue(self.masterProxy.multiPut(items))
+
+		self._killMaster()
+		self.replicaPorts = [self.replica1Port, self.replica2Port]
+		self.masterFlags = "--groups=2"
+		self._startMaster()
+		ring = sharding.HashRing(2)
+		moved = set(key for key in items if ring.owner(key) == 1)
+		self.assertTrue(moved and len(moved) < len(items))
+		# the old copies are deleted once the moved keys are in the new group
+		for i in range(30):
+			if not moved & set(self.replica1Proxy.keys("", 1000)):
+				break
+			time.sleep(1)
+
+		self.assertEqual(set(items) - moved, set(self.replica1Proxy.keys("", 1000)))
+		self.assertEqual(moved, set(self.replica2Proxy.keys("", 1000)))
+		self.assertEqual(items, self.masterProxy.getMany(list(items)))
+		for key in items:
+			self.assertEqual(items[key], self.masterProxy.get(key))
 
 	def tearDown(self):
 		self._cleanup()
 
+
+# Binary log records, without a cluster
+class LogFormatTests(unittest.TestCase):
+	def setUp(self):
+		self.logFile = "test-logformat-log.bin"
+		self.textLogFile = "test-logformat-log.txt"
+		self._removeFiles()
+
+	def test_scanReturnsEncodedRecordsWithTheirTypes(self):
+		self._write([logformat.encode(1, "replica-commit", [["put", "key 1", 5], ["put", "key2", None], ["delete", "key3"]]),
+			logformat.encode(2, "master-commit", None)])
+		self.assertEqual([(1, "replica-commit", [["put", "key 1", 5], ["put", "key2", None], ["delete", "key3"]]), (2, "master-commit", None)], self._scan())
+
+	def test_tornTailIsTruncated(self):
+		first = logformat.encode(1, "replica-yes", [["put", "key1", "value1"]])
+		second = logformat.encode(1, "replica-commit", [["put", "key1", "value1"]])
+		self._write([first, second[:len(second) - 3]])
+		self.assertEqual([(1, "replica-yes", [["put", "key1", "value1"]])], self._scan())
+		self.assertEqual(len(first), os.path.getsize(self.logFile))
+
+	def test_recordWithCrcMismatchIsTruncatedWithTheRecordsAfterIt(self):
+		first = logformat.encode(1, "master-commit", None)
+		second = bytearray(logformat.encode(2, "replica-commit", [["put", "key1", "value1"]]))
+		second[-1] ^= 0xFF
+		self._write([first, bytes(second), logformat.encode(3, "master-commit", None)])
+		self.assertEqual([(1, "master-commit", None)], self._scan())
+		self.assertEqual(len(first), os.path.getsize(self.logFile))
+
+	def test_convertlogConvertsATextLog(self):
+		with open(self.textLogFile, "w") as f:
+			f.write("1 replica-yes put key1 5\n")
+			f.write("1 replica-commit put key1 5\n")
+			f.write("not a record\n")
+			f.write("2 replica-commit multi put key2 value2 delete key1\n")
+		subprocess.call("convertlog.py {0} {1}".format(self.textLogFile, self.logFile), shell=True)
+		# the values of a text log stay strings
+		self.assertEqual([(1, "replica-yes", [["put", "key1", "5"]]), (1, "replica-commit", [["put", "key1", "5"]]),
+			(2, "replica-commit", [["put", "key2", "value2"], ["delete", "key1"]])], self._scan())
+
+	def _write(self, records):
+		with open(self.logFile, "wb") as f:
+			f.write(b"".join(records))
+
+	def _scan(self):
+		records = []
+		logformat.scanFile(self.logFile, lambda tid, state, ops: records.append((tid, state, ops)))
+		return records
+
+	def _removeFiles(self):
+		for fileName in (self.logFile, self.textLogFile):
+			if os.path.isfile(fileName):
+				os.remove(fileName)
+
+	def tearDown(self):
+		self._removeFiles()
+
+# Storage engines of the replicas, without a cluster
+class LogStoreTests(unittest.TestCase):
+	def setUp(self):
+		self.dbName = "test-logstore-db"
+		self._removeDb()
+
+	def test_compactionKeepsTheLiveValuesAndRemovesTheOldFiles(self):
+		store = logstore.LogStore(self.dbName, maxFileSize=256)
+		for i in range(50):
+			store.put("key{0}".format(i), "value{0}".format(i))
+		for i in range(0, 50, 2):
+			store.put("key{0}".format(i), i)
+		for i in range(0, 50, 5):
+			store.delete("key{0}".format(i))
+		oldIds = logstore.listDataFiles(self.dbName)
+		self.assertTrue(len(oldIds) > 2)
+
+		store.compact()
+		fileIds = logstore.listDataFiles(self.dbName)
+		self.assertFalse(set(oldIds) & set(fileIds))
+		self.assertTrue(os.path.isfile(logstore.hintFileName(self.dbName, fileIds[0])))
+		for i in range(50):
+			self.assertEqual(self._expected(i), store.get("key{0}".format(i)))
+		store.close()
+
+	def test_storeReloadsACompactedFileFromItsHint(self):
+		store = logstore.LogStore(self.dbName, maxFileSize=256)
+		for i in range(50):
+			store.put("key{0}".format(i), i)
+		store.compact()
+		store.close()
+		mergedId = logstore.listDataFiles(self.dbName)[0]
+		mergedSize = os.path.getsize(logstore.dataFileName(self.dbName, mergedId))
+
+		store = logstore.LogStore(self.dbName, maxFileSize=256)
+		for i in range(50):
+			self.assertEqual(i, store.get("key{0}".format(i)))
+		# writes after the reload go to a new file
+		store.put("key0", "newvalue")
+		self.assertEqual(mergedSize, os.path.getsize(logstore.dataFileName(self.dbName, mergedId)))
+		self.assertEqual("newvalue", store.get("key0"))
+		store.close()
+
+	def test_shelveDatabaseIsMigratedOnce(self):
+		with shelve.open(self.dbName) as data:
+			data["key1"] = "value1"
+			data["key2"] = 2
+		store = keyvaluestore.createStore(keyvaluestore.LOG, self.dbName)
+		self.assertEqual("value1", store.get("key1"))
+		self.assertEqual(2, store.get("key2"))
+		self.assertTrue(os.path.isfile(self.dbName + ".migrated"))
+		store.delete("key1")
+		store.close()
+
+		# the shelve files are left in place, but aren't copied again
+		with shelve.open(self.dbName) as data:
+			data["key3"] = "value3"
+		store = keyvaluestore.createStore(keyvaluestore.LOG, self.dbName)
+		self.assertEqual(None, store.get("key1"))
+		self.assertEqual(None, store.get("key3"))
+		self.assertEqual(2, store.get("key2"))
+		store.close()
+
+	def _expected(self, i):
+		if i % 5 == 0:
+			return None
+		if i % 2 == 0:
+			return i
+		return "value{0}".format(i)
+
+	def _removeDb(self):
+		logstore.removeFiles(self.dbName)
+		for suffix in ("", ".dat", ".bak", ".dir", ".db", ".migrated"):
+			if os.path.isfile(self.dbName + suffix):
+				os.remove(self.dbName + suffix)
+
+	def tearDown(self):
+		self._removeDb()
+
+# Read cache of the master, without a cluster
+class ReadCacheTests(unittest.TestCase):
+	def setUp(self):
+		self.cache = readcache.ReadCache(1024 * 1024)
+
+	def test_fillAfterAMissIsAHit(self):
+		hit, token = self.cache.lookup("key1")
+		self.assertFalse(hit)
+		self.cache.fill("key1", "value1", token)
+		self.assertEqual((True, "value1"), self.cache.lookup("key1"))
+
+	def test_fillStartedBeforeAnInvalidationIsDropped(self):
+		hit, token = self.cache.lookup("key1")
+		transaction = self._put(1, "key1", "value2")
+		self.cache.invalidate(transaction)
+		self.cache.abort(transaction)
+		# the read may have seen the value from before the write
+		self.cache.fill("key1", "value1", token)
+		self.assertFalse(self.cache.lookup("key1")[0])
+
+	def test_fillWhileAWriteIsPendingIsDropped(self):
+		transaction = self._put(1, "key1", "value2")
+		self.cache.invalidate(transaction)
+		hit, token = self.cache.lookup("key1")
+		self.cache.fill("key1", "value1", token)
+		self.assertFalse(self.cache.lookup("key1")[0])
+		self.cache.commit(transaction)
+		self.assertEqual((True, "value2"), self.cache.lookup("key1"))
+
+	def test_newerTidWinsWhenCommitsComeInOrder(self):
+		older = self._put(1, "key1", "value1")
+		newer = self._put(2, "key1", "value2")
+		self.cache.invalidate(older)
+		self.cache.invalidate(newer)
+		self.cache.commit(older)
+		self.cache.commit(newer)
+		self.assertEqual((True, "value2"), self.cache.lookup("key1"))
+
+	def test_newerTidWinsWhenCommitsComeOutOfOrder(self):
+		older = self._put(1, "key1", "value1")
+		newer = self._put(2, "key1", "value2")
+		self.cache.invalidate(older)
+		self.cache.invalidate(newer)
+		self.cache.commit(newer)
+		self.cache.commit(older)
+		self.assertNotEqual((True, "value1"), self.cache.lookup("key1"))
+
+	def test_newerTidWinsOverACachedValue(self):
+		newer = self._put(2, "key1", "value2")
+		self.cache.invalidate(newer)
+		self.cache.commit(newer)
+		self.cache.commit(self._put(1, "key1", "value1"))
+		self.assertEqual((True, "value2"), self.cache.lookup("key1"))
+
+	def _put(self, tid, key, value):
+		return Transaction(tid, "master-start", "put {0} {1}".format(key, value), None, key, [["put", key, value]])
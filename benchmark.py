@@ -0,0 +1,63 @@
+import options
+import sys
+import threading
+import time
+import transport
+
+# Load generator used to compare the master engines: start the master with
+# --engine=threaded or --engine=asyncio, then run for example
+#   benchmark.py --clients=200 --seconds=10
+# With --binary-port=N the clients talk to the master's binary listener instead of XML-RPC on 8000
+
+argv, flags = options.parse(sys.argv)
+clients = options.getInt(flags, "clients", 50)
+seconds = options.getFloat(flags, "seconds", 10)
+keys = options.getInt(flags, "keys", 100000)
+binaryPort = options.getInt(flags, "binary-port", None)
+
+if binaryPort:
+	# a binary proxy pipelines all the client threads over a single connection
+	sharedProxy = transport.createProxy(transport.BINARY, binaryPort)
+	createClient = lambda: sharedProxy
+else:
+	createClient = lambda: transport.createProxy(transport.XMLRPC, 8000, 1)
+
+latencies = []
+failures = [0]
+lock = threading.Lock()
+deadline = time.monotonic() + seconds
+
+def runClient(clientId):
+	proxy = createClient()
+	i = 0
+	myLatencies = []
+	myFailures = 0
+	while time.monotonic() < deadline:
+		key = "bench{0}".format((clientId * 7919 + i) % keys)
+		start = time.monotonic()
+		try:
+			if not proxy.put(key, "value{0}".format(i)):
+				myFailures += 1
+		except Exception as e:
+			myFailures += 1
+		myLatencies.append(time.monotonic() - start)
+		i += 1
+	with lock:
+		latencies.extend(myLatencies)
+		failures[0] += myFailures
+
+threads = [threading.Thread(target=runClient, args=[i]) for i in range(clients)]
+for thread in threads:
+	thread.start()
+for thread in threads:
+	thread.join()
+
+latencies.sort()
+count = len(latencies)
+if count == 0:
+	print("No requests completed")
+	exit()
+
+percentile = lambda p: latencies[min(count - 1, int(count * p))] * 1000
+print("clients: {0}, puts: {1} ({2} failed), throughput: {3:.1f} puts/s".format(clients, count, failures[0], count / seconds))
+print("latency ms: p50 {0:.2f}, p95 {1:.2f}, p99 {2:.2f}, max {3:.2f}".format(percentile(0.5), percentile(0.95), percentile(0.99), latencies[-1] * 1000))
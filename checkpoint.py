@@ -0,0 +1,150 @@
+import glob
+import json
+import os
+import threading
+import logformat
+import recovery
+
+# Checkpointing for the master and replica logs. A log named base is split into segments
+# (base.00000001, base.00000002, ...). A checkpoint (base.checkpoint) holds a snapshot of the
+# transactions that still matter, written as binary log records (see logformat), plus the first segment that has to be
+# replayed after it. Recovery therefore reads the checkpoint and the tail of the log only, and
+# segments older than the checkpoint are deleted once the checkpoint is durable
+
+def segmentName(base, seq):
+	return "{0}.{1:08d}".format(base, seq)
+
+def checkpointName(base):
+	return base + ".checkpoint"
+
+def listSegments(base):
+	seqs = []
+	for fileName in glob.glob(glob.escape(base) + ".*"):
+		suffix = fileName[len(base) + 1:]
+		if len(suffix) == 8 and suffix.isdigit():
+			seqs.append(int(suffix))
+	return sorted(seqs)
+
+# Returns (checkpoint data, offset of its records) or (None, 0) if there is no usable checkpoint.
+# The checkpoint is a JSON line followed by binary log records (checkpoints written before the
+# binary format keep their records as text lines inside the JSON)
+def readCheckpoint(base):
+	try:
+		with open(checkpointName(base), "rb") as f:
+			data = json.loads(f.readline().decode("utf-8"))
+			return data, f.tell()
+	except (IOError, ValueError) as e:
+		print("No usable checkpoint for {0}: {1}".format(base, e))
+		return None, 0
+
+# Writes the checkpoint to a temporary file, fsyncs it and renames it over the previous one,
+# so a crash leaves either the old or the new checkpoint in place
+def writeCheckpoint(base, data):
+	tmpName = checkpointName(base) + ".tmp"
+	meta = dict((key, value) for key, value in data.items() if key != "records")
+	with open(tmpName, "wb") as f:
+		f.write(json.dumps(meta).encode("utf-8") + b"\n")
+		f.write(b"".join(data["records"]))
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tmpName, checkpointName(base))
+
+# Returns (checkpoint data or None, transaction objs to replay, next free segment number).
+# The transactions come from the records of the checkpoint followed by the segments written
+# after it, decoded by recovery.RecoveryHelper.createTransaction. A log left by a version without
+# segments (a plain text file named base) is replayed first, and so are the text segments of a
+# checkpoint taken before the binary format
+def recoveryRecords(base):
+	data, offset = readCheckpoint(base)
+	seqs = listSegments(base)
+	records = []
+	firstSeq = 0
+	textSegments = False
+
+	def visit(tid, state, ops):
+		transaction = recovery.RecoveryHelper.createTransaction(tid, state, ops)
+		if transaction:
+			records.append(transaction)
+
+	if data and "records" in data:
+		textSegments = True
+		records.extend(parseTextRecords(data["records"]))
+		firstSeq = data["segment"]
+	elif data:
+		logformat.scanFile(checkpointName(base), visit, offset)
+		firstSeq = data["segment"]
+	elif os.path.isfile(base):
+		with open(base, "r") as f:
+			records.extend(parseTextRecords(f))
+
+	for seq in seqs:
+		if seq >= firstSeq:
+			if textSegments:
+				with open(segmentName(base, seq), "r") as f:
+					records.extend(parseTextRecords(f))
+			else:
+				logformat.scanFile(segmentName(base, seq), visit)
+
+	nextSeq = max(seqs + [firstSeq]) + 1
+	return data, records, nextSeq
+
+# Transaction objs decoded from text log lines
+def parseTextRecords(lines):
+	for line in lines:
+		transaction = recovery.RecoveryHelper.parseTransactionLog(line)
+		if transaction:
+			yield transaction
+
+# Removes every file that makes up the log named base
+def removeLog(base):
+	for fileName in [base, checkpointName(base)] + [segmentName(base, seq) for seq in listSegments(base)]:
+		if os.path.isfile(fileName):
+			os.remove(fileName)
+
+# Takes checkpoints of a node periodically, or as soon as the current segment grows past
+# segmentSize. snapshot() must return a dict with a "records" list of encoded log records describing the
+# transactions that are still needed after the older segments are dropped (it can add other keys)
+class Checkpointer:
+
+	DEFAULT_INTERVAL = 60
+	DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+	def __init__(self, base, log, nextSeq, snapshot, interval=DEFAULT_INTERVAL, segmentSize=DEFAULT_SEGMENT_SIZE):
+		self.base = base
+		self.log = log
+		self.nextSeq = nextSeq
+		self.snapshot = snapshot
+		self.interval = interval
+		self.lock = threading.Lock()
+		self.wakeup = threading.Event()
+		log.setMaxSize(segmentSize, self.wakeup.set)
+		self.thread = threading.Thread(target=self.__run, name="checkpointer", daemon=True)
+		self.thread.start()
+
+	def checkpoint(self):
+		with self.lock:
+			seq = self.nextSeq
+			self.nextSeq += 1
+			# everything durable in the older segments is reflected in the snapshot taken after the rotation
+			self.log.rotate(segmentName(self.base, seq))
+			data = self.snapshot()
+			data["segment"] = seq
+			writeCheckpoint(self.base, data)
+
+			# only now is it safe to drop what the checkpoint replaces
+			for old in listSegments(self.base):
+				if old < seq:
+					os.remove(segmentName(self.base, old))
+			if os.path.isfile(self.base):
+				os.remove(self.base)
+			print("Checkpoint taken at segment {0} with {1} records".format(seq, len(data["records"])))
+
+	def __run(self):
+		while True:
+			self.wakeup.wait(self.interval)
+			self.wakeup.clear()
+			try:
+				self.checkpoint()
+			except Exception as e:
+				print("Error taking checkpoint of {0}".format(self.base))
+				print("Exception: {0}".format(e))
@@ -0,0 +1,53 @@
+import checkpoint
+import logformat
+import options
+import os
+import recovery
+import sys
+
+# Converts a text log written before the binary format into a binary log segment, or with
+# --dump prints the records of a binary log (segment or checkpoint) as text lines
+
+argv, flags = options.parse(sys.argv)
+
+if len(argv) < 2:
+	print("convertlog textLogFileName [binaryLogFileName]")
+	print("convertlog --dump binaryLogFileName")
+	exit()
+
+if "dump" in flags:
+	fileName = argv[1]
+	start = 0
+	if fileName.endswith(".checkpoint"):
+		data, start = checkpoint.readCheckpoint(fileName[:-len(".checkpoint")])
+		print(data)
+	def visit(tid, state, ops):
+		if ops:
+			print("{0} {1} {2}".format(tid, state, recovery.RecoveryHelper.createOperationTransaction(tid, state, ops).operationString))
+		else:
+			print("{0} {1}".format(tid, state))
+	logformat.scanFile(fileName, visit, start)
+	exit()
+
+textName = argv[1]
+# segment 0 sorts before every segment a node writes, so the converted records are replayed first
+binaryName = argv[2] if len(argv) >= 3 else checkpoint.segmentName(textName, 0)
+if os.path.exists(binaryName):
+	print("{0} already exists".format(binaryName))
+	exit()
+
+converted = 0
+with open(textName, "r") as textLog, open(binaryName, "wb") as binaryLog:
+	for line in textLog:
+		entry = recovery.RecoveryHelper.parseLogEntry(line)
+		if not entry or entry[1] not in logformat.CODES:
+			print("Skipping malformed entry: {0}".format(line.rstrip()))
+			continue
+		# the values of a text log are strings
+		binaryLog.write(logformat.encode(*entry, typedValues=False))
+		converted += 1
+	binaryLog.flush()
+	os.fsync(binaryLog.fileno())
+
+print("Converted {0} records from {1} to {2}".format(converted, textName, binaryName))
+print("Remove {0} once the node recovers from {1}".format(textName, binaryName))
@@ -0,0 +1,69 @@
+import concurrent.futures
+import proxypool
+import transactions
+
+# Sends the same call to a set of replicas in parallel using a bounded pool of worker threads,
+# so that every phase of the 2-phase-commit costs roughly the RTT of the slowest replica
+# instead of the sum of all of them
+class Dispatcher:
+
+	WORKERS_PER_REPLICA = 4
+	MIN_WORKERS = 8
+
+	def __init__(self, maxWorkers):
+		self.maxWorkers = maxWorkers
+		# control=True runs the calls on the control pool (votes and decisions)
+		self.executors = proxypool.CallExecutors(maxWorkers, "dispatcher")
+
+	@staticmethod
+	def defaultWorkers(replicaCount):
+		return max(Dispatcher.MIN_WORKERS, Dispatcher.WORKERS_PER_REPLICA * replicaCount)
+
+	# Runs func(replica) for every replica and waits for all of them.
+	# Returns a list of (replica, result, exception) in the same order as replicas
+	def broadcast(self, replicas, func, control=False):
+		executor = self.executors.executor(control)
+		futures = [executor.submit(func, replica) for replica in replicas]
+		results = []
+		for replica, future in zip(replicas, futures):
+			try:
+				results.append((replica, future.result(), None))
+			except Exception as e:
+				results.append((replica, None, e))
+		return results
+
+	# Runs func(replica) for every replica and collects their votes. Returns None as soon as the first
+	# replica answers no (or fails), without waiting for the rest; otherwise the replicas that voted read-only
+	def collectVotes(self, replicas, func, control=False):
+		executor = self.executors.executor(control)
+		futures = dict((executor.submit(func, replica), replica) for replica in replicas)
+		readOnly = []
+		for future in concurrent.futures.as_completed(futures):
+			try:
+				vote = future.result()
+			except Exception as e:
+				print("Error collecting vote from one of the replicas")
+				print("Exception: {0}".format(e))
+				vote = False
+			if not vote:
+				for pending in futures:
+					pending.cancel()
+				return None
+			if vote == transactions.READ_ONLY:
+				readOnly.append(futures[future])
+		return readOnly
+
+	# Runs func(replica) for every replica without waiting for the answers (failures are only printed)
+	def send(self, replicas, func, control=False):
+		executor = self.executors.executor(control)
+		for replica in replicas:
+			executor.submit(func, replica).add_done_callback(Dispatcher.__report)
+
+	@staticmethod
+	def __report(future):
+		if future.exception() is not None:
+			print("Error sending message to one of the replicas")
+			print("Exception: {0}".format(future.exception()))
+
+	def shutdown(self):
+		self.executors.shutdown(wait=False)
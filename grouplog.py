@@ -0,0 +1,104 @@
+import concurrent.futures
+import os
+import threading
+import time
+
+# Write-ahead log with group commit: concurrent transactions append their records to a shared
+# buffer and a single flusher thread writes and fsyncs them in batches. Every caller is released
+# once the batch holding its record is durable, so one fsync covers many commits. Records are
+# bytes (see logformat)
+class GroupCommitLog:
+
+	DEFAULT_BATCH_SIZE = 512
+	DEFAULT_MAX_WAIT = 0.001
+
+	# metrics (a metrics.Metrics, optional) gets the time of every write + fsync and the number of records
+	def __init__(self, fileName, mode="ab", batchSize=DEFAULT_BATCH_SIZE, maxWait=DEFAULT_MAX_WAIT, metrics=None):
+		self.fileName = fileName
+		self.metrics = metrics
+		self.file = open(fileName, mode)
+		self.batchSize = batchSize
+		self.maxWait = maxWait
+		self.cond = threading.Condition()
+		# list of [records, future] batches waiting for the flusher, each at most batchSize records long
+		self.pending = []
+		self.closed = False
+		# held by the flusher while it writes a batch, so the file can be swapped safely by rotate
+		self.writeLock = threading.Lock()
+		# called by the flusher after a batch once the file grows past maxSize (see rotate)
+		self.maxSize = None
+		self.onFull = None
+		self.flusher = threading.Thread(target=self.__flushLoop, name="log-flusher", daemon=True)
+		self.flusher.start()
+
+	# Appends a record and blocks until it is on disk
+	def append(self, record):
+		self.submit(record).result()
+
+	# Appends a record without waiting. Returns a future that completes once the record is on disk
+	def submit(self, record):
+		with self.cond:
+			if self.closed:
+				raise ValueError("Log {0} is closed".format(self.fileName))
+			if not self.pending or len(self.pending[-1][0]) >= self.batchSize:
+				self.pending.append([[], concurrent.futures.Future()])
+			batch = self.pending[-1]
+			batch[0].append(record)
+			self.cond.notify()
+			return batch[1]
+
+	# Calls onFull() from the flusher every time a batch leaves the file larger than maxSize bytes
+	def setMaxSize(self, maxSize, onFull):
+		self.maxSize = maxSize
+		self.onFull = onFull
+
+	# Switches to a new file. Every record made durable before the call is in the old file;
+	# records still waiting for the flusher go to the new one
+	def rotate(self, fileName):
+		with self.writeLock:
+			self.file.close()
+			self.fileName = fileName
+			self.file = open(fileName, "ab")
+
+	def close(self):
+		with self.cond:
+			self.closed = True
+			self.cond.notify()
+		self.flusher.join()
+		self.file.close()
+
+	def __flushLoop(self):
+		while True:
+			with self.cond:
+				while not self.pending and not self.closed:
+					self.cond.wait()
+				if not self.pending:
+					return
+				# give concurrent transactions a moment to join the batch, unless it is already full
+				deadline = time.monotonic() + self.maxWait
+				while len(self.pending) == 1 and len(self.pending[0][0]) < self.batchSize and not self.closed:
+					remaining = deadline - time.monotonic()
+					if remaining <= 0:
+						break
+					self.cond.wait(remaining)
+				records, future = self.pending.pop(0)
+
+			full = False
+			try:
+				start = time.monotonic()
+				with self.writeLock:
+					self.file.write(b"".join(records))
+					self.file.flush()
+					os.fsync(self.file.fileno())
+					full = self.maxSize is not None and self.file.tell() >= self.maxSize
+				if self.metrics:
+					self.metrics.record("log.flush", time.monotonic() - start)
+					self.metrics.increment("log.records", len(records))
+				future.set_result(len(records))
+			except Exception as e:
+				print("Error flushing log {0}".format(self.fileName))
+				print("Exception: {0}".format(e))
+				future.set_exception(e)
+
+			if full:
+				self.onFull()
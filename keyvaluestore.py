@@ -1,24 +1,90 @@
+import dbm
+import os
 import shelve
+import threading
+import logstore
 
+# Storage engines a replica can keep its data in
+LOG = "log"
+SHELVE = "shelve"
+
+def createStore(engine, dbName):
+	if engine == LOG:
+		migrateShelve(dbName)
+		return logstore.LogStore(dbName)
+	elif engine == SHELVE:
+		return KeyValueStore(dbName)
+	raise ValueError("Unknown storage engine {0}".format(engine))
+
+# Copies the shelve database of a replica that ran with the shelve engine into the log store, so
+# that the replica keeps its data when it switches engines. The shelve files are left in place and
+# a marker file records that the copy is complete: a copy cut short by a crash is started over
+def migrateShelve(dbName):
+	markerFileName = dbName + ".migrated"
+	if not dbm.whichdb(dbName) or os.path.isfile(markerFileName):
+		return
+	print("Copying the shelve database {0} into the log store".format(dbName))
+	logstore.removeFiles(dbName)
+	store = logstore.LogStore(dbName)
+	count = 0
+	with shelve.open(dbName, "r") as data:
+		for key in data.keys():
+			store.put(key, data[key])
+			count += 1
+	store.close()
+	with open(markerFileName, "w") as f:
+		f.write(str(count))
+		f.flush()
+		os.fsync(f.fileno())
+	print("Copied {0} keys from the shelve database".format(count))
+
+# Legacy engine on top of shelve (dbm pages, pickled values)
 class KeyValueStore:
 	def __init__ (self, dbName):
 		print("dbName at the kvs: " + dbName)
 		self.data = shelve.open(dbName)
+		# shelve objects can't be shared by the request threads without it
+		self.lock = threading.Lock()
+		# sorted keys for keys(), built at its first call
+		self.sortedKeys = None
 
 	def put(self, key, value):
-		self.data[key] = value
+		with self.lock:
+			if self.sortedKeys is not None and key not in self.data:
+				self.sortedKeys.add(key)
+			self.data[key] = value
 		return True
 
 	def get(self, key):
-		return self.data[key] if key in self.data else None
+		with self.lock:
+			return self.data[key] if key in self.data else None
+
+	def getMany(self, keys):
+		with self.lock:
+			return dict((key, self.data[key] if key in self.data else None) for key in keys)
+
+	def keys(self, afterKey, limit):
+		with self.lock:
+			if self.sortedKeys is None:
+				self.sortedKeys = logstore.SortedKeys(self.data.keys(), lambda key: key in self.data)
+		return self.sortedKeys.page(afterKey, limit, self.lock)
 
 	def delete(self, key):
 		success = False
-		if key in self.data:
-			del self.data[key]
-			success = True
+		with self.lock:
+			if key in self.data:
+				del self.data[key]
+				if self.sortedKeys is not None:
+					self.sortedKeys.remove(key)
+				success = True
 		return success
 
+	def sync(self):
+		with self.lock:
+			self.data.sync()
+		return True
+
 	def close(self):
-		self.data.close()
+		with self.lock:
+			self.data.close()
 		return True
@@ -0,0 +1,201 @@
+import collections
+import threading
+import time
+
+# Lock of one key: the tid holding it and the tids waiting for it, in arrival order
+class KeyLock:
+	__slots__ = ("holder", "waiters", "cond")
+
+	def __init__(self, holder, lock):
+		self.holder = holder
+		self.waiters = collections.deque()
+		# shares the lock of the stripe, so only the waiters of this key are woken up
+		self.cond = threading.Condition(lock)
+
+# Contention counters of one key
+class KeyStats:
+	__slots__ = ("waits", "timeouts", "wounds", "waitTime")
+
+	def __init__(self):
+		self.waits = 0
+		self.timeouts = 0
+		self.wounds = 0
+		self.waitTime = 0.0
+
+# Key locks of a replica. The table is split in stripes (each with its own mutex) so that unrelated
+# keys don't contend on one lock. A busy key queues the request (FIFO) until the holder releases
+# it or the deadline of the request passes, instead of failing at once. Distributed deadlocks are
+# avoided with wound-wait ordering by tid: a request younger (higher tid) than the holder waits,
+# an older one wounds the holder, i.e. asks wound(tid) to abort it, which only succeeds while
+# the holder hasn't voted yet (a holder that voted never waits for anything, so it is safe to
+# wait for it). A holder can be wounded while it still waits for other keys of its own: the abort
+# cancels its acquire, which then gives up and releases what it took. Keys are only in the table
+# while they are held
+class LockManager:
+
+	DEFAULT_STRIPES = 64
+	DEFAULT_WAIT = 1.0
+	# keys with contention counters; the least contended half is dropped when there are more
+	MAX_TRACKED_KEYS = 1024
+
+	# wound(tid) aborts the transaction tid if it hasn't voted yet and returns whether it did
+	def __init__(self, wound=None, stripes=DEFAULT_STRIPES):
+		self.wound = wound
+		self.stripes = [(threading.Lock(), dict()) for i in range(stripes)]
+		self.statsLock = threading.Lock()
+		self.acquired = 0
+		self.waits = 0
+		self.timeouts = 0
+		self.wounds = 0
+		self.waitTime = 0.0
+		self.keyStats = dict()
+		# tids in acquire, with the key lock each one waits for (None while it isn't waiting), and
+		# the ones among them that were cancelled
+		self.acquiringLock = threading.Lock()
+		self.acquiring = dict()
+		self.cancelled = set()
+
+	# Locks every key for tid or none of them, waiting up to timeout seconds in total. Fails as
+	# well if cancel(tid) is called meanwhile
+	def acquire(self, keys, tid, timeout):
+		deadline = time.monotonic() + timeout
+		acquired = []
+		with self.acquiringLock:
+			self.acquiring[tid] = None
+		try:
+			for key in keys:
+				if not self.__acquire(key, tid, deadline):
+					self.release(acquired, tid)
+					return False
+				acquired.append(key)
+			return True
+		finally:
+			with self.acquiringLock:
+				del self.acquiring[tid]
+				self.cancelled.discard(tid)
+
+	# Makes the acquire of tid, if one is running, give up (the transaction was aborted). It takes
+	# no key once this returns; the caller releases the keys it took already
+	def cancel(self, tid):
+		with self.acquiringLock:
+			if tid not in self.acquiring:
+				return
+			self.cancelled.add(tid)
+			keyLock = self.acquiring[tid]
+		if keyLock is not None:
+			with keyLock.cond:
+				keyLock.cond.notify_all()
+
+	# Releases the keys held by tid, handing each one to its first waiter
+	def release(self, keys, tid):
+		for key in keys:
+			lock, table = self.__stripe(key)
+			with lock:
+				keyLock = table.get(key)
+				if keyLock is None or keyLock.holder != tid:
+					continue
+				self.__handOver(keyLock, key, table)
+
+	def __len__(self):
+		count = 0
+		for lock, table in self.stripes:
+			with lock:
+				count += len(table)
+		return count
+
+	# Totals and the most contended keys
+	def stats(self, top=10):
+		with self.statsLock:
+			keys = sorted(self.keyStats.items(), key=lambda item: item[1].waitTime, reverse=True)[:top]
+			return {"acquired": self.acquired, "waits": self.waits, "timeouts": self.timeouts, "wounds": self.wounds,
+				"waitTime": self.waitTime, "held": len(self),
+				"hotKeys": [{"key": key, "waits": stats.waits, "timeouts": stats.timeouts, "wounds": stats.wounds, "waitTime": stats.waitTime} for key, stats in keys]}
+
+	def __acquire(self, key, tid, deadline):
+		lock, table = self.__stripe(key)
+		with lock:
+			if tid in self.cancelled:
+				return False
+			keyLock = table.get(key)
+			if keyLock is None:
+				table[key] = KeyLock(tid, lock)
+				self.__count()
+				return True
+			if keyLock.holder == tid:
+				return True
+			keyLock.waiters.append(tid)
+		with self.acquiringLock:
+			self.acquiring[tid] = keyLock
+
+		start = time.monotonic()
+		# holders that were asked to abort already
+		wounded = set()
+		while True:
+			victim = None
+			with lock:
+				while keyLock.holder != tid:
+					if tid in self.cancelled:
+						keyLock.waiters.remove(tid)
+						return False
+					remaining = deadline - time.monotonic()
+					if remaining <= 0:
+						keyLock.waiters.remove(tid)
+						self.__record(key, start, timeout=True)
+						return False
+					if self.wound and keyLock.holder > tid and keyLock.holder not in wounded:
+						victim = keyLock.holder
+						break
+					keyLock.cond.wait(remaining)
+				else:
+					if tid in self.cancelled:
+						self.__handOver(keyLock, key, table)
+						return False
+					self.__record(key, start)
+					return True
+			# the abort releases the locks of the victim, so it runs without the stripe lock
+			wounded.add(victim)
+			if self.wound(victim):
+				self.__record(key, start, wound=True)
+
+	# Passes the key to its first waiter, if any. Must be called with the stripe lock held
+	def __handOver(self, keyLock, key, table):
+		if keyLock.waiters:
+			keyLock.holder = keyLock.waiters.popleft()
+			keyLock.cond.notify_all()
+		else:
+			del table[key]
+
+	def __stripe(self, key):
+		return self.stripes[hash(key) % len(self.stripes)]
+
+	def __count(self):
+		with self.statsLock:
+			self.acquired += 1
+
+	def __record(self, key, start, timeout=False, wound=False):
+		elapsed = time.monotonic() - start
+		with self.statsLock:
+			stats = self.keyStats.get(key)
+			if stats is None:
+				if len(self.keyStats) >= LockManager.MAX_TRACKED_KEYS:
+					self.__dropColdKeys()
+				stats = self.keyStats[key] = KeyStats()
+			if wound:
+				self.wounds += 1
+				stats.wounds += 1
+				return
+			self.waits += 1
+			self.waitTime += elapsed
+			stats.waits += 1
+			stats.waitTime += elapsed
+			if timeout:
+				self.timeouts += 1
+				stats.timeouts += 1
+			else:
+				self.acquired += 1
+
+	# must be called with the stats lock held
+	def __dropColdKeys(self):
+		keys = sorted(self.keyStats, key=lambda key: self.keyStats[key].waitTime)
+		for key in keys[:len(keys) // 2]:
+			del self.keyStats[key]
@@ -0,0 +1,101 @@
+import mmap
+import os
+import pickle
+import struct
+import zlib
+
+# Binary record format of the master and replica logs. Every record is
+#   body length (u32) | crc32 of the body (u32) | body
+# and the body is
+#   tid (i64) | state code (u8) | operation count (u32) | operations
+# where each operation is
+#   op code (u8) | key length (u32) | key bytes [| value length (u32) | value bytes]   (value only for puts)
+# Keys are raw UTF-8 bytes, so they can contain spaces or newlines. Values are pickled (PUT_TYPED)
+# so that they replay with their type, except in the records converted from text logs, whose values
+# were strings already (PUT, raw UTF-8). A record whose length runs past the end of the file or
+# whose crc doesn't match marks a torn tail
+
+STATES = [None, "master-start", "master-start-2pc", "master-commit", "master-abort",
+	"operate", "replica-yes", "replica-no", "replica-commit", "replica-abort", "master-reserve",
+	"replica-read-only"]
+CODES = dict((state, code) for code, state in enumerate(STATES) if state)
+
+FRAME = struct.Struct("<II")
+BODY = struct.Struct("<qBI")
+OP = struct.Struct("<BI")
+LENGTH = struct.Struct("<I")
+
+PUT = 1
+DELETE = 2
+PUT_TYPED = 3
+
+# typedValues is False for the string values of text logs (see convertlog)
+def encode(tid, state, ops, typedValues=True):
+	parts = [BODY.pack(tid, CODES[state], len(ops) if ops else 0)]
+	for op in ops or []:
+		key = str(op[1]).encode("utf-8")
+		if op[0] == "put":
+			if typedValues:
+				value = pickle.dumps(op[2], pickle.HIGHEST_PROTOCOL)
+			else:
+				value = str(op[2]).encode("utf-8")
+			parts.extend([OP.pack(PUT_TYPED if typedValues else PUT, len(key)), key, LENGTH.pack(len(value)), value])
+		else:
+			parts.extend([OP.pack(DELETE, len(key)), key])
+	body = b"".join(parts)
+	return FRAME.pack(len(body), zlib.crc32(body)) + body
+
+# Decodes the records in buffer[offset:end] in place, calling visit(tid, state, ops) for each one
+# (ops is None for records without operations). Returns the offset where the valid records end
+def scan(buffer, offset, end, visit):
+	view = memoryview(buffer)
+	try:
+		while offset + FRAME.size <= end:
+			length, crc = FRAME.unpack_from(buffer, offset)
+			start = offset + FRAME.size
+			if length < BODY.size or start + length > end or zlib.crc32(view[start:start + length]) != crc:
+				break
+			tid, code, count = BODY.unpack_from(buffer, start)
+			if code >= len(STATES) or not STATES[code]:
+				break
+			ops = None
+			if count:
+				ops = []
+				pos = start + BODY.size
+				for i in range(count):
+					opCode, keyLength = OP.unpack_from(buffer, pos)
+					pos += OP.size
+					key = str(view[pos:pos + keyLength], "utf-8")
+					pos += keyLength
+					if opCode == PUT or opCode == PUT_TYPED:
+						valueLength, = LENGTH.unpack_from(buffer, pos)
+						pos += LENGTH.size
+						if opCode == PUT_TYPED:
+							value = pickle.loads(view[pos:pos + valueLength])
+						else:
+							value = str(view[pos:pos + valueLength], "utf-8")
+						ops.append(["put", key, value])
+						pos += valueLength
+					else:
+						ops.append(["delete", key])
+			visit(tid, STATES[code], ops)
+			offset = start + length
+	finally:
+		view.release()
+	return offset
+
+# Scans a log file through mmap. A torn or corrupt tail (left by a crash in the middle of a write)
+# is cut off so that the file only holds whole records. Returns the number of valid bytes
+def scanFile(fileName, visit, start=0):
+	size = os.path.getsize(fileName)
+	if size <= start:
+		return size
+	with open(fileName, "r+b") as f:
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+			end = scan(buffer, start, size, visit)
+		if end < size:
+			print("Torn tail in {0} at offset {1}, dropping {2} bytes".format(fileName, end, size - end))
+			f.truncate(end)
+			f.flush()
+			os.fsync(f.fileno())
+	return end
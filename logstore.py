@@ -0,0 +1,385 @@
+import bisect
+import glob
+import heapq
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+# Append-only storage engine (Bitcask style). Every put or delete appends a record to the active
+# data file and updates an in-memory index of key -> (file id, value offset, value length), so a
+# write costs one sequential append and a read one pread. Data files are named
+# dbName.00000001.data, dbName.00000002.data, ... and a later file overrides an earlier one.
+# Once enough of the data is overwritten, a background compaction merges the immutable files
+# into one holding only the live values, plus a hint file (the index entries of the merged file)
+# that rebuilds the index at startup without reading the values
+class LogStore:
+
+	# crc32 of the rest of the record | key length | value length (-1 for a delete)
+	HEADER = struct.Struct("<IIi")
+	# value offset | value length | key length, followed by the key
+	HINT = struct.Struct("<QiI")
+
+	DEFAULT_MAX_FILE_SIZE = 64 * 1024 * 1024
+	DEFAULT_COMPACT_INTERVAL = 60
+	# compaction runs once this fraction of the bytes on disk is dead...
+	COMPACT_RATIO = 0.5
+	# ...and there is at least this much to reclaim
+	COMPACT_MIN_BYTES = 1024 * 1024
+
+	def __init__(self, dbName, maxFileSize=DEFAULT_MAX_FILE_SIZE, compactInterval=DEFAULT_COMPACT_INTERVAL):
+		print("dbName at the log store: " + dbName)
+		self.dbName = dbName
+		self.maxFileSize = maxFileSize
+		self.compactInterval = compactInterval
+		self.lock = threading.Lock()
+		# held while compacting, so only one compaction runs at a time
+		self.compactLock = threading.Lock()
+		self.index = dict()
+		# file id -> descriptor used for reads
+		self.readers = dict()
+		# descriptors of compacted files, closed at the next compaction so that reads in flight can finish
+		self.retired = []
+		self.totalBytes = 0
+		self.deadBytes = 0
+		# sorted keys for keys(), built at its first call
+		self.sortedKeys = None
+
+		fileIds = listDataFiles(dbName)
+		for fileId in fileIds:
+			self.__load(fileId, fileId == fileIds[-1])
+		self.activeId = fileIds[-1] if fileIds else 1
+		# a merged file is never appended to, its hint would miss the new records
+		if os.path.isfile(hintFileName(dbName, self.activeId)):
+			self.activeId += 1
+		self.__openActive()
+
+		self.thread = threading.Thread(target=self.__run, name="compaction", daemon=True)
+		self.thread.start()
+
+	def put(self, key, value):
+		self.__append(key, encodeValue(value))
+		return True
+
+	def get(self, key):
+		with self.lock:
+			location = self.index.get(key)
+			if location is None:
+				return None
+			fileId, offset, length = location
+			reader = self.readers[fileId]
+		return decodeValue(readAt(reader, length, offset))
+
+	# Bulk lookup: finds every location under one acquisition of the lock, then reads the values
+	def getMany(self, keys):
+		with self.lock:
+			locations = [(key, self.index.get(key)) for key in keys]
+			readers = dict((location[0], self.readers[location[0]]) for key, location in locations if location is not None)
+		values = dict()
+		for key, location in locations:
+			if location is None:
+				values[key] = None
+			else:
+				fileId, offset, length = location
+				values[key] = decodeValue(readAt(readers[fileId], length, offset))
+		return values
+
+	# Up to limit keys that sort after afterKey, in order
+	def keys(self, afterKey, limit):
+		with self.lock:
+			if self.sortedKeys is None:
+				self.sortedKeys = SortedKeys(self.index, lambda key: key in self.index)
+		return self.sortedKeys.page(afterKey, limit, self.lock)
+
+	def delete(self, key):
+		with self.lock:
+			if key not in self.index:
+				return False
+		self.__append(key, None)
+		return True
+
+	def sync(self):
+		with self.lock:
+			os.fsync(self.activeFd)
+		return True
+
+	def close(self):
+		with self.lock:
+			os.fsync(self.activeFd)
+			os.close(self.activeFd)
+			for fd in list(self.readers.values()) + self.retired:
+				os.close(fd)
+			self.readers = dict()
+			self.retired = []
+		return True
+
+	# Merges every immutable data file into a single one with only the live values. The active file
+	# is rotated first, so writes go on while the merge runs
+	def compact(self):
+		with self.compactLock:
+			with self.lock:
+				for fd in self.retired:
+					os.close(fd)
+				self.retired = []
+				oldIds = [fileId for fileId in sorted(self.readers) if fileId <= self.activeId]
+				# the merged file takes the id right after the old files, and new writes go after it
+				mergedId = self.activeId + 1
+				self.__rotate(self.activeId + 2)
+				self.deadBytes = 0
+				live = [(key, location) for key, location in self.index.items() if location[0] in oldIds]
+
+			mergedName = dataFileName(self.dbName, mergedId)
+			moved = dict()
+			offset = 0
+			with open(mergedName + ".tmp", "wb") as data, open(hintFileName(self.dbName, mergedId) + ".tmp", "wb") as hint:
+				for key, (fileId, valueOffset, length) in live:
+					keyBytes = key.encode("utf-8")
+					record = encodeRecord(keyBytes, readAt(self.readers[fileId], length, valueOffset))
+					data.write(record)
+					moved[key] = (mergedId, offset + LogStore.HEADER.size + len(keyBytes), length)
+					hint.write(LogStore.HINT.pack(moved[key][1], length, len(keyBytes)) + keyBytes)
+					offset += len(record)
+				for f in (data, hint):
+					f.flush()
+					os.fsync(f.fileno())
+			# the data file goes in place before its hint, so a hint never describes a missing file
+			os.replace(mergedName + ".tmp", mergedName)
+			os.replace(hintFileName(self.dbName, mergedId) + ".tmp", hintFileName(self.dbName, mergedId))
+
+			with self.lock:
+				self.readers[mergedId] = os.open(mergedName, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+				for key, (fileId, valueOffset, length) in live:
+					# only keys that weren't written again during the merge point to the merged file
+					if self.index.get(key) == (fileId, valueOffset, length):
+						self.index[key] = moved[key]
+				for fileId in oldIds:
+					self.retired.append(self.readers.pop(fileId))
+				self.totalBytes = offset + os.fstat(self.activeFd).st_size
+
+			for fileId in oldIds:
+				for fileName in (dataFileName(self.dbName, fileId), hintFileName(self.dbName, fileId)):
+					if os.path.isfile(fileName):
+						os.remove(fileName)
+			print("Compacted {0} data files into {1} ({2} live keys, {3} bytes)".format(len(oldIds), mergedName, len(live), offset))
+
+	# valueBytes is None for a delete
+	def __append(self, key, valueBytes):
+		keyBytes = key.encode("utf-8")
+		record = encodeRecord(keyBytes, valueBytes)
+		with self.lock:
+			offset = self.activeSize
+			os.write(self.activeFd, record)
+			self.activeSize += len(record)
+			self.totalBytes += len(record)
+			old = self.index.pop(key, None)
+			if old is not None:
+				self.deadBytes += LogStore.HEADER.size + len(keyBytes) + old[2]
+			if self.sortedKeys is not None:
+				if old is None and valueBytes is not None:
+					self.sortedKeys.add(key)
+				elif old is not None and valueBytes is None:
+					self.sortedKeys.remove(key)
+			if valueBytes is None:
+				# the delete record itself is dead as soon as the older files are compacted away
+				self.deadBytes += len(record)
+			else:
+				self.index[key] = (self.activeId, offset + LogStore.HEADER.size + len(keyBytes), len(valueBytes))
+			if self.activeSize >= self.maxFileSize:
+				self.__rotate(self.activeId + 1)
+
+	# must be called with the lock held
+	def __rotate(self, fileId):
+		os.fsync(self.activeFd)
+		os.close(self.activeFd)
+		self.activeId = fileId
+		self.__openActive()
+
+	def __openActive(self):
+		fileName = dataFileName(self.dbName, self.activeId)
+		self.activeFd = os.open(fileName, os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0))
+		self.activeSize = os.fstat(self.activeFd).st_size
+		if self.activeId not in self.readers:
+			self.readers[self.activeId] = os.open(fileName, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+	# Adds the records of a data file to the index, from its hint file if there is one
+	def __load(self, fileId, last):
+		fileName = dataFileName(self.dbName, fileId)
+		self.readers[fileId] = os.open(fileName, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+		if os.path.isfile(hintFileName(self.dbName, fileId)):
+			with open(hintFileName(self.dbName, fileId), "rb") as f:
+				hints = f.read()
+			pos = 0
+			while pos < len(hints):
+				valueOffset, length, keyLength = LogStore.HINT.unpack_from(hints, pos)
+				pos += LogStore.HINT.size
+				key = str(hints[pos:pos + keyLength], "utf-8")
+				pos += keyLength
+				self.__index(key, (fileId, valueOffset, length))
+			self.totalBytes += os.path.getsize(fileName)
+			return
+
+		size = os.path.getsize(fileName)
+		end = 0
+		if size > 0:
+			with open(fileName, "rb") as f:
+				with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+					end = scanRecords(buffer, size, lambda key, location: self.__index(key, None if location[1] < 0 else (fileId,) + location))
+		if end < size:
+			# only the active file can have been cut short by a crash
+			print("Torn tail in {0} at offset {1}, dropping {2} bytes".format(fileName, end, size - end))
+			if last:
+				with open(fileName, "r+b") as f:
+					f.truncate(end)
+		self.totalBytes += end
+
+	def __index(self, key, location):
+		old = self.index.pop(key, None)
+		if old is not None:
+			self.deadBytes += old[2]
+		if location is not None:
+			self.index[key] = location
+
+	def __run(self):
+		while True:
+			time.sleep(self.compactInterval)
+			if self.deadBytes >= LogStore.COMPACT_MIN_BYTES and self.deadBytes >= LogStore.COMPACT_RATIO * self.totalBytes:
+				try:
+					self.compact()
+				except Exception as e:
+					print("Error compacting {0}".format(self.dbName))
+					print("Exception: {0}".format(e))
+
+# Sorted view of the keys of a store, to page through them in order (a rebalance lists every key of
+# a replica this way) without scanning the whole store for every page. It is built once and then
+# follows the keys the store creates and deletes, which are merged in once there are MERGE_SIZE of
+# them, so a page costs O(limit log N). contains(key) tells (with the lock of the store held) whether
+# the store still has a key
+class SortedKeys:
+
+	MERGE_SIZE = 4096
+
+	def __init__(self, keys, contains):
+		self.keys = sorted(keys)
+		self.contains = contains
+		# keys created and count of keys deleted since the last merge, guarded by the lock of the store
+		self.added = set()
+		self.deleted = 0
+		# one page at a time, so a merge never hides the keys it is moving
+		self.lock = threading.Lock()
+
+	# Called by the store, with its lock held, for every key it creates
+	def add(self, key):
+		self.added.add(key)
+
+	# Called by the store, with its lock held, for every key it deletes
+	def remove(self, key):
+		self.added.discard(key)
+		self.deleted += 1
+
+	# Up to limit keys after afterKey. storeLock is the lock of the store
+	def page(self, afterKey, limit, storeLock):
+		with self.lock:
+			with storeLock:
+				if len(self.added) + self.deleted >= SortedKeys.MERGE_SIZE:
+					merging, self.added, self.deleted = self.added, set(), 0
+				else:
+					merging = None
+				recent = [key for key in self.added if key > afterKey]
+			if merging is not None:
+				merged = SortedKeys.__merge(self.keys, sorted(merging))
+				with storeLock:
+					self.keys = [key for key in merged if self.contains(key)]
+			# keys deleted since the last merge are still in keys
+			page = []
+			start = bisect.bisect_right(self.keys, afterKey)
+			while len(page) < limit and start < len(self.keys):
+				batch = self.keys[start:start + limit]
+				start += limit
+				with storeLock:
+					page.extend(key for key in batch if self.contains(key))
+			page = page[:limit]
+			if recent:
+				page = heapq.nsmallest(limit, set(page).union(recent))
+			return page
+
+	@staticmethod
+	def __merge(keys, added):
+		merged = []
+		for key in heapq.merge(keys, added):
+			if not merged or merged[-1] != key:
+				merged.append(key)
+		return merged
+
+def dataFileName(dbName, fileId):
+	return "{0}.{1:08d}.data".format(dbName, fileId)
+
+def hintFileName(dbName, fileId):
+	return "{0}.{1:08d}.hint".format(dbName, fileId)
+
+def listDataFiles(dbName):
+	fileIds = []
+	for fileName in glob.glob(glob.escape(dbName) + ".*.data"):
+		suffix = fileName[len(dbName) + 1:-len(".data")]
+		if len(suffix) == 8 and suffix.isdigit():
+			fileIds.append(int(suffix))
+	return sorted(fileIds)
+
+# Removes every file of the store named dbName
+def removeFiles(dbName):
+	for fileId in listDataFiles(dbName):
+		for fileName in (dataFileName(dbName, fileId), hintFileName(dbName, fileId)):
+			if os.path.isfile(fileName):
+				os.remove(fileName)
+
+# Values are pickled (as shelve does) behind a marker byte, so they read back with their type.
+# Values written before that are plain UTF-8 strings
+TYPED = b"\x00"
+
+def encodeValue(value):
+	return TYPED + pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+def decodeValue(data):
+	if data[:1] == TYPED:
+		return pickle.loads(data[1:])
+	return str(data, "utf-8")
+
+# value is bytes, or None for a delete
+def encodeRecord(keyBytes, value):
+	length = -1 if value is None else len(value)
+	lengths = struct.pack("<Ii", len(keyBytes), length)
+	body = keyBytes + (value or b"")
+	return struct.pack("<I", zlib.crc32(lengths + body)) + lengths + body
+
+# Calls visit(key, (value offset, value length)) for every valid record in buffer[:end] (the value
+# length is -1 for deletes). Returns the offset where the valid records end
+def scanRecords(buffer, end, visit):
+	view = memoryview(buffer)
+	pos = 0
+	try:
+		while pos + LogStore.HEADER.size <= end:
+			crc, keyLength, valueLength = LogStore.HEADER.unpack_from(buffer, pos)
+			keyOffset = pos + LogStore.HEADER.size
+			recordEnd = keyOffset + keyLength + max(valueLength, 0)
+			# the crc covers both lengths, the key and the value
+			if recordEnd > end or zlib.crc32(view[pos + 4:recordEnd]) != crc:
+				break
+			visit(str(view[keyOffset:keyOffset + keyLength], "utf-8"), (keyOffset + keyLength, valueLength))
+			pos = recordEnd
+	finally:
+		view.release()
+	return pos
+
+# pread where the platform has it, a positioned read under a lock elsewhere (Windows)
+if hasattr(os, "pread"):
+	def readAt(fd, length, offset):
+		return os.pread(fd, length, offset)
+else:
+	readLock = threading.Lock()
+
+	def readAt(fd, length, offset):
+		with readLock:
+			os.lseek(fd, offset, os.SEEK_SET)
+			return os.read(fd, length)
@@ -1,40 +1,199 @@
-import random
 import socket
 import threading
 import transactions
 import recovery
+import dispatcher
+import grouplog
+import transactiontable
+import checkpoint
+import readcache
+import readrouter
+import sharding
+import time
+import workers
+import metrics
 
 # Master (aka coordinator) of the replicated key-value store
 # in charge of managing the 2-phase-commit protocol
 class Master:
-	def __init__(self, logFileName, replicaProxies):
+
+	# getMany doesn't split key sets smaller than this across replicas
+	MIN_GET_CHUNK = 32
+	# tids reserved by each reservation record (per worker)
+	TID_BLOCK = 4096
+	# keys listed per replica call while rebalancing
+	SCAN_BATCH = 256
+	# pause before a failed rebalance step is retried
+	REBALANCE_RETRY_DELAY = 1
+
+	def __init__(self, logFileName, replicaProxies, dispatchWorkers=None, logBatchSize=grouplog.GroupCommitLog.DEFAULT_BATCH_SIZE, logMaxWait=grouplog.GroupCommitLog.DEFAULT_MAX_WAIT, prepareMode=False, retention=transactiontable.TransactionTable.DEFAULT_RETENTION,
+			checkpointInterval=checkpoint.Checkpointer.DEFAULT_INTERVAL, segmentSize=checkpoint.Checkpointer.DEFAULT_SEGMENT_SIZE, cacheSize=0,
+			hedge="p95", readTimeout=readrouter.ReadRouter.DEFAULT_TIMEOUT, groups=None, workerId=0, workerCount=1, peers=None, presumedAbort=False):
 		self.replicaProxies = replicaProxies
+		# latency of every phase (and of every replica call), commit and abort counts; see stats
+		self.metrics = metrics.Metrics()
+		# name of every replica proxy (by id) in the per peer metrics
+		self.peerNames = dict((id(proxy), "replica{0}".format(ix)) for ix, proxy in enumerate(replicaProxies))
+		# a write only invalidates the cache of the worker that coordinates it, the others would serve stale values
+		if cacheSize and workerCount > 1:
+			raise ValueError("The read cache can only be used with a single worker")
+		# worker process workerId out of workerCount (see workers.py); it hands out the tids congruent
+		# to workerId and asks peers[owner] about the tids of the other workers
+		self.workerId = workerId
+		self.workerCount = workerCount
+		self.peers = peers
+		# replica groups (lists of positions in replicaProxies); by default one group holds every key
+		groups = groups or [list(range(len(replicaProxies)))]
+		# maps every key to the group that owns it, a write only goes to the owners of its keys
+		self.sharding = sharding.Sharding(groups)
+		self.groupProxies = [[replicaProxies[ix] for ix in group] for group in groups]
+		# group of every replica proxy (by id), to pick the part of a batch that it applies
+		self.proxyGroups = dict((id(proxy), group) for group, proxies in enumerate(self.groupProxies) for proxy in proxies)
+		# optional LRU cache of values (bounded to cacheSize bytes) that serves gets without going to a replica
+		self.cache = readcache.ReadCache(cacheSize) if cacheSize else None
+		# sends each get to a fast replica of the owner group, hedging it on a second one if the answer is late
+		self.routers = [readrouter.ReadRouter(len(group), hedge, readTimeout) for group in groups]
+		# when set, the operation travels with the vote request (replica.prepare) and saves a round trip
+		self.prepareMode = prepareMode
+		# presumed abort: only commits are logged, aborts aren't acked, and a tid without a record was aborted
+		self.presumedAbort = presumedAbort
+		# tids below it are covered by a reservation record, durable once the future reservation is done
+		self.reservedTid = 0
+		self.reservation = None
+		self.dispatcher = dispatcher.Dispatcher(dispatchWorkers or dispatcher.Dispatcher.defaultWorkers(len(replicaProxies)))
 		self.idCount = 0
-		self.logFileName = logFileName
-		self.transactions = dict()
-		self.__recover()
-		self.logFile = open(self.logFileName, "w")
+		self.logFileName = workers.workerLogName(logFileName, workerId, workerCount)
+		self.transactions = transactiontable.TransactionTable(self.logFileName + ".outcomes", retention)
 		self.tidLock = threading.Lock()
+		nextSeq = self.__recover()
+		self.idCount = max(self.idCount, self.transactions.nextFreeTid())
+		self.idCount += (workerId - self.idCount) % workerCount
+		# the recovered log is left alone: new records go to a fresh segment, and the old ones
+		# are only dropped by the checkpoint below, once it is durable
+		self.logFile = grouplog.GroupCommitLog(checkpoint.segmentName(self.logFileName, nextSeq), "ab", logBatchSize, logMaxWait, self.metrics)
+		self.metrics.gauge("inflight", lambda: len(self.transactions.inflight))
+		self.metrics.gauge("retained", lambda: len(self.transactions.finished))
+		self.checkpointer = checkpoint.Checkpointer(self.logFileName, self.logFile, nextSeq + 1, self.__snapshot, checkpointInterval, segmentSize)
+		self.checkpointer.checkpoint()
+		self.__startSharding(logFileName + ".groups", groups)
 
 	def get(self, key):
-		return self.__get(key)
+		if not self.cache:
+			return self.__get(key)
+		hit, result = self.cache.lookup(key)
+		if hit:
+			return result
+		value = self.__get(key)
+		self.cache.fill(key, value, result)
+		return value
+
+	# Values of many keys in one call ({key: value}, None for missing keys). The keys that aren't
+	# cached are split across the replicas of their groups and the parts are read in parallel
+	def getMany(self, keys):
+		values, tokens = self.__lookupMany(keys)
+		results = self.dispatcher.broadcast(self.__splitKeys(list(tokens)), lambda chunk: self.routers[chunk[0]].read(self.groupProxies[chunk[0]], lambda replica: replica.getMany(chunk[1])))
+		for chunk, fetched, e in results:
+			if e:
+				raise e
+			self.__fillMany(values, fetched, tokens)
+		return values
 
 	def put(self, key, value):
-		return self.__2phaseCommit(lambda replica, tid: replica.put(key,value,tid), "put {0} {1}".format(key, value), key)
+		with self.sharding.write([key]):
+			return self.__2phaseCommit(lambda replica, tid: replica.put(key,value,tid), "put {0} {1}".format(key, value), key,
+				lambda replica, tid: replica.prepare(tid, "put", key, value), [["put", key, value]])
 
 	def delete(self, key):
-		return self.__2phaseCommit(lambda replica, tid: replica.delete(key, tid), "delete {0}".format(key), key)
+		with self.sharding.write([key]):
+			return self.__2phaseCommit(lambda replica, tid: replica.delete(key, tid), "delete {0}".format(key), key,
+				lambda replica, tid: replica.prepare(tid, "delete", key), [["delete", key]])
+
+	# Applies a batch of operations ([["put", key, value], ["delete", key], ...]) atomically,
+	# in a single 2-phase-commit round under one tid
+	def multi(self, ops):
+		ops = Master.__checkBatch(ops)
+		if not ops:
+			return True
+		with self.sharding.write(recovery.RecoveryHelper.batchKeys(ops)):
+			return self.__multi(ops, self.sharding.splitOps(ops))
+
+	def multiPut(self, items):
+		return self.multi([["put", key, items[key]] for key in items])
+
+	def multiDelete(self, keys):
+		return self.multi([["delete", key] for key in keys])
 
 	def transactionState(self, tid):
-		if tid in self.transactions:
-			tr = self.transactions[tid]
-			return tr.state
-		return "unknown"
-
-	def __2phaseCommit(self, func, funcName, key):
-		transaction = self.__createTransaction(func, funcName, key)
-		self.__executeOperation(transaction)	
-		allYes = self.__requestVotes(transaction)
+		owner = workers.ownerOf(tid, self.workerCount)
+		if owner != self.workerId:
+			return self.peers[owner].transactionState(tid)
+		return self.__localState(tid)
+
+	# Bulk version of transactionState, used by the replicas' termination protocol. The tids of
+	# other workers are forwarded to their owners in one call per worker
+	def transactionStates(self, tids):
+		if self.workerCount == 1:
+			return [self.__localState(tid) for tid in tids]
+		positions = dict()
+		for i, tid in enumerate(tids):
+			positions.setdefault(workers.ownerOf(tid, self.workerCount), []).append(i)
+		states = [None] * len(tids)
+		for owner in positions:
+			ownerTids = [tids[i] for i in positions[owner]]
+			if owner == self.workerId:
+				ownerStates = [self.__localState(tid) for tid in ownerTids]
+			else:
+				ownerStates = self.peers[owner].transactionStates(ownerTids)
+			for i, state in zip(positions[owner], ownerStates):
+				states[i] = state
+		return states
+
+	# Sizes of the tables of the master
+	def tableSizes(self):
+		return {"inflight": len(self.transactions.inflight), "retained": len(self.transactions.finished),
+			"cacheEntries": len(self.cache.entries) if self.cache else 0, "rebalanceWrites": len(self.sharding.writing)}
+
+	# Latency histograms (per phase and per replica, in milliseconds), commit and abort counters (aborts
+	# by reason) and gauges of the worker that answers
+	def stats(self):
+		return self.metrics.stats()
+
+	# Hit, miss and eviction counters of the read cache (None if it is disabled)
+	def cacheStats(self):
+		return self.cache.stats() if self.cache else None
+
+	def __localState(self, tid):
+		state = self.transactions.state(tid)
+		if self.presumedAbort and state == "unknown":
+			return "master-abort"
+		return state
+
+	@staticmethod
+	def __checkBatch(ops):
+		ops = [list(op) for op in ops]
+		for op in ops:
+			if not ((len(op) == 3 and op[0] == "put") or (len(op) == 2 and op[0] == "delete")):
+				raise ValueError("Invalid batch operation: {0}".format(op))
+		return ops
+
+	# groupOps ({group: ops}) are the parts of the batch applied by each replica group
+	def __multi(self, ops, groupOps):
+		return self.__2phaseCommit(lambda replica, tid: replica.multi(groupOps[self.proxyGroups[id(replica)]], tid), recovery.RecoveryHelper.createBatchOperationString(ops), recovery.RecoveryHelper.batchKeys(ops),
+			lambda replica, tid: replica.prepare(tid, "multi", groupOps[self.proxyGroups[id(replica)]]), ops, sorted(groupOps))
+
+	# groups are the replica groups taking part in the transaction (by default the owners of its keys).
+	# A transaction with a single participant is committed in one phase
+	@metrics.timed("transaction")
+	def __2phaseCommit(self, func, funcName, key, prepareFunc=None, ops=None, groups=None):
+		prepare = self.prepareMode and prepareFunc
+		transaction = self.__createTransaction(prepareFunc if prepare else func, funcName, key, ops, groups)
+		if ops and len(transaction.participants) == 1:
+			return self.__executeAndCommit(transaction)
+		if prepare:
+			allYes = self.__prepare(transaction)
+		else:
+			self.__executeOperation(transaction)	
+			allYes = self.__requestVotes(transaction)
 		if allYes:
 			self.__commit(transaction)
 		else:
@@ -42,103 +201,365 @@ class Master:
 
 		return allYes
 
-	def __createTransaction(self, func, funcName, key):
-		tid = -1
+	# ops are the structured operations of the transaction, logged with its records and used by the read cache
+	@metrics.timed("phase.create")
+	def __createTransaction(self, func, funcName, key, ops=None, groups=None):
+		tid, reservation = self.__nextTid()
+		if reservation:
+			reservation.result()
+		return self.__startTransaction(tid, func, funcName, key, ops, groups)
+
+	# Takes the next tid. reservation is the future of the log record that reserves it (see
+	# __reserveTids), which must be durable before the tid is used
+	def __nextTid(self):
 		with self.tidLock:
 			tid = self.idCount
-			self.idCount += 1
-		transaction = transactions.Transaction(tid, "master-start", funcName, func, key)
+			self.idCount += self.workerCount
+			if tid >= self.reservedTid:
+				self.__reserveTids(tid)
+			return tid, self.reservation
+
+	def __startTransaction(self, tid, func, funcName, key, ops, groups):
+		transaction = transactions.Transaction(tid, "master-start", funcName, func, key, ops)
+		transaction.participants = self.sharding.participants(self.sharding.ownersOf(transaction.lockedKeys()) if groups is None else groups)
 		self.transactions[transaction.tid] = transaction
 		print ("Started transaction {0}".format(tid))
 		return transaction
 
+	@metrics.timed("phase.execute")
 	def __executeOperation(self, transaction):
-		success = False
+		if self.cache:
+			self.cache.invalidate(transaction)
 		print("Start sending {0} operation".format(transaction.operationString))
-		for replica in self.replicaProxies:
-			try:
-				transaction.action(replica, transaction.tid)
-				success = True
-			except Exception as e:
+		results = self.dispatcher.broadcast(self.__proxies(transaction), self.__observed("operate", lambda replica: transaction.action(replica, transaction.tid), transaction))
+		success = False
+		for replica, result, e in results:
+			if e:
 				print("Error sending operation to one of the replicas")
 				print("Exception: {0}".format(e))
-				pass
+			else:
+				success = True
 		return success
 
+	@metrics.timed("phase.votes")
 	def __requestVotes(self, transaction):
 		transaction.state = "master-start-2pc"
-		self.__log(transaction)
+		if not self.presumedAbort:
+			self.__log(transaction)
 
 		print("Sending votereqs")
+		# stops waiting as soon as one of the replicas votes no (or can't be reached)
+		readOnly = self.dispatcher.collectVotes(self.__proxies(transaction), self.__observed("voteReq", lambda replica: replica.voteReq(transaction.tid), transaction, metrics.VOTE_NO), control=True)
+		if readOnly is None:
+			return False
+		self.__dropReadOnly(transaction, readOnly)
+		return True
+
+	# Execute and voteReq in a single message: the action of the transaction is the replica's prepare call
+	@metrics.timed("phase.prepare")
+	def __prepare(self, transaction):
+		transaction.state = "master-start-2pc"
+		if not self.presumedAbort:
+			self.__log(transaction)
+
+		if self.cache:
+			self.cache.invalidate(transaction)
+		print("Sending prepare {0}".format(transaction.operationString))
+		# unlike __requestVotes this waits for every replica: a prepare still in flight when the abort
+		# is sent would otherwise stage (and lock) the transaction after the abort went through
+		results = self.dispatcher.broadcast(self.__proxies(transaction), self.__observed("prepare", lambda replica: transaction.action(replica, transaction.tid), transaction))
 		allYes = True
+		for replica, vote, e in results:
+			if e:
+				print("Error sending prepare to one of the replicas")
+				print("Exception: {0}".format(e))
+			allYes = allYes and not e and vote
+		if allYes:
+			self.__dropReadOnly(transaction, [replica for replica, vote, e in results if vote == transactions.READ_ONLY])
+		return bool(allYes)
+
+	# Leaves the replicas that voted read-only out of the rest of the transaction
+	def __dropReadOnly(self, transaction, readOnly, proxies=None):
+		if not readOnly:
+			return
+		readOnly = set(id(replica) for replica in readOnly)
+		proxies = proxies or self.replicaProxies
+		transaction.participants = [ix for ix in transaction.participants if id(proxies[ix]) not in readOnly]
+		print("{0} replica(s) voted read-only".format(len(readOnly)))
+
+	# One-phase commit: the only participant decides on its own, so there is no vote round and the
+	# master logs nothing (the tid is covered by its reservation)
+	@metrics.timed("phase.onePhase")
+	def __executeAndCommit(self, transaction):
+		if self.cache:
+			self.cache.invalidate(transaction)
+		print("Sending execute-and-commit {0}".format(transaction.operationString))
 		try:
-			for replica in self.replicaProxies:
-				allYes = allYes and replica.voteReq(transaction.tid)
+			committed = self.__observed("executeAndCommit", lambda replica: replica.executeAndCommit(transaction.tid, transaction.operations), transaction)(self.__proxies(transaction)[0])
 		except Exception as e:
-			print("Error sending voteReq to one of the replicas")
+			print("Error sending execute-and-commit to the replica")
 			print("Exception: {0}".format(e))
-			allYes = False
+			committed = None
+		self.__finishOnePhase(transaction, committed)
+		return bool(committed)
 
-		return allYes
+	# committed is None when the replica couldn't be reached: the outcome is unknown (the replica
+	# may have committed), so none is recorded for the tid and the client gets an EnvironmentError
+	# rather than an answer that may be wrong
+	def __finishOnePhase(self, transaction, committed):
+		if committed is None:
+			self.metrics.increment("unknown")
+			if self.cache:
+				self.cache.abort(transaction)
+			self.transactions.discard(transaction.tid)
+			raise EnvironmentError("Outcome of transaction {0} is unknown, the replica couldn't be reached".format(transaction.tid))
+		transaction.state = "master-commit" if committed else "master-abort"
+		self.__count(transaction)
+		if self.cache:
+			if committed:
+				self.cache.commit(transaction)
+			else:
+				self.cache.abort(transaction)
+		if not committed and self.presumedAbort:
+			self.transactions.discard(transaction.tid)
+		else:
+			self.transactions.finish(transaction.tid, True)
 
+	@metrics.timed("phase.commit")
 	def __commit(self, transaction):
 		transaction.state = "master-commit"
-		self.__log(transaction)
-		for replica in self.replicaProxies:
-			try:
-				print("Sending {0} to replica".format(transaction.state))
-				replica.commit(transaction.tid)
-				print("Sent")
-			except Exception as e:
+		self.__count(transaction)
+		proxies = self.__proxies(transaction)
+		# with presumed abort, a transaction whose participants all voted read-only needs no record:
+		# it changed nothing, so taking it for aborted is harmless
+		if proxies or not self.presumedAbort:
+			self.__log(transaction)
+		print("Sending {0} to replicas".format(transaction.state))
+		results = self.dispatcher.broadcast(proxies, self.__observed("commit", lambda replica: replica.commit(transaction.tid)), control=True)
+		acked = True
+		for replica, result, e in results:
+			if e:
 				print("Error sending final commit decision to one of the replicas")
 				print("Exception: {0}".format(e))
-				pass
-
+				acked = False
+		print("Sent")
+		if self.cache:
+			self.cache.commit(transaction)
+		self.transactions.finish(transaction.tid, acked)
 
+	@metrics.timed("phase.abort")
 	def __abort(self, transaction):
 		transaction.state = "master-abort"
+		self.__count(transaction)
+		if self.presumedAbort:
+			print("Sending {0} to replicas without waiting for acks".format(transaction.state))
+			self.dispatcher.send(self.__proxies(transaction), self.__observed("abort", lambda replica: replica.abort(transaction.tid)), control=True)
+			if self.cache:
+				self.cache.abort(transaction)
+			self.transactions.discard(transaction.tid)
+			return
 		self.__log(transaction)
-		for replica in self.replicaProxies:
-			try:
-				print("Sending {0} to replica".format(transaction.state))
-				replica.abort(transaction.tid)
-				print("Sent")
-			except Exception as e:
+		print("Sending {0} to replicas".format(transaction.state))
+		results = self.dispatcher.broadcast(self.__proxies(transaction), self.__observed("abort", lambda replica: replica.abort(transaction.tid)), control=True)
+		acked = True
+		for replica, result, e in results:
+			if e:
 				print("Error sending final abort decision to one of the replicas")
 				print("Exception: {0}".format(e))
-				pass
+				acked = False
+		print("Sent")
+		if self.cache:
+			self.cache.abort(transaction)
+		self.transactions.finish(transaction.tid, acked)
 
-	def __get(self, key):
-		replicas = self.replicaProxies[:]
-		done = False
-		while (not done and len(replicas) > 0):
-			ix = random.randint(0, len(replicas)-1)
-			replica = replicas[ix]
+	# Wraps func(replica), the call of a phase to a replica, so that its latency is recorded per replica.
+	# For the calls of a transaction that is still undecided, a failure or a falsy answer (for which
+	# negative is the reason) notes why the transaction is going to abort; the first reason is kept
+	def __observed(self, phase, func, transaction=None, negative=metrics.LOCK_BUSY):
+		def call(replica):
+			start = time.monotonic()
 			try:
-				value = replica.get(key)
-				done = True
+				result = func(replica)
 			except Exception as e:
-				print("Error getting value from replica")
-				print("Exception {0}".format(e))
-				del replicas[ix]
+				self.__noteAbort(transaction, metrics.abortReason(e))
+				raise
+			finally:
+				self.__recordCall(phase, replica, start)
+			if not result:
+				self.__noteAbort(transaction, negative)
+			return result
+		return call
 
+	def __recordCall(self, phase, replica, start):
+		self.metrics.record("peer.{0}.{1}".format(self.peerNames.get(id(replica)), phase), time.monotonic() - start)
 
-		if not done:
-			raise EnvironmentError("System is temporarily unavailable")
+	def __noteAbort(self, transaction, reason):
+		if transaction and not transaction.abortReason:
+			transaction.abortReason = reason
 
-		return value
+	# Counts the decision of the transaction (aborts by reason too)
+	def __count(self, transaction):
+		if transaction.state == "master-commit":
+			self.metrics.increment("commits")
+		else:
+			self.metrics.increment("aborts")
+			self.metrics.increment("aborts." + (transaction.abortReason or metrics.OTHER))
+
+	# Replicas that take part in the transaction (every replica for the ones found by recovery)
+	def __proxies(self, transaction, proxies=None):
+		proxies = proxies or self.replicaProxies
+		if transaction.participants is None:
+			return proxies
+		return [proxies[ix] for ix in transaction.participants]
+
+	def __get(self, key):
+		group = self.sharding.readOwner(key)
+		return self.routers[group].read(self.groupProxies[group], lambda replica: replica.get(key))
+
+	# Returns the cached values of keys and the read cache tokens of the rest ({key: token}, see ReadCache.lookup)
+	def __lookupMany(self, keys):
+		values = dict()
+		tokens = dict()
+		for key in keys:
+			if key in values or key in tokens:
+				continue
+			hit, result = self.cache.lookup(key) if self.cache else (False, None)
+			if hit:
+				values[key] = result
+			else:
+				tokens[key] = result
+		return values, tokens
+
+	def __fillMany(self, values, fetched, tokens):
+		for key in fetched:
+			values[key] = fetched[key]
+			if self.cache:
+				self.cache.fill(key, fetched[key], tokens[key])
 
+	# Splits keys by the group that serves them, and the keys of a group in up to one chunk per
+	# replica. Returns [(group, keys), ...]
+	def __splitKeys(self, keys):
+		groupKeys = dict()
+		for key in keys:
+			groupKeys.setdefault(self.sharding.readOwner(key), []).append(key)
+		chunks = []
+		for group, keys in groupKeys.items():
+			count = min(len(self.groupProxies[group]), (len(keys) + Master.MIN_GET_CHUNK - 1) // Master.MIN_GET_CHUNK)
+			chunks.extend((group, keys[i::count]) for i in range(count))
+		return chunks
 
+	# Compares the groups with the ones of the last run: groups appended since then get their
+	# keys from the others in the background
+	def __startSharding(self, groupsFileName, groups):
+		previous = sharding.loadGroups(groupsFileName)
+		if previous is None or previous == groups:
+			if self.workerId == 0:
+				sharding.saveGroups(groupsFileName, groups)
+			return
+		if groups[:len(previous)] != previous:
+			raise ValueError("Replica groups {0} can only be extended with new groups, not changed to {1}".format(previous, groups))
+		# the copies only hold back the writes of their own process
+		if self.workerCount > 1:
+			raise ValueError("Replica groups can only be added with a single worker")
+		print("Rebalancing from {0} to {1} replica groups".format(len(previous), len(groups)))
+		self.sharding.startRebalance(len(previous))
+		threading.Thread(target=self.__rebalance, args=(groupsFileName, groups), name="rebalance", daemon=True).start()
+
+	# Copies the keys that changed owner to their new groups, then switches the reads to the new
+	# ring and deletes the copies left in the old groups. If the master stops before the new
+	# groups are saved the whole copy runs again at the next start (copies are idempotent)
+	def __rebalance(self, groupsFileName, groups):
+		oldRing = self.sharding.oldRing
+		ring = self.sharding.ring
+		for group in range(oldRing.groupCount):
+			count = self.__scanGroup(group, lambda key: oldRing.owner(key) == group and ring.owner(key) != group, self.__copyKeys)
+			print("Rebalance copied {0} keys out of group {1}".format(count, group))
+		self.sharding.finishRebalance()
+		sharding.saveGroups(groupsFileName, groups)
+		for group in range(oldRing.groupCount):
+			count = self.__scanGroup(group, lambda key: oldRing.owner(key) == group and ring.owner(key) != group, lambda group, keys: self.__deleteKeys(group, keys))
+			print("Rebalance removed {0} moved keys from group {1}".format(count, group))
+		print("Rebalance done")
+
+	# Lists the keys of a group in batches and calls move(group, keys) with the ones that match.
+	# Returns how many matched
+	def __scanGroup(self, group, matches, move):
+		count = 0
+		cursor = ""
+		while True:
+			keys = self.__retry(lambda: self.routers[group].read(self.groupProxies[group], lambda replica: replica.keys(cursor, Master.SCAN_BATCH)))
+			if not keys:
+				return count
+			cursor = keys[-1]
+			keys = [key for key in keys if matches(key)]
+			if keys:
+				self.__retry(lambda: move(group, keys))
+				count += len(keys)
+
+	# Writes the current values of keys (read from group) to their new owners
+	def __copyKeys(self, group, keys):
+		self.sharding.beginMove(keys)
+		try:
+			values = self.routers[group].read(self.groupProxies[group], lambda replica: replica.getMany(keys))
+			ops = [["put", key, values[key]] if values[key] is not None else ["delete", key] for key in keys]
+			groupOps = dict()
+			for op in ops:
+				groupOps.setdefault(self.sharding.ring.owner(op[1]), []).append(op)
+			return self.__multi(ops, groupOps)
+		finally:
+			self.sharding.endMove(keys)
+
+	def __deleteKeys(self, group, keys):
+		# waits for the writes that were sent to the old owners before the switch
+		self.sharding.beginMove(keys)
+		try:
+			ops = [["delete", key] for key in keys]
+			# logged without ops, so the read cache doesn't take the deletes for the values of the keys
+			return self.__2phaseCommit(lambda replica, tid: replica.multi(ops, tid), recovery.RecoveryHelper.createBatchOperationString(ops), keys,
+				lambda replica, tid: replica.prepare(tid, "multi", ops), None, [group])
+		finally:
+			self.sharding.endMove(keys)
+
+	# Runs step until it succeeds (returns something other than False) and returns its result
+	def __retry(self, step):
+		while True:
+			try:
+				result = step()
+				if result is not False:
+					return result
+				print("Rebalance step aborted, retrying")
+			except Exception as e:
+				print("Error rebalancing, retrying")
+				print("Exception: {0}".format(e))
+			time.sleep(Master.REBALANCE_RETRY_DELAY)
+
+
+	@metrics.timed("phase.log")
 	def __log(self, transaction):
-		logEntry = recovery.RecoveryHelper.createTransactionLog(transaction)
-		self.logFile.write(logEntry + "\n")
-		self.logFile.flush()
+		self.logFile.append(recovery.RecoveryHelper.encodeTransaction(transaction))
+
+	# Submits a reservation of the block of tids that starts at tid to the log, without waiting for
+	# it: self.reservation is its future. A transaction without a start record (presumed abort,
+	# one-phase commit) leaves no other trace of its tid in the log, so after a crash recovery skips
+	# every reserved tid rather than hand one out again. Must be called with the tid lock held
+	def __reserveTids(self, tid):
+		self.reservedTid = tid + Master.TID_BLOCK * self.workerCount
+		self.reservation = self.logFile.submit(recovery.RecoveryHelper.encodeTransaction(transactions.Transaction(self.reservedTid, "master-reserve", "", None, None)))
 
 	def __recover(self):
 		print("Starting recovery")
-		try:
-			logFile = open(self.logFileName, "r")
-			recovery.RecoveryHelper.recoverMaster(logFile, self, self.replicaProxies)
-			logFile.close()
-		except IOError as e:
-			print("Error opening file: {0}".format(e))
+		data, records, nextSeq = checkpoint.recoveryRecords(self.logFileName)
+		if data:
+			self.idCount = data["idCount"]
+		recovery.RecoveryHelper.recoverMaster(records, self, self.replicaProxies)
+		return nextSeq
+
+	# State a checkpoint needs: the outcome index made durable, the transactions it doesn't cover and the next tid
+	def __snapshot(self):
+		with self.tidLock:
+			# the reservation record may be in a segment the checkpoint drops
+			idCount = max(self.idCount, self.reservedTid)
+		records = [recovery.RecoveryHelper.encodeTransaction(transaction) for transaction in self.transactions.snapshot()]
+		# synced after the snapshot: an outcome that moved to the index in between is in one of the two
+		self.transactions.sync()
+		return {"records": records, "idCount": idCount}
@@ -0,0 +1,179 @@
+import functools
+import inspect
+import signal
+import socket
+import threading
+import time
+
+# Reasons a transaction aborts, counted as "aborts.<reason>" by the master (and the replicas)
+LOCK_BUSY = "lockBusy"
+VOTE_NO = "voteNo"
+REPLICA_ERROR = "replicaError"
+TIMEOUT = "timeout"
+WOUNDED = "wounded"
+OTHER = "other"
+
+# Latency histogram with HDR-style log-linear buckets: every power of two (in microseconds) is
+# split into SUB_BUCKETS linear buckets, so a percentile is off by at most 1/SUB_BUCKETS of its
+# value while the whole range from 1us to hours takes a few hundred counters. Recording is a
+# couple of integer operations under a lock
+class Histogram:
+
+	SUB_BUCKET_BITS = 4
+	SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+	# values from 2^(MAX_SHIFT + SUB_BUCKET_BITS + 1) us (about 39 hours) on share the last bucket
+	MAX_SHIFT = 32
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counts = [0] * (Histogram.SUB_BUCKETS * (Histogram.MAX_SHIFT + 2))
+		self.count = 0
+		self.total = 0
+		self.min = None
+		self.max = 0
+
+	def record(self, seconds):
+		micros = max(int(seconds * 1000000), 0)
+		index = Histogram.bucketOf(micros)
+		with self.lock:
+			self.counts[index] += 1
+			self.count += 1
+			self.total += micros
+			if self.min is None or micros < self.min:
+				self.min = micros
+			if micros > self.max:
+				self.max = micros
+
+	# Highest value (in microseconds) that falls in the bucket of fraction p (0..1) of the values
+	def percentile(self, p):
+		with self.lock:
+			return self.__percentile(p)
+
+	# Count, mean, min, max and percentiles, in milliseconds
+	def snapshot(self):
+		with self.lock:
+			if not self.count:
+				return {"count": 0}
+			return {"count": self.count, "mean": self.total / self.count / 1000.0, "min": self.min / 1000.0, "max": self.max / 1000.0,
+				"p50": self.__percentile(0.5) / 1000.0, "p90": self.__percentile(0.9) / 1000.0,
+				"p99": self.__percentile(0.99) / 1000.0, "p999": self.__percentile(0.999) / 1000.0}
+
+	@staticmethod
+	def bucketOf(micros):
+		if micros < Histogram.SUB_BUCKETS:
+			return micros
+		shift = min(micros.bit_length() - Histogram.SUB_BUCKET_BITS - 1, Histogram.MAX_SHIFT)
+		return Histogram.SUB_BUCKETS * (shift + 1) + min((micros >> shift) - Histogram.SUB_BUCKETS, Histogram.SUB_BUCKETS - 1)
+
+	# Highest value of a bucket
+	@staticmethod
+	def valueOf(index):
+		if index < Histogram.SUB_BUCKETS:
+			return index
+		shift = index // Histogram.SUB_BUCKETS - 1
+		return ((index % Histogram.SUB_BUCKETS + Histogram.SUB_BUCKETS + 1) << shift) - 1
+
+	# must be called with the lock held
+	def __percentile(self, p):
+		if not self.count:
+			return 0
+		target = max(1, int(p * self.count + 0.5))
+		seen = 0
+		for index, count in enumerate(self.counts):
+			seen += count
+			if seen >= target:
+				return min(Histogram.valueOf(index), self.max)
+		return self.max
+
+# Metrics of one process: latency histograms, counters and gauges by name. Gauges are functions
+# evaluated only when the metrics are read, so they cost nothing on the request path
+class Metrics:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.histograms = dict()
+		self.counters = dict()
+		self.gauges = dict()
+
+	def histogram(self, name):
+		histogram = self.histograms.get(name)
+		if histogram is None:
+			with self.lock:
+				histogram = self.histograms.setdefault(name, Histogram())
+		return histogram
+
+	def record(self, name, seconds):
+		self.histogram(name).record(seconds)
+
+	def increment(self, name, count=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + count
+
+	# func() gives the current value of the gauge
+	def gauge(self, name, func):
+		self.gauges[name] = func
+
+	def stats(self):
+		with self.lock:
+			histograms = list(self.histograms.items())
+			counters = dict(self.counters)
+		gauges = dict()
+		for name, func in list(self.gauges.items()):
+			try:
+				gauges[name] = func()
+			except Exception as e:
+				print("Error reading gauge {0}".format(name))
+				print("Exception: {0}".format(e))
+		return {"histograms": dict((name, histogram.snapshot()) for name, histogram in histograms), "counters": counters, "gauges": gauges}
+
+	# The metrics as text, one line per histogram, counter and gauge
+	def dump(self):
+		stats = self.stats()
+		lines = []
+		for name in sorted(stats["histograms"]):
+			snapshot = stats["histograms"][name]
+			if snapshot["count"]:
+				lines.append("{0}: count={1} mean={2:.3f}ms p50={3:.3f}ms p90={4:.3f}ms p99={5:.3f}ms p999={6:.3f}ms max={7:.3f}ms".format(name, snapshot["count"],
+					snapshot["mean"], snapshot["p50"], snapshot["p90"], snapshot["p99"], snapshot["p999"], snapshot["max"]))
+		for kind in ("counters", "gauges"):
+			for name in sorted(stats[kind]):
+				lines.append("{0}: {1}".format(name, stats[kind][name]))
+		return "\n".join(lines)
+
+# Decorator that records how long each call of a method takes in the histogram name of self.metrics.
+# Works for coroutine methods too (the time until the coroutine finishes)
+def timed(name):
+	def decorate(method):
+		if inspect.iscoroutinefunction(method):
+			@functools.wraps(method)
+			async def call(self, *args, **kwargs):
+				start = time.monotonic()
+				try:
+					return await method(self, *args, **kwargs)
+				finally:
+					self.metrics.record(name, time.monotonic() - start)
+		else:
+			@functools.wraps(method)
+			def call(self, *args, **kwargs):
+				start = time.monotonic()
+				try:
+					return method(self, *args, **kwargs)
+				finally:
+					self.metrics.record(name, time.monotonic() - start)
+		return call
+	return decorate
+
+# Abort reason for a failed call to a replica
+def abortReason(e):
+	if isinstance(e, (TimeoutError, socket.timeout)):
+		return TIMEOUT
+	return REPLICA_ERROR
+
+# Prints the metrics on SIGUSR1 where the platform has it (not on Windows). The dump runs on a
+# thread of its own, the handler itself could interrupt a print of the main thread.
+# Must be called from the main thread
+def dumpOnSignal(metrics):
+	if not hasattr(signal, "SIGUSR1"):
+		return
+	def handler(signum, frame):
+		threading.Thread(target=lambda: print(metrics.dump(), flush=True), name="metrics-dump", daemon=True).start()
+	signal.signal(signal.SIGUSR1, handler)
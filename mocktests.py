@@ -2,6 +2,7 @@ import unittest
 import subprocess
 import xmlrpc.client
 import os
+import threading
 import time
 import testingbase
 from replica import Replica
@@ -312,11 +313,72 @@ class MockTests(testingbase.TestingBase):
 		self.assertEqual(None, self.masterProxy.get(key))
 
 
-	
+	def test_WhenKeyIsLockedAndReplicasWaitForLocks_PutCommitsOnceTheHolderCommits(self):
+		self._restartWith(replicaFlags="--lock-wait=10")
+		key = "somekey"
+		value = "somevalue"
+		value2 = "someothervalue"
+
+		tid = self.masterProxy.startPut(key, value)
+		self.masterProxy.execute(tid)
+		self.masterProxy.requestVotes(tid)
+
+		# the put is younger than the holder, so it waits for the lock instead of wounding it
+		results = []
+		putThread = threading.Thread(target=lambda: results.append(xmlrpc.client.ServerProxy("http://localhost:8000").put(key, value2)))
+		putThread.start()
+		time.sleep(2)
+		self.masterProxy.commit(tid)
+		putThread.join()
+
+		self.assertEqual([True], results)
+		self.assertEqual(value2, self.masterProxy.get(key))
+
+	def test_WhenYoungerBatchWaitsForAKey_OlderTransactionWoundsIt(self):
+		self._restartWith(replicaFlags="--lock-wait=5")
+
+		self.assertTrue(self.replica1Proxy.put("key2", "value", 20))
+		# the batch takes key1, then waits for key2
+		results = []
+		multiThread = threading.Thread(target=lambda: results.append(xmlrpc.client.ServerProxy("http://localhost:8888").multi([["put", "key1", "x"], ["put", "key2", "y"]], 30)))
+		multiThread.start()
+		time.sleep(1)
+
+		# older than the batch, so it aborts it instead of waiting for its lock wait to run out
+		start = time.time()
+		self.assertTrue(self.replica1Proxy.put("key1", "value", 25))
+		self.assertLess(time.time() - start, 3)
+		multiThread.join()
+		self.assertEqual([False], results)
+
+	def test_WithPresumedAbort_WhenReplicasRestartAfterVotingYesAndMasterDiedUndecided_TheyDecideAbort(self):
+		self._restartWith("--presumed-abort", "--presumed-abort")
+		key = "somekey"
+		value = "somevalue"
+		value2 = "someothervalue"
+		tid = self.masterProxy.startPut(key, value)
+		self.masterProxy.execute(tid)
+		self.masterProxy.requestVotes(tid)
+
+		# the master logged nothing for the transaction
+		self._killMaster()
+		self._killReplica1()
+		self._killReplica2()
+		self._startMaster()
+		self._startReplica1()
+		self._startReplica2()
+
+		time.sleep(Replica.TIMEOUT)
+
+		self.assertEqual(None, self.masterProxy.get(key))
+		success = self.masterProxy.put(key, value2)
+		self.assertTrue(success)
+		self.assertEqual(value2, self.masterProxy.get(key))
+
 	def tearDown(self):
 		self._cleanup()
 	
 	def _startMaster(self):
 		print("Starting master mock")
-		self.masterProcess = subprocess.Popen("startmastermock.py {0} {1} {2}".format(self.masterLogFile, self.replica1Port, self.replica2Port), shell=True)
+		self.masterProcess = subprocess.Popen("startmastermock.py {0} {1} {2}".format(self.masterLogFile, " ".join(str(port) for port in self.replicaPorts), self.masterFlags), shell=True)
 		time.sleep(1)
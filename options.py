@@ -0,0 +1,22 @@
+# Minimal command line helper shared by the start scripts: pulls "--name=value" (or "--name")
+# flags out of argv and leaves the positional arguments in place, so the existing
+# "startX logFileName port ..." usage keeps working unchanged
+def parse(argv):
+	args = []
+	flags = dict()
+	for arg in argv:
+		if arg.startswith("--"):
+			name, sep, value = arg[2:].partition("=")
+			flags[name] = value if sep else True
+		else:
+			args.append(arg)
+	return args, flags
+
+def getInt(flags, name, default):
+	return int(flags[name]) if name in flags else default
+
+def getFloat(flags, name, default):
+	return float(flags[name]) if name in flags else default
+
+def getString(flags, name, default):
+	return flags[name] if name in flags else default
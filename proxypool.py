@@ -0,0 +1,98 @@
+import concurrent.futures
+import http.client
+import queue
+import threading
+import xmlrpc.client
+
+# Calls that never wait for the key locks of the peer (votes, decisions and queries about them).
+# They don't count against the limits meant for operations, so they can't queue behind operations
+# that wait for a lock held by the very transaction they would finish
+CONTROL_METHODS = frozenset(["voteReq", "commit", "abort", "commitMany", "abortMany", "transactionState", "transactionStates"])
+
+def isControl(method):
+	return method in CONTROL_METHODS
+
+# Thread pools of a component that runs calls of both kinds: control calls get a pool of their own
+# (see CONTROL_METHODS). normal is an existing pool to use for the other calls
+class CallExecutors:
+	def __init__(self, workers, name, normal=None, controlWorkers=None):
+		self.normal = normal or concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+		self.control = concurrent.futures.ThreadPoolExecutor(max_workers=controlWorkers or workers, thread_name_prefix=name + "-control")
+
+	# Pool for a call, given whether it is a control call
+	def executor(self, control):
+		return self.control if control else self.normal
+
+	# Pool for a call of method
+	def executorFor(self, method):
+		return self.executor(isControl(method))
+
+	def shutdown(self, wait=True):
+		self.normal.shutdown(wait=wait)
+		self.control.shutdown(wait=wait)
+
+# Thread-safe stand-in for xmlrpc.client.ServerProxy. A ServerProxy can't be shared between
+# the request threads of a MultiThreadXMLRPCServer, so every call checks out a proxy of its own
+# from a per-peer pool and gives it back afterwards. Pooled proxies keep their HTTP/1.1
+# connection alive between calls, so the TCP setup is paid once per connection, not per call
+class ProxyPool:
+
+	DEFAULT_SIZE = 8
+
+	def __init__(self, url, size=DEFAULT_SIZE):
+		self.url = url
+		self.size = size
+		self.idle = queue.LifoQueue()
+		self.slots = threading.BoundedSemaphore(size)
+
+	def __getattr__(self, name):
+		if name.startswith("__"):
+			raise AttributeError(name)
+		return lambda *args: self.call(name, *args)
+
+	def call(self, method, *args):
+		bounded = not isControl(method)
+		proxy = self.__checkout(bounded)
+		healthy = True
+		try:
+			return getattr(proxy, method)(*args)
+		except xmlrpc.client.Fault:
+			# the remote method failed, but the connection itself is fine
+			raise
+		except (OSError, http.client.HTTPException, xmlrpc.client.ProtocolError):
+			healthy = False
+			raise
+		finally:
+			self.__checkin(proxy, healthy, bounded)
+
+	def close(self):
+		self.__evictIdle()
+
+	def __checkout(self, bounded):
+		if bounded:
+			self.slots.acquire()
+		try:
+			return self.idle.get_nowait()
+		except queue.Empty:
+			return xmlrpc.client.ServerProxy(self.url, allow_none=True)
+
+	def __checkin(self, proxy, healthy, bounded):
+		if healthy:
+			self.idle.put(proxy)
+		else:
+			# a broken connection most likely means the peer went away, so the idle ones are stale too
+			proxy("close")()
+			self.__evictIdle()
+		if bounded:
+			self.slots.release()
+
+	def __evictIdle(self):
+		while True:
+			try:
+				proxy = self.idle.get_nowait()
+			except queue.Empty:
+				return
+			proxy("close")()
+
+def createProxy(port, size=ProxyPool.DEFAULT_SIZE):
+	return ProxyPool("http://localhost:" + str(port), size)
@@ -0,0 +1,134 @@
+import collections
+import sys
+import threading
+
+# Entry of the read cache: the value (None for a key known to be missing), the tid of the
+# transaction that wrote it (-1 if it was filled by a read) and its approximate size in bytes
+class Entry:
+	__slots__ = ("value", "tid", "size")
+
+	def __init__(self, value, tid, size):
+		self.value = value
+		self.tid = tid
+		self.size = size
+
+# LRU cache of the master for values read from the replicas, bounded by a byte budget.
+# A write drops the keys it touches as soon as it is sent to the replicas and fills them with the
+# new values once it commits. Reads fill the cache too, but only when no write touched the key
+# while the read was in flight: a read takes a token (the current generation) before it goes to a
+# replica, every invalidation records the generation at which it happened, and a fill older than
+# the last invalidation of its key (or made while a write is pending on it) is dropped
+class ReadCache:
+
+	# bookkeeping per entry on top of the key and value
+	ENTRY_OVERHEAD = 64
+	# invalidation generations remembered per key; older ones are summarised by a floor
+	MAX_INVALIDATIONS = 65536
+
+	def __init__(self, maxBytes):
+		self.maxBytes = maxBytes
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict()
+		self.size = 0
+		self.generation = 0
+		# key -> generation of its last invalidation
+		self.invalidations = collections.OrderedDict()
+		# fills with a token below the floor are dropped (their invalidation may have been forgotten)
+		self.floor = 0
+		# key -> number of writes sent to the replicas and not decided yet
+		self.pending = dict()
+		# key -> newest tid that committed while other writes of the key were pending
+		self.latest = dict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	# Returns (True, value) on a hit, (False, token) on a miss. The token goes to fill once the read is done
+	def lookup(self, key):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				self.misses += 1
+				return False, self.generation
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return True, entry.value
+
+	def fill(self, key, value, token):
+		with self.lock:
+			if key in self.pending or token < self.floor or self.invalidations.get(key, -1) > token:
+				return
+			self.__put(key, value, -1)
+
+	# Called when the operation of a transaction is sent to the replicas
+	def invalidate(self, transaction):
+		with self.lock:
+			for key in transaction.lockedKeys():
+				self.pending[key] = self.pending.get(key, 0) + 1
+				self.__invalidate(key)
+
+	# Called once the replicas were told to commit: the values written by the transaction replace the cached ones
+	def commit(self, transaction):
+		with self.lock:
+			self.__settle(transaction)
+			for op in transaction.operations or []:
+				entry = self.entries.get(op[1])
+				if entry is not None and entry.tid > transaction.tid:
+					continue
+				self.__invalidate(op[1])
+				# another write already went out for the key, its outcome decides the value. Commits
+				# can come in out of tid order, so a newer one that was seen meanwhile keeps this one out
+				if op[1] in self.pending:
+					self.latest[op[1]] = max(self.latest.get(op[1], -1), transaction.tid)
+				elif self.latest.pop(op[1], -1) < transaction.tid:
+					self.__put(op[1], op[2] if op[0] == "put" else None, transaction.tid)
+
+	def abort(self, transaction):
+		with self.lock:
+			self.__settle(transaction)
+			for key in transaction.lockedKeys():
+				if key not in self.pending:
+					self.latest.pop(key, None)
+
+	def stats(self):
+		with self.lock:
+			return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+				"entries": len(self.entries), "bytes": self.size, "maxBytes": self.maxBytes}
+
+	# must be called with the lock held
+	def __settle(self, transaction):
+		for key in transaction.lockedKeys():
+			count = self.pending.get(key, 0) - 1
+			if count > 0:
+				self.pending[key] = count
+			else:
+				self.pending.pop(key, None)
+
+	# must be called with the lock held
+	def __invalidate(self, key):
+		self.generation += 1
+		self.__remove(key)
+		self.invalidations.pop(key, None)
+		self.invalidations[key] = self.generation
+		while len(self.invalidations) > ReadCache.MAX_INVALIDATIONS:
+			oldKey, generation = self.invalidations.popitem(last=False)
+			self.floor = generation
+
+	# must be called with the lock held
+	def __put(self, key, value, tid):
+		self.__remove(key)
+		size = ReadCache.ENTRY_OVERHEAD + sys.getsizeof(key) + sys.getsizeof(value)
+		if size > self.maxBytes:
+			return
+		self.entries[key] = Entry(value, tid, size)
+		self.size += size
+		while self.size > self.maxBytes:
+			oldKey, old = self.entries.popitem(last=False)
+			self.size -= old.size
+			self.evictions += 1
+
+	# must be called with the lock held
+	def __remove(self, key):
+		entry = self.entries.pop(key, None)
+		if entry is not None:
+			self.size -= entry.size
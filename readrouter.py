@@ -0,0 +1,203 @@
+import asyncio
+import collections
+import concurrent.futures
+import random
+import threading
+import time
+
+# Latency statistics of one replica as seen by the read router
+class ReplicaStats:
+	__slots__ = ("ewma", "outstanding", "samples")
+
+	def __init__(self, samples):
+		self.ewma = 0.0
+		self.outstanding = 0
+		self.samples = collections.deque(maxlen=samples)
+
+# Picks the replica that serves each read. Every replica keeps an EWMA of its read latency and
+# a count of outstanding reads, and a read goes to the better of two replicas chosen at random
+# (power of two choices), so a slow or overloaded replica gets less traffic without every read
+# piling onto the single fastest one. If the first answer takes longer than the hedge delay
+# (fixed, or the p95 of recent reads), a second read goes to another replica and the first
+# answer wins. Reads that take longer than the timeout are given up and retried elsewhere.
+# Replicas are referred to by their position, so the same router serves the blocking proxies of
+# the threaded master and the asyncio proxies of AsyncMaster
+class ReadRouter:
+
+	DEFAULT_TIMEOUT = 5
+	EWMA_WEIGHT = 0.2
+	SAMPLES = 256
+	HEDGE_PERCENTILE = 0.95
+	MIN_HEDGE_DELAY = 0.001
+	# adaptive hedge delay used until there are latency samples
+	INITIAL_HEDGE_DELAY = 0.05
+	# reads between two recomputations of the adaptive hedge delay
+	HEDGE_REFRESH = 32
+	# a replica with this many reads in flight is skipped while another one is available, so a hung
+	# replica can't take every thread of the pool
+	MAX_OUTSTANDING = 16
+
+	# hedge is None (no hedged reads), "p95" or a fixed delay in seconds
+	def __init__(self, replicaCount, hedge="p95", timeout=DEFAULT_TIMEOUT):
+		self.replicaStats = [ReplicaStats(ReadRouter.SAMPLES) for i in range(replicaCount)]
+		self.hedge = hedge
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=ReadRouter.MAX_OUTSTANDING * replicaCount, thread_name_prefix="reads")
+		self.adaptiveDelay = ReadRouter.INITIAL_HEDGE_DELAY
+		self.sinceRefresh = 0
+
+	# Runs func(replica) on the replicas of the list (in the order the router was built with) and
+	# returns the first answer. Raises EnvironmentError if no replica answers
+	def read(self, replicas, func):
+		tried = set()
+		pending = dict()
+		hedgeAt = self.__hedgeAt()
+
+		while True:
+			if not pending and not self.__launch(replicas, func, tried, pending, self.executor.submit):
+				raise EnvironmentError("System is temporarily unavailable")
+			done, notDone = concurrent.futures.wait(list(pending), timeout=self.__wait(pending, hedgeAt), return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				del pending[future]
+				if future.exception() is None:
+					return future.result()
+				print("Error getting value from replica")
+				print("Exception {0}".format(future.exception()))
+			if hedgeAt is not None and time.monotonic() >= hedgeAt:
+				hedgeAt = None
+				self.__hedge(replicas, func, tried, pending, self.executor.submit)
+			self.__expire(pending)
+
+	# asyncio version of read, for replicas whose calls return awaitables
+	async def readAsync(self, replicas, func):
+		tried = set()
+		pending = dict()
+		hedgeAt = self.__hedgeAt()
+		submit = lambda func, replica: asyncio.ensure_future(func(replica))
+
+		try:
+			while True:
+				if not pending and not self.__launch(replicas, func, tried, pending, submit):
+					raise EnvironmentError("System is temporarily unavailable")
+				done, notDone = await asyncio.wait(list(pending), timeout=self.__wait(pending, hedgeAt), return_when=asyncio.FIRST_COMPLETED)
+				for future in done:
+					del pending[future]
+					if future.exception() is None:
+						return future.result()
+					print("Error getting value from replica")
+					print("Exception {0}".format(future.exception()))
+				if hedgeAt is not None and time.monotonic() >= hedgeAt:
+					hedgeAt = None
+					self.__hedge(replicas, func, tried, pending, submit)
+				for future in self.__expire(pending):
+					future.cancel()
+		finally:
+			# the losers of a hedged read are dropped
+			for future in pending:
+				future.cancel()
+
+	# Hedge delay currently in use (None if reads aren't hedged)
+	def hedgeDelay(self):
+		if self.hedge is None:
+			return None
+		if self.hedge != "p95":
+			return self.hedge
+		with self.lock:
+			if self.sinceRefresh >= ReadRouter.HEDGE_REFRESH:
+				samples = sorted(sample for stats in self.replicaStats for sample in stats.samples)
+				if samples:
+					self.adaptiveDelay = max(ReadRouter.MIN_HEDGE_DELAY, samples[min(len(samples) - 1, int(len(samples) * ReadRouter.HEDGE_PERCENTILE))])
+				self.sinceRefresh = 0
+			return self.adaptiveDelay
+
+	def stats(self):
+		with self.lock:
+			return [{"ewma": stats.ewma, "outstanding": stats.outstanding} for stats in self.replicaStats]
+
+	# Power of two choices among the replicas not tried yet. Returns None if all of them were tried
+	def choose(self, exclude):
+		with self.lock:
+			candidates = [ix for ix in range(len(self.replicaStats)) if ix not in exclude]
+			available = [ix for ix in candidates if self.replicaStats[ix].outstanding < ReadRouter.MAX_OUTSTANDING]
+			candidates = available or candidates
+			if len(candidates) <= 1:
+				return candidates[0] if candidates else None
+			first, second = random.sample(candidates, 2)
+			return first if self.__score(first) <= self.__score(second) else second
+
+	def __launch(self, replicas, func, tried, pending, submit):
+		ix = self.choose(tried)
+		if ix is None:
+			return False
+		tried.add(ix)
+		with self.lock:
+			self.replicaStats[ix].outstanding += 1
+		start = time.monotonic()
+		future = submit(func, replicas[ix])
+		future.add_done_callback(lambda future: self.__finished(ix, start, future))
+		pending[future] = (ix, start)
+		return True
+
+	# The reads in flight are already slower than the hedge delay, which is also what their replicas
+	# are charged with for now (they may never answer), then the read goes to one more replica
+	def __hedge(self, replicas, func, tried, pending, submit):
+		now = time.monotonic()
+		with self.lock:
+			for ix, start in pending.values():
+				self.__record(ix, now - start)
+		self.__launch(replicas, func, tried, pending, submit)
+
+	def __finished(self, ix, start, future):
+		with self.lock:
+			self.replicaStats[ix].outstanding -= 1
+			if future.cancelled():
+				return
+			latency = time.monotonic() - start
+			# a failed replica counts as slow, so the next reads prefer the others
+			if future.exception() is not None:
+				latency = max(latency, self.timeout)
+			self.__record(ix, latency)
+
+	# Gives up on the reads that passed their deadline. Returns their futures
+	def __expire(self, pending):
+		now = time.monotonic()
+		expired = [future for future, (ix, start) in pending.items() if start + self.timeout <= now]
+		for future in expired:
+			ix = pending.pop(future)[0]
+			print("Timed out getting value from replica {0}".format(ix))
+			with self.lock:
+				self.__record(ix, self.timeout)
+		return expired
+
+	def __hedgeAt(self):
+		delay = self.hedgeDelay()
+		return None if delay is None else time.monotonic() + delay
+
+	# How long to wait for the next answer: until the hedge is due or the earliest read expires
+	def __wait(self, pending, hedgeAt):
+		wakeup = min(start for ix, start in pending.values()) + self.timeout
+		if hedgeAt is not None:
+			wakeup = min(wakeup, hedgeAt)
+		return max(0, wakeup - time.monotonic())
+
+	# must be called with the lock held
+	def __record(self, ix, latency):
+		stats = self.replicaStats[ix]
+		stats.ewma = latency if not stats.samples else (1 - ReadRouter.EWMA_WEIGHT) * stats.ewma + ReadRouter.EWMA_WEIGHT * latency
+		stats.samples.append(latency)
+		self.sinceRefresh += 1
+
+	# must be called with the lock held
+	def __score(self, ix):
+		stats = self.replicaStats[ix]
+		# a replica that hasn't answered yet has no latency, its reads in flight still count
+		return (stats.ewma + ReadRouter.MIN_HEDGE_DELAY) * (stats.outstanding + 1)
+
+# Parses the value of the --hedge flag: "off", "p95" or a delay in seconds
+def parseHedge(value):
+	if value == "off":
+		return None
+	if value == "p95":
+		return value
+	return float(value)
@@ -1,152 +1,203 @@
 import threading
+import logformat
 from transactions import Transaction
 
 # Helper class that provides functionality for recovering masters and replicas after failure by using logs
 class RecoveryHelper:
+
+	# decisions per commitMany / abortMany call when the master resends what it recovered
+	RESEND_BATCH_SIZE = 512
+
 	@staticmethod
-	# Create transaciton log string out of a transaction obj
-	def createTransactionLog(transaction):
-		logEntry = None
-		if transaction.operationString:
-			logEntry = "{0} {1} {2}".format(transaction.tid, transaction.state, transaction.operationString)
-		else:
-			logEntry = "{0} {1}".format(transaction.tid, transaction.state)
-		return logEntry
+	# Encodes a transaction obj as a binary log record (see logformat)
+	def encodeTransaction(transaction):
+		return logformat.encode(transaction.tid, transaction.state, transaction.operations)
 
 	@staticmethod
-	# Creates a transaction obj out of log entry string
+	# Creates a transaction obj out of a text log entry (logs written before the binary format)
 	def parseTransactionLog(logEntry):
+		entry = RecoveryHelper.parseLogEntry(logEntry)
+		if entry:
+			return RecoveryHelper.createTransaction(*entry)
+		return None
+
+	@staticmethod
+	# Splits a text log entry into (tid, state, operations or None). Returns None for malformed entries
+	def parseLogEntry(logEntry):
 		logParts = logEntry.split()
-		trAction = None
-		
-		if len(logParts) >= 3:
-			print("Transaction id string: {0}".format(logParts[0]))
-			tid = int(logParts[0])
-			state = logParts[1]
-			operation = logParts[2]
-			print("Parsing transaction with tid: {0}, state: {1}, operation: {2}".format(tid, state, operation))
-			if state == "master-start-2PC" or state == "master-abort":
-				action = lambda replica: replica.abort(tid)
-				trAction = Transaction(tid, "master-abort", "", action, "") 
-			elif state == "master-commit":
-				action = lambda replica: replica.commit(tid)
-				trAction = Transaction(tid, state, "", action, "") 
-			elif state == "replica-commit":
-				if operation == "delete":
-					if len(logParts) >= 4:
-						key = logParts[3]
-						action = lambda store: store.delete(key)	
-						trAction = Transaction(tid, state, "delete {0}".format(key), action, key)
-				elif operation == "put":
-					if len(logParts) >= 5:
-						key = logParts[3]
-						value = logParts[4]
-						action = lambda store: store.put(key, value)
-						trAction = Transaction(tid, state, "put {0} {1}".format(key, value), action, key)
-			elif state == "replica-yes":
-				if operation == "delete":
-					if len(logParts) >= 4:
-						key = logParts[3]
-						action = lambda store: store.delete(key)	
-						trAction = Transaction(tid, state, "delete {0}".format(key), action, key)
-				elif operation == "put":
-					if len(logParts) >= 5:
-						key = logParts[3]
-						value = logParts[4]
-						action = lambda store: store.put(key, value)
-						trAction = Transaction(tid, state, "put {0} {1}".format(key, value), action, key)
+		# master decisions may come without the operation (e.g. the outcomes kept in a checkpoint)
+		if len(logParts) < 2 or not logParts[0].isdigit():
+			return None
+		tid = int(logParts[0])
+		state = logParts[1]
+		return tid, state, RecoveryHelper.parseOperation(logParts[2:])
+
+	@staticmethod
+	# Operations described by the operation part of a text log entry, or None if there is none
+	def parseOperation(opParts):
+		if len(opParts) >= 2 and opParts[0] == "delete":
+			return [["delete", opParts[1]]]
+		elif len(opParts) >= 3 and opParts[0] == "put":
+			return [["put", opParts[1], opParts[2]]]
+		elif len(opParts) >= 1 and opParts[0] == "multi":
+			return RecoveryHelper.parseBatchOperations(opParts[1:])
+		return None
+
+	@staticmethod
+	# Creates the transaction obj recovery works with out of a decoded log record.
+	# Returns None for records recovery doesn't need
+	def createTransaction(tid, state, ops):
+		if state == "master-start-2pc" or state == "master-abort":
+			action = lambda replica: replica.abort(tid)
+			return Transaction(tid, "master-abort", "", action, "")
+		elif state == "master-commit":
+			action = lambda replica: replica.commit(tid)
+			return Transaction(tid, state, "", action, "")
+		elif (state == "replica-commit" or state == "replica-yes") and ops:
+			return RecoveryHelper.createOperationTransaction(tid, state, ops)
+		elif state == "replica-abort":
+			# supersedes the replica-yes record of the same transaction
+			return Transaction(tid, state, "", None, "")
+		elif state == "master-reserve":
+			# tids below this one may have been handed out without a start record
+			return Transaction(tid, state, "", None, "")
+		# replica-no and replica-read-only records leave nothing to recover
+		return None
+
+	@staticmethod
+	# Transaction obj whose action applies ops ([["put", key, value], ["delete", key], ...]) to a store
+	def createOperationTransaction(tid, state, ops):
+		if len(ops) == 1:
+			operationString = " ".join(str(part) for part in ops[0])
+		else:
+			operationString = RecoveryHelper.createBatchOperationString(ops)
+		return Transaction(tid, state, operationString, RecoveryHelper.createBatchAction(ops), RecoveryHelper.batchKeys(ops), ops)
+
+	@staticmethod
+	# Compact operation string for a batch: "multi put k1 v1 delete k2 ..."
+	def createBatchOperationString(ops):
+		return "multi " + " ".join(" ".join(str(part) for part in op) for op in ops)
+
+	@staticmethod
+	# Inverse of createBatchOperationString (without the leading "multi"). Returns None if the record is cut short
+	def parseBatchOperations(parts):
+		ops = []
+		i = 0
+		while i < len(parts):
+			if parts[i] == "put" and i + 2 < len(parts):
+				ops.append(["put", parts[i+1], parts[i+2]])
+				i += 3
+			elif parts[i] == "delete" and i + 1 < len(parts):
+				ops.append(["delete", parts[i+1]])
+				i += 2
 			else:
-				print("Nothing required for state: {0}", state)
+				print("Malformed batch operation at: {0}".format(parts[i:]))
+				return None
+		return ops
 
-		return trAction
+	@staticmethod
+	# Store action that applies all the operations of a batch in order
+	def createBatchAction(ops):
+		def action(store):
+			for op in ops:
+				if op[0] == "put":
+					store.put(op[1], op[2])
+				else:
+					store.delete(op[1])
+		return action
 
 	@staticmethod
-	def recoverMaster(logFile, master, replicas):
-		trActions = RecoveryHelper.parseTransactions(logFile)
+	def batchKeys(ops):
+		keys = []
+		for op in ops:
+			if op[1] not in keys:
+				keys.append(op[1])
+		return keys
 
-		# Execute them
+	@staticmethod
+	# records is any iterable of transaction objs decoded from the log (see checkpoint.recoveryRecords).
+	# The recovered decisions stay in the master's transaction table and are resent to the replicas by a
+	# background thread (see resendDecisions), so the master accepts new transactions right away
+	# Reservation records keep the tids of transactions that left no record (presumed abort, one-phase
+	# commit) from being handed out again
+	def recoverMaster(records, master, replicas):
+		reserved = [transaction.tid for transaction in records if transaction.state == "master-reserve"]
+		if reserved:
+			master.idCount = max(master.idCount, max(reserved))
+		trActions = RecoveryHelper.parseTransactions(transaction for transaction in records if transaction.state != "master-reserve")
+
+		commits = []
+		aborts = []
 		for tid in trActions:
 			trAction = trActions[tid]
 			master.transactions[tid] = trAction
-			print("Executing action {0} {1} in all replicas".format(trAction.state, trAction.operationString))
-			if trAction.action:
-				for replica in replicas:
-					try:
-						threading.Thread(target=trAction.action, args=[replica]).start()
-					except Exception as e:
-						print("Error sendint recovery action to one of the replicas")
-						print("Exception: {0}".format(e))
-						pass
+			if trAction.state == "master-commit":
+				commits.append(tid)
+			else:
+				aborts.append(tid)
 
 		tids = trActions.keys()
 		if len(tids) > 0:
-			master.idCount = max(tids) + 1
-		print("Finished recovery...clearing log")
+			master.idCount = max(master.idCount, max(tids) + 1)
+			threading.Thread(target=RecoveryHelper.resendDecisions, args=[master, replicas, commits, aborts], name="recovery", daemon=True).start()
+		print("Finished recovery: {0} commit and {1} abort decisions to resend".format(len(commits), len(aborts)))
+
+	@staticmethod
+	# Sends the recovered decisions to the replicas with batched commitMany / abortMany calls, one batch
+	# in flight per replica at a time. A tid is finished once its batch went out: if every replica acked
+	# it the outcome goes straight to the index, otherwise it is retained for the replicas' termination protocol
+	def resendDecisions(master, replicas, commits, aborts):
+		total = len(commits) + len(aborts)
+		sent = 0
+		for method, tids in [("commitMany", commits), ("abortMany", aborts)]:
+			for i in range(0, len(tids), RecoveryHelper.RESEND_BATCH_SIZE):
+				batch = tids[i:i + RecoveryHelper.RESEND_BATCH_SIZE]
+				acked = True
+				for replica, result, e in master.dispatcher.broadcast(replicas, lambda replica: getattr(replica, method)(batch), control=True):
+					if e is not None:
+						print("Error sending recovered decisions to one of the replicas")
+						print("Exception: {0}".format(e))
+						acked = False
+				for tid in batch:
+					master.transactions.finish(tid, acked)
+				sent += len(batch)
+				print("Recovery: resent {0}/{1} decisions".format(sent, total))
 
 	@staticmethod
-	def recoverReplica(logFile, replica, store):
-		trActions = RecoveryHelper.parseTransactions(logFile)
+	# Applies the committed transactions and re-registers the ones that voted yes and never heard
+	# the decision, with their keys locked. Returns the tids of the latter: instead of blocking on the
+	# master for each of them, the caller hands them to the termination service once it can log, and
+	# they are resolved with batched queries while the replica already serves other keys
+	def recoverReplica(records, replica, store):
+		trActions = RecoveryHelper.parseTransactions(records)
 
-		# Execute them
+		committed = 0
+		inDoubt = []
 		for tid in trActions:
 			trAction = trActions[tid]
-			print("Executing action {0} {1}".format(trAction.state, trAction.operationString))
 			if trAction.state == "replica-commit":
 				if trAction.action:
 					try:
 						trAction.action(store)
+						committed += 1
 					except Exception as e:
 						print("Error executing aciton")
 						print("Exception: {0}".format(e))
 						pass
 			elif trAction.state == "replica-yes":
-				#contact master (block until response)
-				#if the transaction is committed, execute action
-				#if the state is votereq, add transaction to list 
-				#   (and replica will wait for commit/abort)
-				#if aborted, don't do anything
-
-				trMasterState = None
-				print("Transaction was in uncertainty state, so contacting master")
-				while (not trMasterState):
-					try:
-						trMasterState = replica.masterProxy.transactionState(trAction.tid)
-					except Exception as e:
-						print("Error contacting master")
-						print("Exception: {0}".format(e))
-						pass
+				# keys in doubt stay locked until the master tells how the transaction ended
+				if not replica.locks.acquire(trAction.lockedKeys(), tid, 0):
+					print("Keys of transaction {0} are already locked".format(tid))
+				replica.transactions[tid] = trAction
+				inDoubt.append(tid)
 
-				if trMasterState == "master-commit":	
-					print("Master commited, so executing action")
-					if trAction.action:
-						try:
-							trAction.action(store)
-						except Exception as e:
-							print("Error executing aciton")
-							print("Exception: {0}".format(e))
-							pass
-				elif trMasterState == "master-start-2pc":
-					print("Master hasn't commited yet, so keep the transaciton active (but add timeout)")
-					replica._Replica__acquireKeyLock(trAction.key)
-					replica.transactions[trAction.tid] = trAction
-					replica._Replica__scheduleTerminateProtocol(trAction)
-				else:
-					print("Master said that transaction was in {0} so not doing anything".format(trMasterState))
-
-
-		print("Finished recovery...clearing log")
+		print("Finished recovery: {0} transactions applied, {1} in uncertainty state".format(committed, len(inDoubt)))
+		return inDoubt
 
 	@staticmethod
-	def parseTransactions(logFile):
+	# Keeps the latest record of every transaction
+	def parseTransactions(records):
 		trActions = dict()
-		while 1:
-			line = logFile.readline()
-			if not line:
-				break
-			transaction = RecoveryHelper.parseTransactionLog(line)
-			if (transaction):
-				trActions[transaction.tid] = transaction
-			else:
-				print("Log entry not associated to an action: {0}".format(line))
+		for transaction in records:
+			trActions[transaction.tid] = transaction
 		return trActions
-
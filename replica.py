@@ -1,36 +1,62 @@
 import keyvaluestore 
 import threading 
+import concurrent.futures
 import transactions
 import recovery
+import grouplog
+import scheduler
+import termination
+import checkpoint
+import lockmanager
+import metrics
+
+# stands for the log record of a decision that isn't logged (aborts in presumed abort mode)
+notLogged = concurrent.futures.Future()
+notLogged.set_result(None)
 
 class Replica:
 
 	TIMEOUT = 10
 
-	def __init__(self, logFileName, dbName, port, masterProxy):
-		self.store = keyvaluestore.KeyValueStore(dbName)
+	def __init__(self, logFileName, dbName, port, masterProxy, logBatchSize=grouplog.GroupCommitLog.DEFAULT_BATCH_SIZE, logMaxWait=grouplog.GroupCommitLog.DEFAULT_MAX_WAIT,
+			checkpointInterval=checkpoint.Checkpointer.DEFAULT_INTERVAL, segmentSize=checkpoint.Checkpointer.DEFAULT_SEGMENT_SIZE, storageEngine=keyvaluestore.LOG,
+			lockWait=lockmanager.LockManager.DEFAULT_WAIT, presumedAbort=False):
+		# latency of every call from the master and of the log flushes, vote and abort counters; see stats
+		self.metrics = metrics.Metrics()
+		self.store = keyvaluestore.createStore(storageEngine, dbName)
 		self.port = port
 		self.masterProxy = masterProxy
-		self.keyLocksDict = dict()
-		self.keyLocksDictLock = threading.Lock()
+		# a write on a busy key waits up to lockWait seconds for it (older transactions abort younger ones that haven't voted)
+		self.locks = lockmanager.LockManager(self.__wound)
+		self.lockWait = lockWait
+		# presumed abort: aborts and no votes aren't logged, a voted transaction without an outcome
+		# record is asked about after a crash (and the master answers abort for a tid it has no record of)
+		self.presumedAbort = presumedAbort
+		# tid -> [lock, number of threads holding or waiting for it]; dropped when the count gets back to 0
 		self.transactionLocksDict = dict()
 		self.transactionLocksDictLock = threading.Lock()
 
 		self.transactions = dict()
+		# one thread drives the timeouts of every transaction
+		self.timers = scheduler.TimerWheel()
+		# asks the master (in batches, with backoff) about transactions that voted yes and never heard back
+		self.termination = termination.TerminationService(masterProxy, self.__terminate)
 		self.logFileName = logFileName
-		self.__recover()
-		self.logFile = open(self.logFileName, "w")
+		nextSeq, inDoubt = self.__recover()
+		self.logFile = grouplog.GroupCommitLog(checkpoint.segmentName(self.logFileName, nextSeq), "ab", logBatchSize, logMaxWait, self.metrics)
+		self.checkpointer = checkpoint.Checkpointer(self.logFileName, self.logFile, nextSeq + 1, self.__snapshot, checkpointInterval, segmentSize)
+		self.checkpointer.checkpoint()
+		# the outcome of these can only be logged now that the log is open
+		self.termination.addMany(inDoubt, 0)
+		self.metrics.gauge("staged", lambda: sum(1 for transaction in list(self.transactions.values()) if transaction.state == "operate"))
+		self.metrics.gauge("voted", lambda: sum(1 for transaction in list(self.transactions.values()) if transaction.state == "replica-yes"))
+		self.metrics.gauge("keyLocks", lambda: len(self.locks))
+		self.metrics.gauge("inDoubt", lambda: len(self.termination))
 	
+	@metrics.timed("put")
 	def put(self, key, value, tid):
-		success = False
-		if self.__acquireKeyLock(key):
-			action = lambda s: s.put(key, value)	
-			transaction = transactions.Transaction(tid, "operate", "put {0} {1}".format(key, value), action, key)
-			self.transactions[tid] = transaction
-			timer = threading.Timer(Replica.TIMEOUT, self.__tryAbort, args=[transaction])
-			timer.start()
-			success = True
-		else:
+		success = self.__stage(tid, [["put", key, value]])
+		if not success:
 			print("Lock not acquired for put {0} {1}".format(key, value))
 
 		return success
@@ -40,27 +66,79 @@ class Replica:
 		# gets will continue to be served in parallel and will eventually be consistent
 		return self.store.get(key)	
 
+	# Values of many keys in one call ({key: value}, None for missing keys)
+	def getMany(self, keys):
+		return self.store.getMany(keys)
+
+	# Up to limit keys of the store that sort after afterKey, in order (the master lists the keys of a
+	# group with it when rebalancing)
+	def keys(self, afterKey, limit):
+		return self.store.keys(afterKey, limit)
+
+	@metrics.timed("delete")
 	def delete(self, key, tid):
-		success = False
-		if self.__acquireKeyLock(key):
-			action = lambda s: s.delete(key)	
-			transaction = transactions.Transaction(tid, "operate", "delete {0}".format(key), action, key)
-			self.transactions[tid] = transaction
-			timer = threading.Timer(Replica.TIMEOUT, self.__tryAbort, args=[transaction])
-			timer.start()
-			success = True
-		else:
+		success = self.__stage(tid, [["delete", key]])
+		if not success:
 			print("Lock not acquired for delete {0}".format(key))
 
 		return success
 
+	# Stages all the operations of a batch ([["put", key, value], ["delete", key], ...]) under a single tid.
+	# Either every key of the batch gets locked or none of them does
+	@metrics.timed("multi")
+	def multi(self, ops, tid):
+		success = self.__stage(tid, ops)
+		if not success:
+			print("Locks not acquired for batch of {0} operations".format(len(ops)))
+
+		return success
+
+	# Stages the operation and votes on it in one call, collapsing the operate and voteReq round trips.
+	# op is "put", "delete" or "multi" (in which case key holds the list of operations of the batch).
+	# The vote is logged as the usual replica-yes record, which carries the operation for recovery
+	@metrics.timed("prepare")
+	def prepare(self, tid, op, key, value=None):
+		if op == "put":
+			self.put(key, value, tid)
+		elif op == "delete":
+			self.delete(key, tid)
+		elif op == "multi":
+			self.multi(key, tid)
+		else:
+			print("Unknown operation {0} in prepare".format(op))
+		# votes no (and logs replica-no) if the operation could not be staged
+		return self.voteReq(tid)
+
+	# One-phase commit, used by the master when this replica is the only participant: stages the
+	# operations and commits them right away, without a vote. Returns False if they could not be
+	# staged. The replica is never in doubt, so the master keeps no record of the transaction
+	@metrics.timed("executeAndCommit")
+	def executeAndCommit(self, tid, ops):
+		if not self.__stage(tid, ops):
+			print("Locks not acquired for one-phase commit of {0} operations".format(len(ops)))
+			return False
+		transaction, logged = self.__decide(tid, "replica-read-only" if self.__changesNothing(self.transactions[tid]) else "replica-commit", "operate")
+		if not transaction:
+			# timed out or wounded in between
+			return False
+		logged.result()
+		self.locks.release(transaction.lockedKeys(), tid)
+		print("Transaction committed in one phase")
+		return True
+
+	# Votes True (yes), False (no) or transactions.READ_ONLY
+	@metrics.timed("voteReq")
 	def voteReq(self, tid):
 		success = False
+		readOnly = False
 		self.__acquireTransactionLock(tid)
-		if tid in self.transactions:
+		if tid in self.transactions and self.__changesNothing(self.transactions[tid]):
+			readOnly = True
+		elif tid in self.transactions:
 			print("Transaction found, voting Yes")
 			transaction = self.transactions[tid]
 			transaction.state = "replica-yes"
+			self.timers.cancel(transaction.timer)
 			self.__log(transaction)
 
 			# after voting yes, the replica cannot take a decision anymore, and so after a timeout
@@ -69,117 +147,204 @@ class Replica:
 			success = True
 		else:
 			print("Transaction not found, voting No")
-			transaction = transactions.Transaction(tid, "replica-no", None, None, None)
-			self.__log(transaction)
+			if not self.presumedAbort:
+				transaction = transactions.Transaction(tid, "replica-no", None, None, None)
+				self.__log(transaction)
 
 		self.__releaseTransactionLock(tid)
+		if readOnly:
+			return self.__voteReadOnly(tid)
+		self.metrics.increment("votes.yes" if success else "votes.no")
 		return success
 		
+	# Latency histograms (in milliseconds) of the calls from the master and of the log flushes,
+	# vote and abort counters, and gauges of the transactions in progress
+	def stats(self):
+		return self.metrics.stats()
+
+	# Contention counters of the key locks
+	def lockStats(self):
+		return self.locks.stats()
+
+	# Sizes of the per-key and per-transaction tables, which go back to 0 on an idle replica
+	def tableSizes(self):
+		with self.transactionLocksDictLock:
+			transactionLocks = len(self.transactionLocksDict)
+		return {"transactions": len(self.transactions), "transactionLocks": transactionLocks, "keyLocks": len(self.locks),
+			"timers": len(self.timers), "termination": len(self.termination), "terminationQueue": self.termination.queued()}
+
+	@metrics.timed("commit")
 	def commit(self, tid):
-		success = False
-		# Note that the transaction lock is not needed (neither is a check for state==replica-yes
-		# because the master can never commit unless the replica already voted yes
-		if tid in self.transactions:
-			print("Transaction found, executing")
-			transaction = self.transactions[tid]
-			transaction.state = "replica-commit"
-			self.__log(transaction)
-			transaction.action(self.store)
-			self.__releaseKeyLock(transaction.key)
-			del self.transactions[tid]
-			success = True
-			print("Transaction successful!") 
-		else:
-			print("Transaction not found, likely executed already")
-		return success
+		transaction, logged = self.__decide(tid, "replica-commit")
+		if transaction:
+			logged.result()
+			self.locks.release(transaction.lockedKeys(), transaction.tid)
+			print("Transaction successful!")
+		return transaction is not None
 
+	@metrics.timed("abort")
 	def abort(self, tid):
+		transaction, logged = self.__decide(tid, "replica-abort")
+		if transaction:
+			logged.result()
+			self.locks.release(transaction.lockedKeys(), transaction.tid)
+		return True
+
+	# Batched commit used by the master to resend the decisions it recovered. The records of the
+	# whole batch share one group commit
+	@metrics.timed("commitMany")
+	def commitMany(self, tids):
+		return self.__decideMany(tids, "replica-commit")
+
+	@metrics.timed("abortMany")
+	def abortMany(self, tids):
+		return self.__decideMany(tids, "replica-abort")
+
+	def __decideMany(self, tids, state):
+		decided = [self.__decide(tid, state) for tid in tids]
+		for transaction, logged in decided:
+			if transaction:
+				logged.result()
+				self.locks.release(transaction.lockedKeys(), transaction.tid)
+		return True
+
+	# Applies (on commit) and submits the log record with the outcome of a transaction. Returns the
+	# transaction and the future of its record, or (None, None) if the transaction is not known (already
+	# decided) or isn't in the expected state. Its keys stay locked: the caller releases them once the record is durable
+	def __decide(self, tid, state, expected=None):
+		transaction = None
+		logged = None
+		# Note that there is no need to check for state==replica-yes because the master can never commit
+		# unless the replica already voted yes. The transaction lock is still needed because the decision can
+		# arrive from the master and from the termination protocol at the same time
 		self.__acquireTransactionLock(tid)
-		if tid in self.transactions:
-			print("Transaction found, aborting")
+		if tid in self.transactions and expected and self.transactions[tid].state != expected:
+			print("Transaction {0} is {1} already".format(tid, self.transactions[tid].state))
+		elif tid in self.transactions:
 			transaction = self.transactions[tid]
-			transaction.state = "replica-abort"
-			self.__log(transaction)
-			self.__releaseKeyLock(transaction.key)
+			print("Transaction found, {0}".format({"replica-commit": "executing", "replica-abort": "aborting"}.get(state, "releasing")))
+			transaction.state = state
+			if state == "replica-abort":
+				# it may still be waiting for some of its keys
+				self.locks.cancel(tid)
+			self.timers.cancel(transaction.timer)
+			self.termination.remove(tid)
+			if state == "replica-commit":
+				# applied before the record is logged, so that a checkpoint taken once the record is durable
+				# already finds the change in the store (replaying the commit after a crash is harmless)
+				transaction.action(self.store)
+			# (replica-read-only is only logged when replica-no is)
+			if self.presumedAbort and state in ("replica-abort", "replica-read-only"):
+				logged = notLogged
+			else:
+				logged = self.logFile.submit(recovery.RecoveryHelper.encodeTransaction(transaction))
 			del self.transactions[tid]
 		else:
 			print("Transaction not found, likely executed already")
 		self.__releaseTransactionLock(tid)
-		return True
+		return transaction, logged
+
+	# Whether committing the transaction would leave the store as it is: every operation is the
+	# delete of a missing key (its lock keeps the key from being created meanwhile)
+	def __changesNothing(self, transaction):
+		if not transaction.operations or any(op[0] != "delete" for op in transaction.operations):
+			return False
+		return all(value is None for value in self.store.getMany(transaction.lockedKeys()).values())
+
+	# Finishes a transaction that changes nothing at the vote: its locks are released and the
+	# master leaves the replica out of the commit phase
+	def __voteReadOnly(self, tid):
+		transaction, logged = self.__decide(tid, "replica-read-only", "operate")
+		if not transaction:
+			# aborted (timed out or wounded) before the vote
+			return False
+		logged.result()
+		self.locks.release(transaction.lockedKeys(), tid)
+		print("Transaction changes nothing, voted read-only")
+		self.metrics.increment("votes.readOnly")
+		return transactions.READ_ONLY
+
+	# Registers the transaction and locks the keys of its operations. It aborts unless the vote request
+	# arrives in time. It is registered first so that an older transaction can wound it while it still
+	# waits for some of its keys (the abort cancels the acquire)
+	def __stage(self, tid, ops):
+		transaction = recovery.RecoveryHelper.createOperationTransaction(tid, "operate", ops)
+		self.transactions[tid] = transaction
+		acquired = self.locks.acquire(transaction.lockedKeys(), tid, self.lockWait)
+		self.__acquireTransactionLock(tid)
+		# False if it was aborted meanwhile, which released its keys
+		staged = self.transactions.get(tid) is transaction
+		if staged and not acquired:
+			del self.transactions[tid]
+		elif staged:
+			transaction.timer = self.timers.schedule(Replica.TIMEOUT, self.__tryAbort, transaction)
+		self.__releaseTransactionLock(tid)
+		if staged and not acquired:
+			self.metrics.increment("aborts." + metrics.LOCK_BUSY)
+		return staged and acquired
 
 	def __recover(self):
 		print("Starting recovery")
-		try:
-			logFile = open(self.logFileName, "r")
-			recovery.RecoveryHelper.recoverReplica(logFile, self, self.store)
-			logFile.close()
-		except IOError as e:
-			print("Error opening file: {0}".format(e))
+		data, records, nextSeq = checkpoint.recoveryRecords(self.logFileName)
+		inDoubt = recovery.RecoveryHelper.recoverReplica(records, self, self.store)
+		return nextSeq, inDoubt
+
+	# State a checkpoint needs: the store flushed to disk and the transactions still waiting for a decision
+	def __snapshot(self):
+		self.store.sync()
+		records = [recovery.RecoveryHelper.encodeTransaction(transaction) for transaction in list(self.transactions.values()) if transaction.state == "replica-yes"]
+		return {"records": records}
 
 	def __log(self, transaction):
-		logEntry = recovery.RecoveryHelper.createTransactionLog(transaction)
-		self.logFile.write(logEntry + "\n")
-		self.logFile.flush()
-
-	def __acquireKeyLock(self, key):
-		# Note that this there won't be a deadlock because the inner lock will never block
-		with self.keyLocksDictLock:
-			if key in self.keyLocksDict:
-				return self.keyLocksDict[key].acquire(blocking=False)
-			else:
-				lock = threading.Lock()
-				lock.acquire()
-				self.keyLocksDict[key] = lock
-				return True
-
-	def __releaseKeyLock(self, key):
-		with self.keyLocksDictLock:
-			self.keyLocksDict[key].release()
-		
+		self.logFile.append(recovery.RecoveryHelper.encodeTransaction(transaction))
+
 	def __acquireTransactionLock(self, tid):
-		lock = None
 		with self.transactionLocksDictLock:
-			if tid in self.transactionLocksDict:
-				lock = self.transactionLocksDict[tid]
-			else:
-				lock = threading.Lock()
-				self.transactionLocksDict[tid] = lock
-		lock.acquire()
+			entry = self.transactionLocksDict.get(tid)
+			if entry is None:
+				entry = self.transactionLocksDict[tid] = [threading.Lock(), 0]
+			entry[1] += 1
+		entry[0].acquire()
 
 	def __releaseTransactionLock(self, tid):
 		with self.transactionLocksDictLock:
-			self.transactionLocksDict[tid].release()
+			entry = self.transactionLocksDict[tid]
+			entry[0].release()
+			entry[1] -= 1
+			if entry[1] == 0:
+				del self.transactionLocksDict[tid]
 
 	def __scheduleTerminateProtocol(self, transaction):
-		timer = threading.Timer(Replica.TIMEOUT, self.__terminateProtocol, args=[transaction])
-		timer.start()
+		self.termination.add(transaction.tid, Replica.TIMEOUT)
 
 	def __tryAbort(self, transaction):
 		# if transaction is still blocked waiting for the vote request, abort
 		if transaction.state == "operate":
 			print("Timed out waiting for votereq, so abort")
-			self.abort(transaction.tid)
-
-	def __terminateProtocol(self, transaction):
-		trMasterState = None
-		print("Transaction was in uncertainty state, so contacting master")
-		while (not trMasterState and transaction.state == "replica-yes"):
-			try:
-				trMasterState = self.masterProxy.transactionState(transaction.tid)
-			except Exception as e:
-				print("Error contacting master")
-				print("Exception: {0}".format(e))
-				pass
-
-		# if got state from polling replica, execute termination, otherwise the commit/abort was received
-		if trMasterState:
-			if trMasterState == "master-commit":	
-				print("Master commited, so commit")
-				self.commit(transaction.tid)
-			elif trMasterState == "master-start-2pc":
-				print("Master taking its time, so keep waiting")
-				timer = threading.Timer(Replica.TIMEOUT, self.__terminateProtocol, args=[transaction])
-				timer.start()
-			else:
-				print("Master said {0} so abort".format(trMasterState))
-				self.abort(transaction.tid)
+			if self.__abortUnvoted(transaction.tid):
+				self.metrics.increment("aborts." + metrics.TIMEOUT)
+
+	# Wound-wait: an older transaction waiting for a key aborts the younger holder, unless it voted already
+	def __wound(self, tid):
+		if self.__abortUnvoted(tid):
+			print("Transaction {0} wounded by an older one".format(tid))
+			self.metrics.increment("aborts." + metrics.WOUNDED)
+			return True
+		return False
+
+	# Aborts the transaction if it hasn't voted yet. Returns whether it did
+	def __abortUnvoted(self, tid):
+		transaction, logged = self.__decide(tid, "replica-abort", "operate")
+		if transaction:
+			logged.result()
+			self.locks.release(transaction.lockedKeys(), tid)
+		return transaction is not None
+
+	# Called by the termination service once the master has decided on a transaction in uncertainty state
+	def __terminate(self, tid, trMasterState):
+		if trMasterState == "master-commit":	
+			print("Master commited, so commit")
+			self.commit(tid)
+		else:
+			print("Master said {0} so abort".format(trMasterState))
+			self.abort(tid)
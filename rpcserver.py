@@ -1,6 +1,21 @@
+import socket
 from socketserver import ThreadingMixIn
-from xmlrpc.server import SimpleXMLRPCServer
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+# Speaks HTTP/1.1 so that pooled proxies can keep their connection open between calls
+class KeepAliveXMLRPCRequestHandler(SimpleXMLRPCRequestHandler):
+	protocol_version = "HTTP/1.1"
 
 # Extends the XML RPC server to make it multi-threaded
 class MultiThreadXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
-	pass
+	daemon_threads = True
+
+	# reusePort lets the worker processes of the master listen on the same port
+	def __init__(self, addr, requestHandler=KeepAliveXMLRPCRequestHandler, reusePort=False, **kwargs):
+		self.reusePort = reusePort
+		SimpleXMLRPCServer.__init__(self, addr, requestHandler=requestHandler, **kwargs)
+
+	def server_bind(self):
+		if self.reusePort:
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		SimpleXMLRPCServer.server_bind(self)
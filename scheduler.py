@@ -0,0 +1,95 @@
+import concurrent.futures
+import threading
+import time
+
+# Handle returned by TimerWheel.schedule, used to cancel the timer
+class Timer:
+	__slots__ = ("func", "args", "slot", "rounds")
+
+	def __init__(self, func, args, slot, rounds):
+		self.func = func
+		self.args = args
+		# index of the wheel slot holding the timer (None once it fired or was cancelled)
+		self.slot = slot
+		# full turns of the wheel left before the timer is due
+		self.rounds = rounds
+
+# Hashed timer wheel: a single thread drives all the timeouts of a node instead of one
+# threading.Timer (and so one OS thread) per timeout. Scheduling and cancelling are O(1);
+# timers fire with a resolution of one tick. Expired callbacks run on a small pool so that a slow
+# callback doesn't delay the rest of the wheel
+class TimerWheel:
+
+	DEFAULT_TICK = 0.1
+	DEFAULT_SIZE = 512
+	CALLBACK_WORKERS = 4
+
+	def __init__(self, tick=DEFAULT_TICK, size=DEFAULT_SIZE):
+		self.tick = tick
+		self.slots = [set() for i in range(size)]
+		self.current = 0
+		self.count = 0
+		self.lock = threading.Lock()
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=TimerWheel.CALLBACK_WORKERS, thread_name_prefix="timer")
+		self.thread = threading.Thread(target=self.__run, name="timer-wheel", daemon=True)
+		self.thread.start()
+
+	# Runs func(*args) after delay seconds (rounded up to a whole tick)
+	def schedule(self, delay, func, *args):
+		ticks = max(1, int(-(-delay // self.tick)))
+		with self.lock:
+			slot = (self.current + ticks) % len(self.slots)
+			timer = Timer(func, args, slot, (ticks - 1) // len(self.slots))
+			self.slots[slot].add(timer)
+			self.count += 1
+		return timer
+
+	# Returns True if the timer was still pending
+	def cancel(self, timer):
+		if timer is None:
+			return False
+		with self.lock:
+			if timer.slot is None:
+				return False
+			self.slots[timer.slot].discard(timer)
+			timer.slot = None
+			# the callback often refers back to the owner of the timer
+			timer.func = timer.args = None
+			self.count -= 1
+			return True
+
+	def __len__(self):
+		return self.count
+
+	def __run(self):
+		nextTick = time.monotonic() + self.tick
+		while True:
+			delay = nextTick - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+			nextTick += self.tick
+
+			expired = []
+			with self.lock:
+				self.current = (self.current + 1) % len(self.slots)
+				slot = self.slots[self.current]
+				for timer in list(slot):
+					if timer.rounds == 0:
+						slot.discard(timer)
+						timer.slot = None
+						expired.append(timer)
+					else:
+						timer.rounds -= 1
+				self.count -= len(expired)
+
+			for timer in expired:
+				self.executor.submit(self.__fire, timer)
+
+	def __fire(self, timer):
+		func, args = timer.func, timer.args
+		timer.func = timer.args = None
+		try:
+			func(*args)
+		except Exception as e:
+			print("Error running timer callback")
+			print("Exception: {0}".format(e))
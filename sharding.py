@@ -0,0 +1,173 @@
+import bisect
+import contextlib
+import hashlib
+import json
+import os
+import threading
+
+# Consistent hash ring of the replica groups. Every group is placed on the ring at vnodes points
+# (its virtual nodes) and a key belongs to the group of the first point at or after the hash of
+# the key, so adding a group only moves the keys that land on its new points, about 1/N of them
+class HashRing:
+
+	DEFAULT_VNODES = 128
+
+	def __init__(self, groupCount, vnodes=DEFAULT_VNODES):
+		self.groupCount = groupCount
+		points = sorted((hashKey("group-{0}-{1}".format(group, vnode)), group) for group in range(groupCount) for vnode in range(vnodes))
+		self.hashes = [point[0] for point in points]
+		self.groups = [point[1] for point in points]
+
+	def owner(self, key):
+		if self.groupCount == 1:
+			return 0
+		return self.groups[bisect.bisect_left(self.hashes, hashKey(key)) % len(self.hashes)]
+
+# Maps the keys of the master to replica groups (lists of positions in its list of replicas).
+# A write only goes to the groups that own its keys. While a rebalance is in progress the ring
+# of the groups before it is kept too: reads keep going to the old owners, which stay complete
+# because writes go to the old and the new owners of their keys, until every key that moves has
+# been copied. Copying a batch of keys waits for the writes in flight on them and holds back new
+# ones, so a copy never overwrites a newer value
+class Sharding:
+	def __init__(self, groups, vnodes=HashRing.DEFAULT_VNODES):
+		self.groups = groups
+		self.vnodes = vnodes
+		self.ring = HashRing(len(groups), vnodes)
+		# ring of the groups before the rebalance in progress (None when there is none)
+		self.oldRing = None
+		self.everyReplica = sorted(ix for group in groups for ix in group)
+		self.cond = threading.Condition()
+		# key -> client writes in flight on it that started during the rebalance
+		self.writing = dict()
+		# keys being copied by the rebalance, writes on them wait
+		self.moving = set()
+
+	# Groups that apply a write of key
+	def owners(self, key):
+		group = self.ring.owner(key)
+		oldRing = self.oldRing
+		if oldRing is None:
+			return [group]
+		old = oldRing.owner(key)
+		return [group] if old == group else [old, group]
+
+	# Group that serves the reads of key
+	def readOwner(self, key):
+		return (self.oldRing or self.ring).owner(key)
+
+	# Groups that take part in a transaction on keys
+	def ownersOf(self, keys):
+		if len(self.groups) == 1:
+			return [0]
+		groups = set()
+		for key in keys:
+			groups.update(self.owners(key))
+		return sorted(groups)
+
+	# Replicas of the groups (positions in the master's list), sorted
+	def participants(self, groups):
+		if len(groups) == len(self.groups):
+			return self.everyReplica
+		return sorted(ix for group in groups for ix in self.groups[group])
+
+	# Splits the operations of a batch by owner: {group: ops}
+	def splitOps(self, ops):
+		if len(self.groups) == 1:
+			return {0: ops}
+		groupOps = dict()
+		for op in ops:
+			for group in self.owners(op[1]):
+				groupOps.setdefault(group, []).append(op)
+		return groupOps
+
+	def startRebalance(self, oldGroupCount):
+		self.oldRing = HashRing(oldGroupCount, self.vnodes)
+
+	def finishRebalance(self):
+		self.oldRing = None
+
+	# Registers a client write on keys, waiting while the rebalance copies any of them.
+	# Returns whether exit has to be called (writes are only tracked during a rebalance)
+	def enter(self, keys):
+		if self.oldRing is None:
+			return False
+		with self.cond:
+			while self.__moving(keys):
+				self.cond.wait()
+			self.__enter(keys)
+		return True
+
+	# Non-blocking enter: None if the write has to wait for a copy
+	def tryEnter(self, keys):
+		if self.oldRing is None:
+			return False
+		with self.cond:
+			if self.__moving(keys):
+				return None
+			self.__enter(keys)
+		return True
+
+	def exit(self, keys):
+		with self.cond:
+			for key in keys:
+				count = self.writing[key] - 1
+				if count > 0:
+					self.writing[key] = count
+				else:
+					del self.writing[key]
+			self.cond.notify_all()
+
+	@contextlib.contextmanager
+	def write(self, keys):
+		entered = self.enter(keys)
+		try:
+			yield
+		finally:
+			if entered:
+				self.exit(keys)
+
+	# Holds back the writes on keys and waits for the ones in flight
+	def beginMove(self, keys):
+		with self.cond:
+			self.moving.update(keys)
+			while any(key in self.writing for key in keys):
+				self.cond.wait()
+
+	def endMove(self, keys):
+		with self.cond:
+			self.moving.difference_update(keys)
+			self.cond.notify_all()
+
+	# must be called with the lock held
+	def __moving(self, keys):
+		return self.moving and any(key in self.moving for key in keys)
+
+	# must be called with the lock held
+	def __enter(self, keys):
+		for key in keys:
+			self.writing[key] = self.writing.get(key, 0) + 1
+
+def hashKey(key):
+	return int.from_bytes(hashlib.md5(str(key).encode("utf-8")).digest()[:8], "big")
+
+# Splits replicaCount replicas (in the order they were given) into groupCount groups of consecutive replicas
+def splitGroups(replicaCount, groupCount):
+	if groupCount < 1 or replicaCount % groupCount != 0:
+		raise ValueError("{0} replicas can't be split into {1} groups of the same size".format(replicaCount, groupCount))
+	size = replicaCount // groupCount
+	return [list(range(group * size, (group + 1) * size)) for group in range(groupCount)]
+
+# Groups the master ran with last time (None if it never ran)
+def loadGroups(fileName):
+	if not os.path.isfile(fileName):
+		return None
+	with open(fileName) as f:
+		return json.load(f)
+
+def saveGroups(fileName, groups):
+	with open(fileName + ".tmp", "w") as f:
+		json.dump(groups, f)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(fileName + ".tmp", fileName)
@@ -1,22 +1,106 @@
-import xmlrpc.client
+import asyncmaster
+import asyncrpc
+import concurrent.futures
+import checkpoint
+import grouplog
 import master
+import metrics
+import options
+import proxypool
+import readrouter
+import sharding
 import sys
+import threading
+import transactiontable
+import transport
+import workers
 from rpcserver import MultiThreadXMLRPCServer
 
-def createProxy(port):
-	proxy = xmlrpc.client.ServerProxy("http://localhost:"+ port)
-	return proxy
+argv, flags = options.parse(sys.argv)
 
-if len(sys.argv) < 2:
-	print ("startmaster logFileName replica-port1 [replica-port2 ...]")
+if len(argv) < 2:
+	print ("startmaster logFileName replica-port1 [replica-port2 ...] [--engine=threaded|asyncio] [--binary-port=N] [--transport=xmlrpc|binary] [--pool-size=N] [--dispatch-workers=N] [--log-batch-size=N] [--log-max-wait=SECONDS] [--protocol=classic|prepare] [--retention=SECONDS] [--checkpoint-interval=SECONDS] [--segment-size=BYTES] [--cache-size=BYTES] [--hedge=p95|off|SECONDS] [--read-timeout=SECONDS] [--groups=N] [--workers=N] [--worker-port=N] [--presumed-abort]")
 	exit()
 
-logFileName = sys.argv[1]
-server = MultiThreadXMLRPCServer(("localhost", 8000), allow_none=True)
-print("Listening on port 8000...")
+logFileName = argv[1]
+replicaPorts = argv[2:len(argv)]
+engine = options.getString(flags, "engine", "threaded")
+binaryPort = options.getInt(flags, "binary-port", None)
 
-replicaProxies = [createProxy(arg) for arg in sys.argv[2:len(sys.argv)]]
+poolSize = options.getInt(flags, "pool-size", proxypool.ProxyPool.DEFAULT_SIZE)
+# --transport picks how the master talks to the replicas (clients keep using XML-RPC on port 8000)
+replicaTransport = options.getString(flags, "transport", transport.XMLRPC)
 
-server.register_instance(master.Master(logFileName, replicaProxies))
-server.serve_forever()
+# --workers=N runs N coordinator processes on the same ports, each with its own tids and log;
+# worker w also listens on --worker-port + w for the transactionState queries of the others
+workerCount = options.getInt(flags, "workers", 1)
+workerPort = options.getInt(flags, "worker-port", workers.DEFAULT_WORKER_PORT)
+if workerCount > 1 and not workers.supported():
+	print("Worker processes need fork and SO_REUSEPORT, falling back to a single worker")
+	workerCount = 1
+# every worker would keep a cache of its own, which the writes of the other workers don't invalidate
+if workerCount > 1 and options.getInt(flags, "cache-size", 0):
+	print("--cache-size can only be used with a single worker")
+	exit()
+
+def startWorker(workerId):
+	reusePort = workerCount > 1
+	replicaProxies = [transport.createProxy(replicaTransport, port, poolSize) for port in replicaPorts]
+	peers = [transport.createProxy(transport.XMLRPC, workerPort + peer, poolSize) for peer in range(workerCount)] if reusePort else None
+
+	masterOptions = dict(
+		dispatchWorkers=options.getInt(flags, "dispatch-workers", None),
+		logBatchSize=options.getInt(flags, "log-batch-size", grouplog.GroupCommitLog.DEFAULT_BATCH_SIZE),
+		logMaxWait=options.getFloat(flags, "log-max-wait", grouplog.GroupCommitLog.DEFAULT_MAX_WAIT),
+		prepareMode=options.getString(flags, "protocol", "classic") == "prepare",
+		retention=options.getFloat(flags, "retention", transactiontable.TransactionTable.DEFAULT_RETENTION),
+		checkpointInterval=options.getFloat(flags, "checkpoint-interval", checkpoint.Checkpointer.DEFAULT_INTERVAL),
+		segmentSize=options.getInt(flags, "segment-size", checkpoint.Checkpointer.DEFAULT_SEGMENT_SIZE),
+		cacheSize=options.getInt(flags, "cache-size", 0),
+		hedge=readrouter.parseHedge(options.getString(flags, "hedge", "p95")),
+		readTimeout=options.getFloat(flags, "read-timeout", readrouter.ReadRouter.DEFAULT_TIMEOUT),
+		# --groups=N splits the replicas (in the order given) into N groups that each own part of the keys;
+		# groups appended to the list of a previous run take their keys over from the others
+		groups=sharding.splitGroups(len(replicaPorts), options.getInt(flags, "groups", 1)),
+		# --presumed-abort logs only commits and doesn't wait for abort acks (the replicas need the flag too)
+		presumedAbort="presumed-abort" in flags,
+		workerId=workerId,
+		workerCount=workerCount,
+		peers=peers)
+
+	if engine == "asyncio":
+		# one event loop serves every client; blocking XML-RPC replica proxies get a thread pool of their own
+		executor = concurrent.futures.ThreadPoolExecutor(max_workers=masterOptions["dispatchWorkers"] or 32)
+		asyncReplicaProxies = [asyncrpc.createProxy(replicaTransport, port, executor, poolSize) for port in replicaPorts]
+		coordinator = asyncmaster.AsyncMaster(logFileName, replicaProxies, asyncReplicaProxies, **masterOptions)
+		server = asyncrpc.AsyncRPCServer(coordinator)
+		server.listenXMLRPC(("localhost", 8000), reusePort)
+		if binaryPort:
+			server.listenBinary(("localhost", binaryPort), reusePort)
+		if reusePort:
+			server.listenXMLRPC(("localhost", workerPort + workerId))
+		print("Listening on port 8000 (asyncio engine, worker {0})...".format(workerId))
+	else:
+		server = MultiThreadXMLRPCServer(("localhost", 8000), allow_none=True, reusePort=reusePort)
+		print("Listening on port 8000 (worker {0})...".format(workerId))
+		coordinator = master.Master(logFileName, replicaProxies, **masterOptions)
+		server.register_instance(coordinator)
+		if binaryPort:
+			binaryServer = transport.createServer(transport.BINARY, ("localhost", binaryPort), reusePort=reusePort)
+			binaryServer.register_instance(coordinator)
+			threading.Thread(target=binaryServer.serve_forever, daemon=True).start()
+		if reusePort:
+			peerServer = MultiThreadXMLRPCServer(("localhost", workerPort + workerId), allow_none=True)
+			peerServer.register_instance(coordinator)
+			threading.Thread(target=peerServer.serve_forever, daemon=True).start()
+
+	# kill -USR1 prints the metrics (of every worker when sent to the parent of the workers)
+	metrics.dumpOnSignal(coordinator.metrics)
+	server.serve_forever()
 
+# logs of a previous run with another number of workers are merged before any worker starts
+workers.prepareLogs(logFileName, workerCount)
+if workerCount > 1:
+	workers.fork(workerCount, startWorker)
+else:
+	startWorker(0)
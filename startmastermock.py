@@ -1,23 +1,49 @@
-import xmlrpc.client
+import checkpoint
+import grouplog
 import master
 import mastermock
+import metrics
+import options
+import proxypool
+import readrouter
+import sharding
 import sys
+import transactiontable
+import transport
 from rpcserver import MultiThreadXMLRPCServer
 
-def createProxy(port):
-	proxy = xmlrpc.client.ServerProxy("http://localhost:"+ port)
-	return proxy
+argv, flags = options.parse(sys.argv)
 
-if len(sys.argv) < 2:
-	print ("startmaster logFileName replica-port1 [replica-port2 ...]")
+if len(argv) < 2:
+	print ("startmaster logFileName replica-port1 [replica-port2 ...] [--transport=xmlrpc|binary] [--pool-size=N] [--dispatch-workers=N] [--log-batch-size=N] [--log-max-wait=SECONDS] [--protocol=classic|prepare] [--retention=SECONDS] [--checkpoint-interval=SECONDS] [--segment-size=BYTES] [--cache-size=BYTES] [--hedge=p95|off|SECONDS] [--read-timeout=SECONDS] [--groups=N] [--presumed-abort]")
 	exit()
 
-logFileName = sys.argv[1]
+logFileName = argv[1]
 server = MultiThreadXMLRPCServer(("localhost", 8000), allow_none=True)
 print("Listening on port 8000...")
 
-replicaProxies = [createProxy(arg) for arg in sys.argv[2:len(sys.argv)]]
+poolSize = options.getInt(flags, "pool-size", proxypool.ProxyPool.DEFAULT_SIZE)
+# --transport picks how the master talks to the replicas (clients keep using XML-RPC on port 8000)
+replicaTransport = options.getString(flags, "transport", transport.XMLRPC)
+replicaProxies = [transport.createProxy(replicaTransport, arg, poolSize) for arg in argv[2:len(argv)]]
+# --groups=N splits the replicas (in the order given) into N groups that each own part of the keys
+groups = sharding.splitGroups(len(replicaProxies), options.getInt(flags, "groups", 1))
 
-server.register_instance(mastermock.MasterMock(logFileName, replicaProxies))
+coordinator = mastermock.MasterMock(logFileName, replicaProxies,
+	dispatchWorkers=options.getInt(flags, "dispatch-workers", None),
+	logBatchSize=options.getInt(flags, "log-batch-size", grouplog.GroupCommitLog.DEFAULT_BATCH_SIZE),
+	logMaxWait=options.getFloat(flags, "log-max-wait", grouplog.GroupCommitLog.DEFAULT_MAX_WAIT),
+	prepareMode=options.getString(flags, "protocol", "classic") == "prepare",
+	retention=options.getFloat(flags, "retention", transactiontable.TransactionTable.DEFAULT_RETENTION),
+	checkpointInterval=options.getFloat(flags, "checkpoint-interval", checkpoint.Checkpointer.DEFAULT_INTERVAL),
+	segmentSize=options.getInt(flags, "segment-size", checkpoint.Checkpointer.DEFAULT_SEGMENT_SIZE),
+	cacheSize=options.getInt(flags, "cache-size", 0),
+	hedge=readrouter.parseHedge(options.getString(flags, "hedge", "p95")),
+	readTimeout=options.getFloat(flags, "read-timeout", readrouter.ReadRouter.DEFAULT_TIMEOUT),
+	groups=groups,
+	presumedAbort="presumed-abort" in flags)
+
+server.register_instance(coordinator)
+metrics.dumpOnSignal(coordinator.metrics)
 server.serve_forever()
 
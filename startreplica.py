@@ -1,20 +1,39 @@
-import xmlrpc.client
+import checkpoint
+import grouplog
+import keyvaluestore
+import lockmanager
+import metrics
+import options
+import proxypool
 import sys
 import replica
-from rpcserver import MultiThreadXMLRPCServer
+import transport
 
-if len(sys.argv) < 3:
-	print("startreplica logFileName replica-port [db name]")
+argv, flags = options.parse(sys.argv)
+
+if len(argv) < 3:
+	print("startreplica logFileName replica-port [db name] [--transport=xmlrpc|binary] [--pool-size=N] [--log-batch-size=N] [--log-max-wait=SECONDS] [--checkpoint-interval=SECONDS] [--segment-size=BYTES] [--storage=log|shelve] [--lock-wait=SECONDS] [--presumed-abort]")
 	exit()
 
-server = MultiThreadXMLRPCServer(("localhost", int(sys.argv[2])), allow_none=True)
-port = sys.argv[2]
+server = transport.createServer(options.getString(flags, "transport", transport.XMLRPC), ("localhost", int(argv[2])))
+port = argv[2]
 print("Listening on port" + port + "...")
-masterProxy = xmlrpc.client.ServerProxy("http://localhost:8000")
+masterProxy = proxypool.createProxy(8000, options.getInt(flags, "pool-size", proxypool.ProxyPool.DEFAULT_SIZE))
 
-logFileName = sys.argv[1]
-dbName = "someDb{0}".format(port) if len(sys.argv) == 3 else sys.argv[3]
+logFileName = argv[1]
+dbName = "someDb{0}".format(port) if len(argv) == 3 else argv[3]
 print(dbName)
 
-server.register_instance(replica.Replica(logFileName, dbName, port, masterProxy))
+instance = replica.Replica(logFileName, dbName, port, masterProxy,
+	logBatchSize=options.getInt(flags, "log-batch-size", grouplog.GroupCommitLog.DEFAULT_BATCH_SIZE),
+	logMaxWait=options.getFloat(flags, "log-max-wait", grouplog.GroupCommitLog.DEFAULT_MAX_WAIT),
+	checkpointInterval=options.getFloat(flags, "checkpoint-interval", checkpoint.Checkpointer.DEFAULT_INTERVAL),
+	segmentSize=options.getInt(flags, "segment-size", checkpoint.Checkpointer.DEFAULT_SEGMENT_SIZE),
+	storageEngine=options.getString(flags, "storage", keyvaluestore.LOG),
+	lockWait=options.getFloat(flags, "lock-wait", lockmanager.LockManager.DEFAULT_WAIT),
+	# --presumed-abort doesn't log aborts (the master needs the flag too)
+	presumedAbort="presumed-abort" in flags)
+server.register_instance(instance)
+# kill -USR1 prints the metrics
+metrics.dumpOnSignal(instance.metrics)
 server.serve_forever()
@@ -0,0 +1,118 @@
+import heapq
+import random
+import threading
+import time
+
+# Termination protocol of a replica: transactions that voted yes and never heard the decision are
+# queued here, and a single thread asks the master about all of the due ones with one
+# transactionStates call. While the master is down (or hasn't decided yet) every tid is retried
+# with jittered exponential backoff, so the replica neither spins nor floods the master when it comes back
+class TerminationService:
+
+	BATCH_SIZE = 256
+	BASE_DELAY = 0.5
+	MAX_DELAY = 30
+	# the queue is rebuilt once entries of removed or rescheduled tids make up this share of it
+	COMPACT_RATIO = 0.5
+	COMPACT_MIN_SIZE = 1024
+
+	# Master states that don't settle the transaction yet
+	UNDECIDED = ("master-start-2pc", "master-start")
+
+	def __init__(self, masterProxy, resolve):
+		self.masterProxy = masterProxy
+		# resolve(tid, masterState) is called once the master has decided
+		self.resolve = resolve
+		# tid -> [due time, attempts]
+		self.entries = dict()
+		self.heap = []
+		self.cond = threading.Condition()
+		self.thread = threading.Thread(target=self.__run, name="termination", daemon=True)
+		self.thread.start()
+
+	# Queues an uncertain transaction, to be asked about after delay seconds
+	def add(self, tid, delay):
+		with self.cond:
+			self.__schedule(tid, time.monotonic() + delay, 0)
+			self.cond.notify()
+
+	# Queues many uncertain transactions at once (e.g. the ones found by recovery)
+	def addMany(self, tids, delay):
+		with self.cond:
+			due = time.monotonic() + delay
+			for tid in tids:
+				self.__schedule(tid, due, 0)
+			self.cond.notify()
+
+	# Drops a transaction whose decision arrived through the normal path. Its entry stays in the
+	# queue until it is due or the queue is compacted
+	def remove(self, tid):
+		with self.cond:
+			self.entries.pop(tid, None)
+			if len(self.heap) >= TerminationService.COMPACT_MIN_SIZE and len(self.entries) < (1 - TerminationService.COMPACT_RATIO) * len(self.heap):
+				self.heap = [(entry[0], tid) for tid, entry in self.entries.items()]
+				heapq.heapify(self.heap)
+
+	def __len__(self):
+		return len(self.entries)
+
+	# Entries in the queue, including the stale ones
+	def queued(self):
+		with self.cond:
+			return len(self.heap)
+
+	@staticmethod
+	def backoff(attempt):
+		delay = min(TerminationService.MAX_DELAY, TerminationService.BASE_DELAY * (2 ** attempt))
+		return delay * random.uniform(0.5, 1.0)
+
+	# must be called with the lock held
+	def __schedule(self, tid, due, attempts):
+		self.entries[tid] = [due, attempts]
+		heapq.heappush(self.heap, (due, tid))
+
+	def __run(self):
+		while True:
+			with self.cond:
+				while True:
+					now = time.monotonic()
+					if self.heap and self.heap[0][0] <= now:
+						break
+					self.cond.wait(self.heap[0][0] - now if self.heap else None)
+				due = []
+				while self.heap and self.heap[0][0] <= now and len(due) < TerminationService.BATCH_SIZE:
+					when, tid = heapq.heappop(self.heap)
+					# skip entries that were removed or rescheduled since they were pushed
+					entry = self.entries.get(tid)
+					if entry and entry[0] == when:
+						due.append(tid)
+
+			if not due:
+				continue
+
+			print("Contacting master about {0} transaction(s) in uncertainty state".format(len(due)))
+			try:
+				states = self.masterProxy.transactionStates(due)
+			except Exception as e:
+				print("Error contacting master")
+				print("Exception: {0}".format(e))
+				states = [None] * len(due)
+
+			# tids retried after the same number of attempts share one jittered delay, so they stay in one batch
+			retries = dict()
+			for tid, state in zip(due, states):
+				with self.cond:
+					entry = self.entries.get(tid)
+					if entry is None:
+						continue
+					if state is None or state in TerminationService.UNDECIDED:
+						if entry[1] not in retries:
+							retries[entry[1]] = time.monotonic() + TerminationService.backoff(entry[1])
+						self.__schedule(tid, retries[entry[1]], entry[1] + 1)
+						continue
+					del self.entries[tid]
+				try:
+					self.resolve(tid, state)
+				except Exception as e:
+					print("Error terminating transaction {0}".format(tid))
+					print("Exception: {0}".format(e))
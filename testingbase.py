@@ -3,6 +3,9 @@ import subprocess
 import xmlrpc.client
 import os
 import time
+import checkpoint
+import logformat
+import logstore
 
 class TestingBase(unittest.TestCase):
 	def _initialize(self):
@@ -16,9 +19,14 @@ class TestingBase(unittest.TestCase):
 		self.replica2Port = 9999
 		self.replica2DbName = "test-replica2-db"
 
-		self._removeFile(self.masterLogFile)	
-		self._removeFile(self.replica1LogFile)	
-		self._removeFile(self.replica2LogFile)	
+		# replicas the master uses and extra command line flags, see _restartWith
+		self.replicaPorts = [self.replica1Port, self.replica2Port]
+		self.masterFlags = ""
+		self.replicaFlags = ""
+
+		self._removeMasterLog()
+		self._removeLog(self.replica1LogFile)
+		self._removeLog(self.replica2LogFile)
 
 		self._removeDb(self.replica1DbName)
 		self._removeDb(self.replica2DbName)
@@ -38,6 +46,18 @@ class TestingBase(unittest.TestCase):
 		self._killReplica1()
 		self._killReplica2()
 
+	# Restarts the master and the replicas with other command line flags (and replicas for the master)
+	def _restartWith(self, masterFlags="", replicaFlags="", replicaPorts=None):
+		self._cleanup()
+		# the master refuses a log written for other replicas
+		self._removeMasterLog()
+		self.masterFlags = masterFlags
+		self.replicaFlags = replicaFlags
+		self.replicaPorts = replicaPorts or [self.replica1Port, self.replica2Port]
+		self._startReplica1()
+		self._startReplica2()
+		self._startMaster()
+
 	def _createFile(self, fileName):
 		f = open(fileName, "w")
 		f.close()
@@ -46,6 +66,25 @@ class TestingBase(unittest.TestCase):
 		self._removeFile(fileName + ".dat")
 		self._removeFile(fileName + ".bak")
 		self._removeFile(fileName + ".dir")
+		self._removeFile(fileName + ".migrated")
+		logstore.removeFiles(fileName)
+
+	def _removeMasterLog(self):
+		self._removeLog(self.masterLogFile)
+		self._removeFile(self.masterLogFile + ".outcomes")
+		self._removeFile(self.masterLogFile + ".groups")
+
+	# States of the records in the segments of a log, in order
+	def _logStates(self, fileName):
+		states = []
+		for seq in checkpoint.listSegments(fileName):
+			logformat.scanFile(checkpoint.segmentName(fileName, seq), lambda tid, state, ops: states.append(state))
+		return states
+
+	# logs are split into segments plus a checkpoint
+	def _removeLog(self, fileName):
+		checkpoint.removeLog(fileName)
+		time.sleep(1)
 
 	def _removeFile(self, fileName):
 		if os.path.isfile(fileName):
@@ -54,17 +93,17 @@ class TestingBase(unittest.TestCase):
 	
 	def _startMaster(self):
 		print("Starting master")
-		self.masterProcess = subprocess.Popen("startmaster.py {0} {1} {2}".format(self.masterLogFile, self.replica1Port, self.replica2Port), shell=True)
+		self.masterProcess = subprocess.Popen("startmaster.py {0} {1} {2}".format(self.masterLogFile, " ".join(str(port) for port in self.replicaPorts), self.masterFlags), shell=True)
 		time.sleep(1)
 
 	def _startReplica1(self):
 		print("Starting replica 1")
-		self.replica1Process = subprocess.Popen("startreplica.py {0} {1} {2}".format(self.replica1LogFile, self.replica1Port, self.replica1DbName), shell=True)
+		self.replica1Process = subprocess.Popen("startreplica.py {0} {1} {2} {3}".format(self.replica1LogFile, self.replica1Port, self.replica1DbName, self.replicaFlags), shell=True)
 		time.sleep(1)
 
 	def _startReplica2(self):
 		print("Starting replica 2")
-		self.replica2Process = subprocess.Popen("startreplica.py {0} {1} {2}".format(self.replica2LogFile, self.replica2Port, self.replica2DbName), shell=True)
+		self.replica2Process = subprocess.Popen("startreplica.py {0} {1} {2} {3}".format(self.replica2LogFile, self.replica2Port, self.replica2DbName, self.replicaFlags), shell=True)
 		time.sleep(1)
 
 
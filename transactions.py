@@ -1,5 +1,9 @@
+# Vote of a participant whose operation changes nothing (e.g. the delete of a missing key): it
+# releases its locks at once and takes no part in the commit phase
+READ_ONLY = "read-only"
+
 class Transaction:
-	def __init__(self, tid, state, operationString, action, key):
+	def __init__(self, tid, state, operationString, action, key, operations=None):
 		# (string) transaction id
 		self.tid = tid
 		# (string) Commit, abort, etc
@@ -8,6 +12,20 @@ class Transaction:
 		self.operationString = operationString
 		# lambda to execute the actual operation
 		self.action = action
-		# key, used for locking purposes
+		# key, used for locking purposes (a list of keys for batch transactions)
 		self.key = key
+		# structured operations ([["put", key, value], ["delete", key], ...]) written to the log, if any
+		self.operations = operations
+		# replicas taking part in the transaction (positions in the master's list), None for all of them
+		self.participants = None
+		# pending timeout of the transaction (a scheduler.Timer), cancelled once the outcome is known
+		self.timer = None
+		# why the master is aborting the transaction (see metrics), None if it isn't
+		self.abortReason = None
+
+	# Keys that have to be locked while the transaction is in progress
+	def lockedKeys(self):
+		if isinstance(self.key, (list, tuple)):
+			return list(self.key)
+		return [self.key]
 
@@ -0,0 +1,118 @@
+import collections
+import os
+import threading
+import time
+from transactions import Transaction
+
+# Compact record kept for a finished transaction while it is still within the retention window
+class Outcome:
+	__slots__ = ("code", "finished")
+
+	def __init__(self, code, finished):
+		self.code = code
+		self.finished = finished
+
+# Transaction table of the master. In-flight transactions are kept in full (they are needed to
+# run the protocol), finished ones shrink to a state code and are evicted once every replica acked
+# the decision or the retention window passed. Evicted outcomes go to a small on-disk index holding
+# one byte per tid at offset tid, so transactionState can still answer for old tids while
+# the memory used by the master stays flat
+class TransactionTable:
+
+	STATES = ["unknown", "master-start", "master-start-2pc", "master-commit", "master-abort"]
+	CODES = dict((state, code) for code, state in enumerate(STATES))
+
+	DEFAULT_RETENTION = 60
+
+	def __init__(self, indexFileName, retention=DEFAULT_RETENTION):
+		self.inflight = dict()
+		self.finished = collections.OrderedDict()
+		self.retention = retention
+		self.lock = threading.Lock()
+		self.indexFileName = indexFileName
+		mode = "r+b" if os.path.isfile(indexFileName) else "w+b"
+		self.index = open(indexFileName, mode)
+
+	def __setitem__(self, tid, transaction):
+		with self.lock:
+			self.inflight[tid] = transaction
+
+	# Only in-flight transactions can be looked up in full
+	def __getitem__(self, tid):
+		return self.inflight[tid]
+
+	def __contains__(self, tid):
+		return tid in self.inflight
+
+	def __len__(self):
+		return len(self.inflight) + len(self.finished)
+
+	def state(self, tid):
+		with self.lock:
+			transaction = self.inflight.get(tid)
+			if transaction:
+				return transaction.state
+			outcome = self.finished.get(tid)
+			if outcome:
+				return TransactionTable.STATES[outcome.code]
+			return TransactionTable.STATES[self.__readIndex(tid)]
+
+	# Called once the decision of the transaction was sent. acked tells whether every replica got it
+	def finish(self, tid, acked):
+		with self.lock:
+			transaction = self.inflight.pop(tid, None)
+			if transaction is None:
+				return
+			code = TransactionTable.CODES.get(transaction.state, 0)
+			if acked:
+				self.__writeIndex(tid, code)
+			else:
+				self.finished[tid] = Outcome(code, time.monotonic())
+			self.__evictExpired()
+
+	# Drops an in-flight transaction without recording its outcome (presumed abort: no record means abort)
+	def discard(self, tid):
+		with self.lock:
+			self.inflight.pop(tid, None)
+
+	# Transactions that a checkpoint has to keep: the logged in-flight ones and the retained outcomes
+	def snapshot(self):
+		with self.lock:
+			transactions = [transaction for transaction in self.inflight.values() if transaction.state != "master-start"]
+			for tid, outcome in self.finished.items():
+				transactions.append(Transaction(tid, TransactionTable.STATES[outcome.code], None, None, None))
+		return transactions
+
+	# Lowest tid that is safe to hand out: tids below it may already have an outcome in the index
+	def nextFreeTid(self):
+		with self.lock:
+			self.index.seek(0, os.SEEK_END)
+			return self.index.tell()
+
+	# Makes the on-disk index durable (needed before the log records it replaces are dropped)
+	def sync(self):
+		with self.lock:
+			self.index.flush()
+			os.fsync(self.index.fileno())
+
+	# must be called with the lock held
+	def __evictExpired(self):
+		expiry = time.monotonic() - self.retention
+		while self.finished:
+			tid, outcome = next(iter(self.finished.items()))
+			if outcome.finished > expiry:
+				break
+			del self.finished[tid]
+			self.__writeIndex(tid, outcome.code)
+
+	# must be called with the lock held
+	def __writeIndex(self, tid, code):
+		self.index.seek(tid)
+		self.index.write(bytes([code]))
+		self.index.flush()
+
+	# must be called with the lock held
+	def __readIndex(self, tid):
+		self.index.seek(tid)
+		data = self.index.read(1)
+		return data[0] if data else 0
@@ -0,0 +1,200 @@
+import concurrent.futures
+import itertools
+import json
+import socket
+import struct
+import threading
+import proxypool
+from rpcserver import MultiThreadXMLRPCServer
+
+# Compact binary RPC used between the master and the replicas, with XML-RPC kept as the
+# compatibility backend. Every message is a frame made of a fixed header
+# (payload length, request id, message kind) followed by a JSON payload:
+#   request:  [method, [params...]]
+#   response: result (or an error message when kind is ERROR)
+# Connections are persistent and requests are tagged with an id, so a client can pipeline many
+# requests on one socket and the server can answer them out of order
+
+XMLRPC = "xmlrpc"
+BINARY = "binary"
+
+HEADER = struct.Struct("!IIB")
+REQUEST = 0
+RESPONSE = 1
+ERROR = 2
+
+def createServer(kind, address, workers=None, reusePort=False):
+	if kind == BINARY:
+		return BinaryRPCServer(address, workers or BinaryRPCServer.DEFAULT_WORKERS, reusePort)
+	return MultiThreadXMLRPCServer(address, allow_none=True, reusePort=reusePort)
+
+def createProxy(kind, port, poolSize=proxypool.ProxyPool.DEFAULT_SIZE):
+	if kind == BINARY:
+		return BinaryRPCProxy("localhost", int(port))
+	return proxypool.createProxy(port, poolSize)
+
+def encode(kind, requestId, payload):
+	data = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+	return HEADER.pack(len(data), requestId, kind) + data
+
+def readFrame(sock):
+	header = readExactly(sock, HEADER.size)
+	if header is None:
+		return None
+	length, requestId, kind = HEADER.unpack(header)
+	data = readExactly(sock, length)
+	if data is None:
+		return None
+	return requestId, kind, json.loads(data.decode("utf-8"))
+
+def readExactly(sock, size):
+	chunks = []
+	while size > 0:
+		chunk = sock.recv(min(size, 1 << 16))
+		if not chunk:
+			return None
+		chunks.append(chunk)
+		size -= len(chunk)
+	return b"".join(chunks)
+
+# Raised on the client when the remote method failed (the equivalent of an xmlrpc Fault)
+class RemoteError(Exception):
+	pass
+
+# Serves the public methods of an instance over the binary protocol. Each connection has a reader
+# thread, and requests run on a shared pool so that pipelined requests don't wait for each other
+class BinaryRPCServer:
+
+	DEFAULT_WORKERS = 64
+
+	def __init__(self, address, workers=DEFAULT_WORKERS, reusePort=False):
+		self.instance = None
+		self.executors = proxypool.CallExecutors(workers, "rpc-worker")
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		if reusePort:
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		self.socket.bind(address)
+		self.socket.listen(128)
+
+	def register_instance(self, instance):
+		self.instance = instance
+
+	def serve_forever(self):
+		while True:
+			conn, addr = self.socket.accept()
+			conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			threading.Thread(target=self.__serveConnection, args=[conn], daemon=True).start()
+
+	def __serveConnection(self, conn):
+		writeLock = threading.Lock()
+		try:
+			while True:
+				frame = readFrame(conn)
+				if frame is None:
+					break
+				requestId, kind, payload = frame
+				self.executors.executorFor(payload[0]).submit(self.__handle, conn, writeLock, requestId, payload)
+		except OSError as e:
+			print("Connection closed: {0}".format(e))
+		finally:
+			conn.close()
+
+	def __handle(self, conn, writeLock, requestId, payload):
+		try:
+			method, params = payload
+			if method.startswith("_"):
+				raise AttributeError("method {0} is not supported".format(method))
+			result = getattr(self.instance, method)(*params)
+			response = encode(RESPONSE, requestId, result)
+		except Exception as e:
+			response = encode(ERROR, requestId, "{0}: {1}".format(type(e).__name__, e))
+		try:
+			with writeLock:
+				conn.sendall(response)
+		except OSError as e:
+			print("Error sending response: {0}".format(e))
+
+# Client side of the binary protocol. Thread-safe: all the threads share one persistent
+# connection, and a reader thread hands every response to the call waiting on its request id
+class BinaryRPCProxy:
+
+	def __init__(self, host, port, timeout=None):
+		self.address = (host, port)
+		self.timeout = timeout
+		self.ids = itertools.count(1)
+		self.lock = threading.Lock()
+		self.sock = None
+		self.pending = dict()
+
+	def __getattr__(self, name):
+		if name.startswith("__"):
+			raise AttributeError(name)
+		return lambda *args: self.call(name, *args)
+
+	def call(self, method, *args):
+		requestId = next(self.ids) & 0xFFFFFFFF
+		future = concurrent.futures.Future()
+		frame = encode(REQUEST, requestId, [method, list(args)])
+		with self.lock:
+			sock = self.__connect()
+			self.pending[requestId] = future
+			try:
+				sock.sendall(frame)
+			except OSError:
+				del self.pending[requestId]
+				self.__disconnect(sock)
+				raise
+		try:
+			return future.result(self.timeout)
+		except concurrent.futures.TimeoutError:
+			with self.lock:
+				self.pending.pop(requestId, None)
+			raise TimeoutError("No response to {0} from {1}".format(method, self.address))
+
+	def close(self):
+		with self.lock:
+			if self.sock:
+				self.__disconnect(self.sock)
+
+	# must be called with the lock held
+	def __connect(self):
+		if self.sock is None:
+			sock = socket.create_connection(self.address)
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			self.sock = sock
+			threading.Thread(target=self.__readLoop, args=[sock], daemon=True).start()
+		return self.sock
+
+	# must be called with the lock held. Fails every call still waiting on the connection
+	def __disconnect(self, sock):
+		if self.sock is sock:
+			self.sock = None
+			pending = self.pending
+			self.pending = dict()
+			for future in pending.values():
+				future.set_exception(ConnectionError("Connection to {0} lost".format(self.address)))
+		try:
+			sock.close()
+		except OSError:
+			pass
+
+	def __readLoop(self, sock):
+		try:
+			while True:
+				frame = readFrame(sock)
+				if frame is None:
+					break
+				requestId, kind, payload = frame
+				with self.lock:
+					future = self.pending.pop(requestId, None)
+				if future is None:
+					continue
+				if kind == ERROR:
+					future.set_exception(RemoteError(payload))
+				else:
+					future.set_result(payload)
+		except OSError:
+			pass
+		with self.lock:
+			self.__disconnect(sock)
@@ -0,0 +1,157 @@
+import os
+import signal
+import socket
+import threading
+import time
+import checkpoint
+import recovery
+
+# Multi-process master: workerCount coordinator processes are forked and all of them listen on the
+# client port (SO_REUSEPORT, the kernel spreads the connections). Worker w hands out the tids
+# w, w + workerCount, w + 2 * workerCount, ... and keeps a log (and outcome index) of its own, so
+# the workers share nothing. transactionState is answered by the worker that owns the tid: the
+# others forward the query to it on its private port (workerPort + w)
+
+DEFAULT_WORKER_PORT = 8100
+# a worker that dies sooner than this after its start is taken as a configuration error
+MIN_UPTIME = 5
+RESTART_DELAY = 1
+
+# Whether the platform can run more than one worker (not on Windows)
+def supported():
+	return hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")
+
+# Log of worker workerId out of workerCount (a single worker keeps the plain log name)
+def workerLogName(base, workerId, workerCount):
+	if workerCount == 1:
+		return base
+	return "{0}.worker{1}-{2}".format(base, workerId, workerCount)
+
+def ownerOf(tid, workerCount):
+	return tid % workerCount
+
+# Makes the logs of base match workerCount workers. If the master last ran with a different
+# number of workers, their logs are merged and split again by tid owner before any worker starts
+def prepareLogs(base, workerCount):
+	countFileName = base + ".workers"
+	previous = 1
+	if os.path.isfile(countFileName):
+		with open(countFileName) as f:
+			previous = int(f.read())
+	if previous != workerCount:
+		mergeLogs(base, previous, workerCount)
+
+# Merges the logs (checkpoints, segments and outcome indexes) of previous workers into the logs of
+# workerCount workers. The new logs go under new names and the worker count is saved before the
+# old logs are removed, so a crash in between leaves the old logs to merge again
+def mergeLogs(base, previous, workerCount):
+	oldNames = [workerLogName(base, workerId, previous) for workerId in range(previous)]
+	records = []
+	outcomes = bytearray()
+	idCount = 0
+	for name in oldNames:
+		data, transactions, nextSeq = checkpoint.recoveryRecords(name)
+		records.extend(transactions)
+		if data:
+			idCount = max(idCount, data["idCount"])
+		if os.path.isfile(name + ".outcomes"):
+			with open(name + ".outcomes", "rb") as f:
+				index = f.read()
+			if len(index) > len(outcomes):
+				outcomes.extend(bytes(len(index) - len(outcomes)))
+			for tid, code in enumerate(index):
+				if code:
+					outcomes[tid] = code
+	# reservations only carry a tid bound, which idCount keeps (as in recoverMaster)
+	reserved = [transaction.tid for transaction in records if transaction.state == "master-reserve"]
+	if reserved:
+		idCount = max(idCount, max(reserved))
+	transactions = recovery.RecoveryHelper.parseTransactions(transaction for transaction in records if transaction.state != "master-reserve")
+	if transactions:
+		idCount = max(idCount, max(transactions) + 1)
+	idCount = max(idCount, len(outcomes))
+
+	for workerId in range(workerCount):
+		name = workerLogName(base, workerId, workerCount)
+		removeLog(name)
+		with open(name + ".outcomes", "wb") as f:
+			for tid in range(workerId, len(outcomes), workerCount):
+				if outcomes[tid]:
+					f.seek(tid)
+					f.write(bytes([outcomes[tid]]))
+			f.flush()
+			os.fsync(f.fileno())
+		records = [recovery.RecoveryHelper.encodeTransaction(transaction) for tid, transaction in transactions.items() if ownerOf(tid, workerCount) == workerId]
+		checkpoint.writeCheckpoint(name, {"records": records, "idCount": idCount, "segment": 1})
+
+	with open(base + ".workers.tmp", "w") as f:
+		f.write(str(workerCount))
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(base + ".workers.tmp", base + ".workers")
+	for name in oldNames:
+		removeLog(name)
+	print("Merged the logs of {0} worker(s) into {1} worker(s): {2} transactions, next tid {3}".format(previous, workerCount, len(transactions), idCount))
+
+def removeLog(name):
+	checkpoint.removeLog(name)
+	if os.path.isfile(name + ".outcomes"):
+		os.remove(name + ".outcomes")
+
+# Runs start(workerId) in workerCount forked processes and restarts the ones that die. A worker
+# that dies right after its start stops every worker (it would only die again). Never returns
+def fork(workerCount, start):
+	children = dict()
+	for workerId in range(workerCount):
+		spawn(workerId, start, children)
+
+	def stop(signum, frame):
+		for pid in children:
+			os.kill(pid, signal.SIGTERM)
+		os._exit(0)
+	signal.signal(signal.SIGTERM, stop)
+	signal.signal(signal.SIGINT, stop)
+	# every worker prints its metrics (see metrics.dumpOnSignal)
+	def forward(signum, frame):
+		for pid in list(children):
+			os.kill(pid, signum)
+	if hasattr(signal, "SIGUSR1"):
+		signal.signal(signal.SIGUSR1, forward)
+
+	while True:
+		pid, status = os.wait()
+		if pid not in children:
+			continue
+		workerId, started = children.pop(pid)
+		if time.monotonic() - started < MIN_UPTIME:
+			print("Worker {0} exited with status {1} right after starting, stopping".format(workerId, status))
+			stop(None, None)
+		print("Worker {0} exited with status {1}, restarting it".format(workerId, status))
+		time.sleep(RESTART_DELAY)
+		spawn(workerId, start, children)
+
+def spawn(workerId, start, children):
+	pid = os.fork()
+	if pid == 0:
+		# the handlers of the parent would stop the other workers
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+		signal.signal(signal.SIGINT, signal.default_int_handler)
+		# until the worker installs its metrics dump, a forwarded SIGUSR1 would kill it
+		if hasattr(signal, "SIGUSR1"):
+			signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+		watchParent(os.getppid())
+		try:
+			start(workerId)
+		except Exception as e:
+			print("Worker {0} failed".format(workerId))
+			print("Exception: {0}".format(e))
+		os._exit(1)
+	children[pid] = (workerId, time.monotonic())
+
+# Ends the worker once its parent is gone (e.g. killed), so no worker keeps the port alone
+def watchParent(parentPid):
+	def run():
+		while os.getppid() == parentPid:
+			time.sleep(RESTART_DELAY)
+		os._exit(1)
+	threading.Thread(target=run, name="parent-watch", daemon=True).start()